@@ -0,0 +1,89 @@
+import csv
+import random
+from argparse import ArgumentParser
+
+FIELDNAMES = ['localID', 'isniIDs', 'kbrIDs', 'ntaIDs', 'bnfIDs', 'nationalities', 'languages']
+
+# -----------------------------------------------------------------------------
+def parseArguments():
+  parser = ArgumentParser(description='This script generates a synthetic authority CSV file with ISNI lookup identifiers to benchmark the enrichment')
+  parser.add_argument('-o', '--output-file', action='store', required=True, help='The CSV file that is generated')
+  parser.add_argument('-n', '--rows', action='store', type=int, default=10000, help='The number of rows')
+  parser.add_argument('--duplicate-ratio', action='store', type=float, default=0.2, help='The fraction of lookup identifiers that already appeared in an earlier row')
+  parser.add_argument('--multiple-ratio', action='store', type=float, default=0.1, help='The fraction of rows with two ";" separated lookup identifiers')
+  parser.add_argument('--missing-ratio', action='store', type=float, default=0.1, help='The fraction of rows without lookup identifier')
+  parser.add_argument('--seed', action='store', type=int, default=42, help='The seed of the random generator, such that the same file can be generated again')
+  args = parser.parse_args()
+
+  return args
+
+# -----------------------------------------------------------------------------
+def getISNICheckCharacter(digits):
+  """This function returns the ISO 7064 MOD 11-2 check character of the first 15 digits of an ISNI.
+
+  >>> getISNICheckCharacter('000000012103268')
+  '3'
+  """
+  total = 0
+  for digit in digits:
+    total = (total + int(digit)) * 2
+  result = (12 - total % 11) % 11
+  return 'X' if result == 10 else str(result)
+
+# -----------------------------------------------------------------------------
+def createISNI(randomGenerator):
+  """This function returns a random ISNI with a valid check character.
+
+  >>> len(createISNI(random.Random(1)))
+  16
+  """
+  digits = '0000000' + ''.join(randomGenerator.choices('0123456789', k=8))
+  return digits + getISNICheckCharacter(digits)
+
+# -----------------------------------------------------------------------------
+def generateRows(numberRows, duplicateRatio=0.2, multipleRatio=0.1, missingRatio=0.1, seed=42):
+  """This function yields rows with ISNI lookup identifiers and partially filled datafields.
+
+  >>> rows = list(generateRows(100, duplicateRatio=0.5, seed=1))
+  >>> len(rows)
+  100
+  >>> rows == list(generateRows(100, duplicateRatio=0.5, seed=1))
+  True
+  """
+  randomGenerator = random.Random(seed)
+  usedIdentifiers = []
+  for rowNumber in range(numberRows):
+    identifiers = []
+    if randomGenerator.random() >= missingRatio:
+      numberIdentifiers = 2 if randomGenerator.random() < multipleRatio else 1
+      for i in range(numberIdentifiers):
+        if usedIdentifiers and randomGenerator.random() < duplicateRatio:
+          identifiers.append(randomGenerator.choice(usedIdentifiers))
+        else:
+          identifier = createISNI(randomGenerator)
+          usedIdentifiers.append(identifier)
+          identifiers.append(identifier)
+
+    # some rows already have a local KBR identifier, such that not all datafields are missing
+    yield {
+      'localID': str(rowNumber + 1),
+      'isniIDs': ';'.join(identifiers),
+      'kbrIDs': str(randomGenerator.randint(1000000, 9999999)) if randomGenerator.random() < 0.3 else '',
+      'ntaIDs': '',
+      'bnfIDs': '',
+      'nationalities': '',
+      'languages': ''
+    }
+
+# -----------------------------------------------------------------------------
+def main(outputFile, numberRows, duplicateRatio=0.2, multipleRatio=0.1, missingRatio=0.1, seed=42):
+
+  with open(outputFile, 'w', newline='') as outFile:
+    outputWriter = csv.DictWriter(outFile, fieldnames=FIELDNAMES)
+    outputWriter.writeheader()
+    for row in generateRows(numberRows, duplicateRatio, multipleRatio, missingRatio, seed):
+      outputWriter.writerow(row)
+
+if __name__ == '__main__':
+  args = parseArguments()
+  main(args.output_file, args.rows, args.duplicate_ratio, args.multiple_ratio, args.missing_ratio, args.seed)
@@ -0,0 +1,192 @@
+import re
+import sys
+import json
+import time
+import random
+import zlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from argparse import ArgumentParser
+
+SRW_NAMESPACE = 'http://www.loc.gov/zing/srw/'
+MXC_NAMESPACE = 'info:lc/xmlns/marcxchange-v2'
+
+NATIONALITIES = ['BE', 'FR', 'NL', 'DE', 'GB']
+LANGUAGES = ['dut', 'fre', 'ger', 'eng']
+
+# -----------------------------------------------------------------------------
+def parseArguments():
+  parser = ArgumentParser(description='This script starts a local stand-in for the ISNI and BnF SRU APIs that answers every query with generated isni-e or unimarcxchange records')
+  parser.add_argument('-p', '--port', action='store', type=int, default=8765, help='The port on which the server listens')
+  parser.add_argument('--latency', action='store', type=float, default=0.05, help='The number of seconds the server waits before answering a request')
+  parser.add_argument('--latency-jitter', action='store', type=float, default=0.0, help='A random number of seconds up to this value is added to the latency of each request')
+  parser.add_argument('--slow-ratio', action='store', type=float, default=0.0, help='The fraction of requests that are answered only after --slow-latency seconds, for example to test hedged requests')
+  parser.add_argument('--slow-latency', action='store', type=float, default=10.0, help='The number of seconds the server waits before answering a slow request')
+  parser.add_argument('--error-rate', action='store', type=float, default=0.0, help='The fraction of requests that are answered with HTTP status code 503')
+  parser.add_argument('--record-size', action='store', type=int, default=2000, help='The approximate size of each record in bytes')
+  parser.add_argument('--not-found-ratio', action='store', type=float, default=0.1, help='The fraction of identifiers for which no record is found')
+  args = parser.parse_args()
+
+  return args
+
+# -----------------------------------------------------------------------------
+def isFound(identifier, notFoundRatio):
+  """This function decides based on the identifier alone if a record exists, such that repeated runs get the same answers.
+
+  >>> isFound('0000000121032683', 0.0)
+  True
+  >>> isFound('0000000121032683', 1.0)
+  False
+  """
+  return (zlib.crc32(identifier.encode('utf-8')) % 1000) >= notFoundRatio * 1000
+
+# -----------------------------------------------------------------------------
+def getPadding(identifier, size):
+  """This function returns a string of the given size to make records bigger, it is derived from the identifier such that it does not compress too well."""
+  return ''.join(random.Random(identifier).choices('abcdefghijklmnopqrstuvwxyz ', k=max(0, size)))
+
+# -----------------------------------------------------------------------------
+def createISNIRecord(identifier, recordSize):
+  """This function returns an isni-e srw:record with KBR, NTA and BNF identifiers and a nationality.
+
+  >>> record = createISNIRecord('0000000121032683', 0)
+  >>> '<isniUnformatted>0000000121032683</isniUnformatted>' in record
+  True
+  """
+  checksum = zlib.crc32(identifier.encode('utf-8'))
+  record = (
+    '<srw:record><srw:recordData><responseRecord><ISNIAssigned>'
+    f'<isniUnformatted>{identifier}</isniUnformatted>'
+    '<ISNIMetadata><identity><personOrFiction><additionalInformation>'
+    f'<nationality>{NATIONALITIES[checksum % len(NATIONALITIES)]}</nationality>'
+    '</additionalInformation></personOrFiction></identity>'
+    f'<sources><codeOfSource>KBR</codeOfSource><sourceIdentifier>{checksum % 10000000}</sourceIdentifier></sources>'
+    f'<sources><codeOfSource>NTA</codeOfSource><sourceIdentifier>{checksum % 100000000:09d}X</sourceIdentifier></sources>'
+    f'<sources><codeOfSource>BNF</codeOfSource><sourceIdentifier>cb1{checksum % 10000000:07d}</sourceIdentifier></sources>'
+    '<note>{padding}</note>'
+    '</ISNIMetadata></ISNIAssigned></responseRecord></srw:recordData></srw:record>'
+  )
+  return record.replace('{padding}', getPadding(identifier, recordSize - len(record)))
+
+# -----------------------------------------------------------------------------
+def createUnimarcRecord(identifier, recordSize):
+  """This function returns a unimarcxchange srw:record with the ISNI in datafield 010, a language and a nationality.
+
+  >>> record = createUnimarcRecord('0000000121032683', 0)
+  >>> '<mxc:subfield code="a">0000000121032683</mxc:subfield>' in record
+  True
+  """
+  checksum = zlib.crc32(identifier.encode('utf-8'))
+  record = (
+    '<srw:record><srw:recordData>'
+    f'<mxc:record xmlns:mxc="{MXC_NAMESPACE}">'
+    f'<mxc:datafield tag="010"><mxc:subfield code="a">{identifier}</mxc:subfield></mxc:datafield>'
+    f'<mxc:datafield tag="101"><mxc:subfield code="a">{LANGUAGES[checksum % len(LANGUAGES)]}</mxc:subfield></mxc:datafield>'
+    f'<mxc:datafield tag="102"><mxc:subfield code="a">{NATIONALITIES[checksum % len(NATIONALITIES)]}</mxc:subfield></mxc:datafield>'
+    '<mxc:datafield tag="300"><mxc:subfield code="a">{padding}</mxc:subfield></mxc:datafield>'
+    '</mxc:record></srw:recordData></srw:record>'
+  )
+  return record.replace('{padding}', getPadding(identifier, recordSize - len(record)))
+
+# -----------------------------------------------------------------------------
+def createResponse(query, recordSchema, startRecord, maximumRecords, recordSize, notFoundRatio):
+  """This function returns the searchRetrieveResponse for all quoted identifiers of the query, paged like an SRU API.
+
+  >>> response = createResponse('pica.isn = "0001" or pica.isn = "0002"', 'isni-e', 1, 1, 0, 0.0)
+  >>> response.count('<srw:record>'), '<srw:nextRecordPosition>2</srw:nextRecordPosition>' in response
+  (1, True)
+  """
+  identifiers = [i for i in re.findall(r'"([^"]*)"', query) if isFound(i, notFoundRatio)]
+  page = identifiers[startRecord-1:startRecord-1+maximumRecords]
+  createRecord = createUnimarcRecord if recordSchema == 'unimarcxchange' else createISNIRecord
+
+  nextRecordPosition = ''
+  if startRecord - 1 + maximumRecords < len(identifiers):
+    nextRecordPosition = f'<srw:nextRecordPosition>{startRecord + maximumRecords}</srw:nextRecordPosition>'
+
+  return (
+    f'<?xml version="1.0" encoding="UTF-8"?><srw:searchRetrieveResponse xmlns:srw="{SRW_NAMESPACE}">'
+    f'<srw:numberOfRecords>{len(identifiers)}</srw:numberOfRecords>'
+    f'<srw:records>{"".join([createRecord(i, recordSize) for i in page])}</srw:records>'
+    f'{nextRecordPosition}</srw:searchRetrieveResponse>'
+  )
+
+# -----------------------------------------------------------------------------
+class MockSRUHandler(BaseHTTPRequestHandler):
+  """An instance of this class answers a single request, the settings and counters are shared via the server."""
+
+  protocol_version = 'HTTP/1.1'
+
+  # headers and body are written separately, without this the delayed ACK of the client adds about 40 ms to each response
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  # ---------------------------------------------------------------------------
+  def sendResponse(self, statusCode, body, headers={}):
+    self.send_response(statusCode)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  # ---------------------------------------------------------------------------
+  def do_GET(self):
+    settings = self.server.settings
+    url = urlparse(self.path)
+
+    # the benchmark asks for the number of requests at the end
+    if url.path == '/stats':
+      with self.server.lock:
+        body = json.dumps(self.server.stats).encode('utf-8')
+      self.sendResponse(200, body, {'Content-Type': 'application/json'})
+      return
+
+    with self.server.lock:
+      self.server.stats['requests'] += 1
+
+    if random.random() < settings['slowRatio']:
+      time.sleep(settings['slowLatency'])
+    else:
+      time.sleep(settings['latency'] + random.uniform(0, settings['latencyJitter']))
+
+    if random.random() < settings['errorRate']:
+      with self.server.lock:
+        self.server.stats['errors'] += 1
+      self.sendResponse(503, b'Service Unavailable', {'Retry-After': '0'})
+      return
+
+    parameters = parse_qs(url.query)
+    body = createResponse(
+      parameters.get('query', [''])[0],
+      parameters.get('recordSchema', ['isni-e'])[0],
+      int(parameters.get('startRecord', ['1'])[0]),
+      int(parameters.get('maximumRecords', ['10'])[0]),
+      settings['recordSize'],
+      settings['notFoundRatio']
+    ).encode('utf-8')
+    self.sendResponse(200, body, {'Content-Type': 'text/xml;charset=UTF-8'})
+
+# -----------------------------------------------------------------------------
+def main(port, latency=0.05, latencyJitter=0.0, errorRate=0.0, recordSize=2000, notFoundRatio=0.1, slowRatio=0.0, slowLatency=10.0):
+
+  server = ThreadingHTTPServer(('127.0.0.1', port), MockSRUHandler)
+  server.daemon_threads = True
+  server.settings = {'latency': latency, 'latencyJitter': latencyJitter, 'errorRate': errorRate, 'recordSize': recordSize, 'notFoundRatio': notFoundRatio, 'slowRatio': slowRatio, 'slowLatency': slowLatency}
+  server.stats = {'requests': 0, 'errors': 0}
+  server.lock = threading.Lock()
+
+  print(f'Mock SRU server listening on http://127.0.0.1:{server.server_address[1]}', file=sys.stderr, flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+if __name__ == '__main__':
+  args = parseArguments()
+  main(args.port, args.latency, args.latency_jitter, args.error_rate, args.record_size, args.not_found_ratio, args.slow_ratio, args.slow_latency)
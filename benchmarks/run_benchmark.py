@@ -0,0 +1,189 @@
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import tempfile
+import subprocess
+import requests
+from argparse import ArgumentParser, REMAINDER
+
+import generate_csv
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# the arguments of enrich_authority_csv.py per API, requests are not delayed unless --wait is given after --
+ENRICHMENT_ARGUMENTS = {
+  'ISNI': ['--query', 'pica.isn =', '--record-schema', 'isni-e', '--data', 'kbrIDs=KBR', 'ntaIDs=NTA', 'bnfIDs=BNF', 'nationalities=nationality'],
+  'BnF': ['--query', 'aut.isni all', '--record-schema', 'unimarcxchange', '--data', 'nationalities=nationality', 'languages=language']
+}
+
+# -----------------------------------------------------------------------------
+def parseArguments():
+  parser = ArgumentParser(description='This script measures the throughput of the enrichment against a local mock SRU server, arguments after "--" are passed to enrich_authority_csv.py')
+  parser.add_argument('--api', action='store', choices=ENRICHMENT_ARGUMENTS.keys(), default='ISNI', help='The API whose records are served: ISNI (isni-e) or BnF (unimarcxchange)')
+  parser.add_argument('-n', '--rows', action='store', type=int, default=10000, help='The number of rows of the generated input')
+  parser.add_argument('--duplicate-ratio', action='store', type=float, default=0.2, help='The fraction of lookup identifiers that already appeared in an earlier row')
+  parser.add_argument('--latency', action='store', type=float, default=0.05, help='The number of seconds the mock server waits before answering a request')
+  parser.add_argument('--latency-jitter', action='store', type=float, default=0.0, help='A random number of seconds up to this value is added to the latency of each request')
+  parser.add_argument('--slow-ratio', action='store', type=float, default=0.0, help='The fraction of requests that the mock server answers only after --slow-latency seconds')
+  parser.add_argument('--slow-latency', action='store', type=float, default=10.0, help='The number of seconds the mock server waits before answering a slow request')
+  parser.add_argument('--error-rate', action='store', type=float, default=0.0, help='The fraction of requests that the mock server answers with HTTP status code 503')
+  parser.add_argument('--record-size', action='store', type=int, default=2000, help='The approximate size of each record in bytes')
+  parser.add_argument('--not-found-ratio', action='store', type=float, default=0.1, help='The fraction of identifiers for which no record is found')
+  parser.add_argument('--input-file', action='store', help='Use this CSV file (with an isniIDs column) instead of a generated one')
+  parser.add_argument('--output-json', action='store', help='A file in which the results are stored as JSON, such that runs can be compared')
+  parser.add_argument('enrichmentArguments', nargs=REMAINDER, help='Arguments for enrich_authority_csv.py, for example -- --max-in-flight 8 --batch-size 20')
+  args = parser.parse_args()
+
+  if args.enrichmentArguments and args.enrichmentArguments[0] == '--':
+    args.enrichmentArguments = args.enrichmentArguments[1:]
+  return args
+
+# -----------------------------------------------------------------------------
+def getPercentile(values, percentile):
+  """This function returns the nearest-rank percentile of the given values.
+
+  >>> getPercentile([4, 1, 3, 2], 50)
+  2
+  >>> getPercentile([4, 1, 3, 2], 99)
+  4
+  >>> getPercentile([], 50) is None
+  True
+  """
+  if not values:
+    return None
+  sortedValues = sorted(values)
+  rank = max(1, -(-len(sortedValues) * percentile // 100))
+  return sortedValues[int(rank) - 1]
+
+# -----------------------------------------------------------------------------
+def getFreePort():
+  with socket.socket() as freeSocket:
+    freeSocket.bind(('127.0.0.1', 0))
+    return freeSocket.getsockname()[1]
+
+# -----------------------------------------------------------------------------
+def getPeakMemory():
+  """This function returns the peak resident set size in megabytes of the largest terminated child process, or None if it cannot be measured on this platform."""
+  try:
+    import resource
+  except ImportError:
+    return None
+  maxRSS = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return maxRSS / (1024 * 1024) if sys.platform == 'darwin' else maxRSS / 1024
+
+# -----------------------------------------------------------------------------
+def createConfig(configFile, url):
+  """This function writes the example configuration with all APIs pointing to the mock server."""
+  with open(os.path.join(REPOSITORY_DIR, 'config-example.json'), 'r') as exampleFile:
+    config = json.load(exampleFile)
+  for apiName, api in config['apis'].items():
+    api['connection'] = {'type': 'unauthenticated', 'url': url, 'payload': api['connection']['payload']}
+  with open(configFile, 'w') as outFile:
+    json.dump(config, outFile, indent=2)
+
+# -----------------------------------------------------------------------------
+def startMockServer(port, latency, latencyJitter, errorRate, recordSize, notFoundRatio, slowRatio=0.0, slowLatency=10.0):
+  """This function starts the mock SRU server in a separate process and waits until it answers."""
+  server = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, 'mock_sru_server.py'),
+    '--port', str(port), '--latency', str(latency), '--latency-jitter', str(latencyJitter),
+    '--error-rate', str(errorRate), '--record-size', str(recordSize), '--not-found-ratio', str(notFoundRatio),
+    '--slow-ratio', str(slowRatio), '--slow-latency', str(slowLatency)])
+
+  for i in range(100):
+    try:
+      requests.get(f'http://127.0.0.1:{port}/stats', timeout=1)
+      return server
+    except requests.exceptions.ConnectionError:
+      time.sleep(0.1)
+  server.terminate()
+  raise Exception(f'The mock SRU server did not start on port {port}')
+
+# -----------------------------------------------------------------------------
+def printReport(results):
+  print()
+  print(f'{results["rows"]} rows in {results["seconds"]:.2f} seconds: {results["rowsPerSecond"]:.1f} rows/sec')
+  print(f'{results["requests"]} requests ({results["errors"]} answered with an error): {results["requestsPerSecond"]:.1f} requests/sec')
+  if results['latencyP50'] is not None:
+    print(f'request latency p50 {results["latencyP50"]*1000:.1f} ms, p99 {results["latencyP99"]*1000:.1f} ms')
+  if results['peakMemory'] is not None:
+    print(f'peak RSS {results["peakMemory"]:.1f} MB')
+
+# -----------------------------------------------------------------------------
+def main(apiName, numberRows, duplicateRatio, latency, latencyJitter, errorRate, recordSize, notFoundRatio, enrichmentArguments, inputFile=None, outputJSON=None, slowRatio=0.0, slowLatency=10.0):
+
+  with tempfile.TemporaryDirectory() as benchmarkDir:
+
+    if not inputFile:
+      inputFile = os.path.join(benchmarkDir, 'input.csv')
+      generate_csv.main(inputFile, numberRows, duplicateRatio)
+    with open(inputFile, 'r', newline='') as inFile:
+      numberRows = sum(1 for row in csv.reader(inFile)) - 1
+
+    port = getFreePort()
+    configFile = os.path.join(benchmarkDir, 'config.json')
+    createConfig(configFile, f'http://127.0.0.1:{port}/sru')
+
+    latencyFile = os.path.join(benchmarkDir, 'latencies.txt')
+    resultFile = os.path.join(benchmarkDir, 'result.json')
+    environment = dict(os.environ, BENCHMARK_LATENCY_FILE=latencyFile, BENCHMARK_RESULT_FILE=resultFile)
+    environment['PYTHONPATH'] = os.pathsep.join([REPOSITORY_DIR] + ([environment['PYTHONPATH']] if 'PYTHONPATH' in environment else []))
+
+    server = startMockServer(port, latency, latencyJitter, errorRate, recordSize, notFoundRatio, slowRatio, slowLatency)
+    try:
+      command = [sys.executable, os.path.join(BENCHMARK_DIR, 'timed_enrichment.py'),
+        '-i', inputFile, '-o', os.path.join(benchmarkDir, 'output.csv'), '-c', configFile, '--api', apiName,
+        '--column-name-lookup-identifier', 'isniIDs', '--wait', '0'] + ENRICHMENT_ARGUMENTS[apiName] + enrichmentArguments
+      # the progress bars and statistics of the enrichment are not shown, only the errors if it fails
+      with open(os.path.join(benchmarkDir, 'enrichment.log'), 'w+') as logFile:
+        enrichment = subprocess.run(command, env=environment, stdout=logFile, stderr=logFile)
+        if enrichment.returncode != 0:
+          logFile.seek(0)
+          print(logFile.read()[-2000:], file=sys.stderr)
+          raise Exception(f'The enrichment failed with exit code {enrichment.returncode}')
+      peakMemory = getPeakMemory()
+      stats = requests.get(f'http://127.0.0.1:{port}/stats', timeout=10).json()
+    finally:
+      server.terminate()
+      server.wait()
+
+    with open(resultFile, 'r') as inFile:
+      seconds = json.load(inFile)['seconds']
+    latencies = []
+    if os.path.isfile(latencyFile):
+      with open(latencyFile, 'r') as inFile:
+        latencies = [float(line) for line in inFile if line.strip()]
+
+  results = {
+    'api': apiName,
+    'rows': numberRows,
+    'duplicateRatio': duplicateRatio,
+    'latency': latency,
+    'errorRate': errorRate,
+    'slowRatio': slowRatio,
+    'recordSize': recordSize,
+    'enrichmentArguments': enrichmentArguments,
+    'seconds': seconds,
+    'rowsPerSecond': numberRows / seconds,
+    'requests': stats['requests'],
+    'errors': stats['errors'],
+    'requestsPerSecond': stats['requests'] / seconds,
+    'latencyP50': getPercentile(latencies, 50),
+    'latencyP99': getPercentile(latencies, 99),
+    'peakMemory': peakMemory
+  }
+  printReport(results)
+
+  if outputJSON:
+    with open(outputJSON, 'w') as outFile:
+      json.dump(results, outFile, indent=2)
+
+  return results
+
+if __name__ == '__main__':
+  args = parseArguments()
+  main(args.api, args.rows, args.duplicate_ratio, args.latency, args.latency_jitter, args.error_rate, args.record_size, args.not_found_ratio, args.enrichmentArguments, args.input_file, args.output_json, args.slow_ratio, args.slow_latency)
@@ -0,0 +1,37 @@
+import os
+import sys
+import json
+import time
+import runpy
+import requests
+
+# -----------------------------------------------------------------------------
+def timeRequests(latencyFile):
+  """This function wraps the HTTP requests of all sessions, such that the duration of each request is appended to the given file.
+
+  Each duration is written as a separate line with a single write, such that worker processes can append to the same file.
+  """
+  sessionGet = requests.Session.get
+
+  def timedGet(session, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return sessionGet(session, *args, **kwargs)
+    finally:
+      with open(latencyFile, 'a') as outFile:
+        outFile.write(f'{time.perf_counter() - start}\n')
+
+  requests.Session.get = timedGet
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  # this script takes the same arguments as enrich_authority_csv.py and is started by run_benchmark.py
+  timeRequests(os.environ['BENCHMARK_LATENCY_FILE'])
+
+  start = time.perf_counter()
+  sys.argv[0] = 'enrich_authority_csv.py'
+  runpy.run_module('enrich_authority_csv.enrich_authority_csv', run_name='__main__', alter_sys=True)
+  seconds = time.perf_counter() - start
+
+  with open(os.environ['BENCHMARK_RESULT_FILE'], 'w') as resultFile:
+    json.dump({'seconds': seconds}, resultFile)
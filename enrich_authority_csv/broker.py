@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import signal
+import socket
+import threading
+import socketserver
+from argparse import ArgumentParser
+from concurrent.futures import Future
+from enrich_authority_csv.config_parser import ConfigParser
+from enrich_authority_csv.memory_cache import MemoryCache
+from enrich_authority_csv.sru_client import SRUClient, readMessage, writeMessage
+from enrich_authority_csv.rate_limiter import createRateLimiter
+
+# -----------------------------------------------------------------------------
+def parseArguments():
+  parser = ArgumentParser(description='This script starts a broker through which several enrichments (started with --broker) send their requests: it requests each API under one rate limit for all of them, identical queries that are already in flight are requested once and recent responses are answered from memory')
+  parser.add_argument('-s', '--socket', action='store', required=True, help='The Unix socket on which the broker listens, the enrichments are started with "--broker" and the same path')
+  parser.add_argument('-c', '--config', action='store', help='The JSON configuration that specifies the SRU APIs and their rate limits, the same as the one of the enrichments, required unless --statistics is given')
+  parser.add_argument('--wait', action='store', type=float, default=1, help='The number of seconds to wait in between API requests, only used if the configuration does not specify a rate limit for the API')
+  parser.add_argument('--adaptive-rate', action='store_true', help='Adapt the number of requests per second to the API like --adaptive-rate of an enrichment, for all enrichments together')
+  parser.add_argument('--max-in-flight', action='store', type=int, help='The maximum number of concurrent requests per API, by default the "maxConcurrency" of the API rate limit in the configuration or 1')
+  parser.add_argument('--max-responses', action='store', type=int, default=10000, help='The number of recent responses that are kept in memory, the least recently used response is removed first')
+  parser.add_argument('--connect-timeout', action='store', type=float, default=10, help='The number of seconds to wait for a connection to the API')
+  parser.add_argument('--read-timeout', action='store', type=float, default=60, help='The number of seconds to wait for a response of the API')
+  parser.add_argument('--max-retries', action='store', type=int, default=3, help='The number of times a request is retried after a timeout, a connection error or the HTTP status codes 429, 500, 502, 503 and 504')
+  parser.add_argument('--hedge-percentile', action='store', type=float, help='Send a request a second time if it was not answered after this percentile of the duration of recent requests, like --hedge-percentile of an enrichment')
+  parser.add_argument('--hedge-budget', action='store', type=float, default=5, help='The maximum number of requests sent a second time by --hedge-percentile, as percentage of all requests')
+  parser.add_argument('--statistics', action='store_true', help='Do not start a broker, but print the statistics of the broker that listens on the socket')
+  args = parser.parse_args()
+  if not args.statistics and not args.config:
+    parser.error('the following arguments are required: -c/--config')
+  return args
+
+# -----------------------------------------------------------------------------
+class Broker:
+  """An instance of this class requests the SRU APIs on behalf of several enrichments, it can be shared by many threads.
+
+  Each API is requested under its own rate limit and with at most maxInFlight concurrent requests, for all enrichments together.
+  A query that is already being requested is not requested again, the later lookups wait for the same response,
+  and the last maxResponses successful responses are answered from memory.
+
+  >>> broker = Broker({'apis': {}}, secondsBetweenAPIRequests=0)
+  >>> payload = {'query': 'pica.isn= "0001"', 'recordSchema': 'isni-e'}
+  >>> broker.responses.put(broker.getKey('ISNI', payload), b'<xml/>')
+  >>> broker.fetch('ISNI', dict(reversed(list(payload.items()))))
+  (b'<xml/>', 'memory')
+  >>> broker.getStatistics()
+  {'ISNI': {'lookups': 1, 'memory': 1, 'coalesced': 0, 'request': 0, 'failures': 0, 'retries': 0}}
+  """
+
+  def __init__(self, config, secondsBetweenAPIRequests=1, adaptive=False, maxInFlight=None, maxResponses=10000, connectTimeout=10, readTimeout=60, maxRetries=3, hedgePercentile=None, hedgeBudget=5):
+    self.config = config
+    self.secondsBetweenAPIRequests = secondsBetweenAPIRequests
+    self.adaptive = adaptive
+    self.maxInFlight = maxInFlight
+    self.clientOptions = {'connectTimeout': connectTimeout, 'readTimeout': readTimeout, 'maxRetries': maxRetries, 'hedgePercentile': hedgePercentile, 'hedgeBudget': hedgeBudget}
+    self.responses = MemoryCache(maxResponses)
+    # the futures of the responses that are being requested per key
+    self.inFlight = {}
+    # the HTTP client, rate limiter and concurrency limit per API, created on the first lookup
+    self.sources = {}
+    self.statistics = {}
+    self.lock = threading.Lock()
+
+  # ---------------------------------------------------------------------------
+  def getKey(self, apiName, payload):
+    """This function returns the key of a query, the order of the payload does not matter."""
+    return (apiName, json.dumps(payload, sort_keys=True))
+
+  # ---------------------------------------------------------------------------
+  def getSource(self, apiName):
+    with self.lock:
+      source = self.sources.get(apiName)
+      if source is None:
+        rateLimiter, maxConcurrency = createRateLimiter(self.config, apiName, self.secondsBetweenAPIRequests, adaptive=self.adaptive)
+        maxInFlight = self.maxInFlight if self.maxInFlight else maxConcurrency
+        source = self.sources[apiName] = {
+          'client': SRUClient(self.config.getURL(apiName), poolSize=maxInFlight, **self.clientOptions),
+          'rateLimiter': rateLimiter,
+          'slots': threading.BoundedSemaphore(maxInFlight)
+        }
+      return source
+
+  # ---------------------------------------------------------------------------
+  def count(self, apiName, answeredBy, failed=False):
+    with self.lock:
+      statistics = self.statistics.setdefault(apiName, {'lookups': 0, 'memory': 0, 'coalesced': 0, 'request': 0, 'failures': 0})
+      statistics['lookups'] += 1
+      statistics[answeredBy] += 1
+      if failed:
+        statistics['failures'] += 1
+
+  # ---------------------------------------------------------------------------
+  def fetch(self, apiName, payload):
+    """This function returns the content of the response of the query (None if the request failed) and whether it was answered by "memory", "coalesced" or "request"."""
+    key = self.getKey(apiName, payload)
+    with self.lock:
+      # a response that was just stored is not requested again
+      content = self.responses.get(key)
+      future = self.inFlight.get(key) if content is None else None
+      isRequester = content is None and future is None
+      if isRequester:
+        future = self.inFlight[key] = Future()
+    if content is not None:
+      self.count(apiName, 'memory')
+      return content, 'memory'
+    if not isRequester:
+      content = future.result()
+      self.count(apiName, 'coalesced', content is None)
+      return content, 'coalesced'
+
+    try:
+      source = self.getSource(apiName)
+      with source['slots']:
+        content = source['client'].requestRecord(payload, source['rateLimiter'])
+      with self.lock:
+        if content is not None:
+          self.responses.put(key, content)
+        del self.inFlight[key]
+      future.set_result(content)
+    except BaseException as e:
+      with self.lock:
+        self.inFlight.pop(key, None)
+      future.set_exception(e)
+      raise
+
+    self.count(apiName, 'request', content is None)
+    return content, 'request'
+
+  # ---------------------------------------------------------------------------
+  def getStatistics(self):
+    """This function returns per API how many lookups were answered from memory, coalesced with a request in flight, requested, failed and how many requests were retried."""
+    with self.lock:
+      statistics = {apiName: dict(values) for apiName, values in self.statistics.items()}
+      for apiName, values in statistics.items():
+        values['retries'] = self.sources[apiName]['client'].retries if apiName in self.sources else 0
+    return statistics
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    for source in self.sources.values():
+      source['client'].close()
+
+# -----------------------------------------------------------------------------
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+  """An instance of this class answers the messages of one connection of an enrichment (see sru_client.BrokerClient) until it is closed."""
+
+  def handle(self):
+    broker = self.server.broker
+    while True:
+      header, content = readMessage(self.rfile)
+      if header is None:
+        return
+
+      if header.get('command') == 'statistics':
+        writeMessage(self.connection, {'statistics': broker.getStatistics()})
+        continue
+
+      try:
+        content, answeredBy = broker.fetch(header['api'], header['payload'])
+      except Exception as e:
+        writeMessage(self.connection, {'error': str(e)})
+        continue
+      writeMessage(self.connection, {'answeredBy': answeredBy}, content)
+
+# -----------------------------------------------------------------------------
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  # each connection is answered by its own thread, which ends with the broker
+  daemon_threads = True
+
+  def __init__(self, socketPath, broker):
+    self.broker = broker
+    super().__init__(socketPath, BrokerRequestHandler)
+
+# -----------------------------------------------------------------------------
+def requestStatistics(socketPath):
+  """This function returns the statistics of the broker that listens on the given socket."""
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as brokerSocket:
+    brokerSocket.connect(socketPath)
+    writeMessage(brokerSocket, {'command': 'statistics'})
+    with brokerSocket.makefile('rb') as inFile:
+      header, content = readMessage(inFile)
+  return header['statistics']
+
+# -----------------------------------------------------------------------------
+def removeStaleSocket(socketPath):
+  """This function removes the socket file of a broker that is not running anymore, it raises an exception if a broker still listens on it."""
+  if not os.path.exists(socketPath):
+    return
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as brokerSocket:
+    try:
+      brokerSocket.connect(socketPath)
+    except OSError:
+      os.remove(socketPath)
+      return
+  raise Exception(f'A broker already listens on "{socketPath}"')
+
+# -----------------------------------------------------------------------------
+def printStatistics(statistics, reportFile=sys.stdout):
+  for apiName, values in statistics.items():
+    print(f'{apiName}: {values["lookups"]} lookups, {values["request"]} requested ({values["retries"]} retries, {values["failures"]} failed), {values["memory"]} answered from memory, {values["coalesced"]} shared a request in flight', file=reportFile)
+
+# -----------------------------------------------------------------------------
+def main(configFile, socketPath, secondsBetweenAPIRequests=1, adaptiveRate=False, maxInFlight=None, maxResponses=10000, connectTimeout=10, readTimeout=60, maxRetries=3, hedgePercentile=None, hedgeBudget=5):
+
+  broker = Broker(ConfigParser(configFile), secondsBetweenAPIRequests, adaptiveRate, maxInFlight, maxResponses, connectTimeout, readTimeout, maxRetries, hedgePercentile, hedgeBudget)
+  removeStaleSocket(socketPath)
+  server = BrokerServer(socketPath, broker)
+
+  # the broker is stopped with Ctrl+C or SIGTERM, afterwards its statistics are printed
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  print(f'The broker listens on "{socketPath}"', file=sys.stderr)
+  try:
+    server.serve_forever()
+  except (KeyboardInterrupt, SystemExit):
+    pass
+  finally:
+    server.server_close()
+    os.remove(socketPath)
+    broker.close()
+    printStatistics(broker.getStatistics(), sys.stderr)
+
+if __name__ == '__main__':
+  args = parseArguments()
+  if args.statistics:
+    printStatistics(requestStatistics(args.socket))
+  else:
+    main(args.config, args.socket,
+      secondsBetweenAPIRequests=args.wait,
+      adaptiveRate=args.adaptive_rate,
+      maxInFlight=args.max_in_flight,
+      maxResponses=args.max_responses,
+      connectTimeout=args.connect_timeout,
+      readTimeout=args.read_timeout,
+      maxRetries=args.max_retries,
+      hedgePercentile=args.hedge_percentile,
+      hedgeBudget=args.hedge_budget)
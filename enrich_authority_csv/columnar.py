@@ -0,0 +1,238 @@
+import csv
+import functools
+import contextlib
+import enrich_authority_csv.lib as lib
+from enrich_authority_csv.enrichment_plan import EnrichmentPlan
+
+# pyarrow is only needed to read and write Parquet and Arrow files, the enrichment of CSV files works without it
+try:
+  import pyarrow as pa
+  import pyarrow.compute as pc
+  import pyarrow.csv as pacsv
+  import pyarrow.ipc as ipc
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+
+# the number of rows that are read, counted and written together
+BATCH_SIZE = 65536
+
+# -----------------------------------------------------------------------------
+def getFileFormat(filename):
+  """This function returns the format of the given file based on its extension: "parquet", "arrow" or "csv" (also if it is compressed).
+
+  >>> getFileFormat('authors.parquet'), getFileFormat('authors.feather'), getFileFormat('authors.csv.gz'), getFileFormat('-')
+  ('parquet', 'arrow', 'csv', 'csv')
+  """
+  for extension, fileFormat in lib.COLUMNAR_EXTENSIONS.items():
+    if filename.endswith(extension):
+      return fileFormat
+  return 'csv'
+
+# -----------------------------------------------------------------------------
+def isColumnar(inputFile, outputFile, arrowCSV=False):
+  """This function returns True if the input or output is a Parquet or Arrow file or if CSV files should be read and written with pyarrow.
+
+  >>> isColumnar('authors.csv', 'enriched.parquet'), isColumnar('authors.csv', 'enriched.csv'), isColumnar('authors.csv', 'enriched.csv', arrowCSV=True)
+  (True, False, True)
+  """
+  return arrowCSV or getFileFormat(inputFile) != 'csv' or getFileFormat(outputFile) != 'csv'
+
+# -----------------------------------------------------------------------------
+def checkPyArrow():
+  if pa is None:
+    raise Exception('Reading and writing Parquet or Arrow files (and --arrow-csv) requires pyarrow, it can be installed with "pip install pyarrow"')
+
+# -----------------------------------------------------------------------------
+def getNeededColumns(fieldnames, dataFields, identifierColumnName, rowKeyColumnName=None):
+  """This function returns the columns of the input the enrichment reads or writes, in the order of the input.
+
+  >>> getNeededColumns(['localID', 'name', 'nationalities', 'isniIDs'], {'nationalities': 'nationality'}, 'isniIDs', 'localID')
+  ['localID', 'nationalities', 'isniIDs']
+  """
+  neededColumns = set([identifierColumnName, rowKeyColumnName if rowKeyColumnName else identifierColumnName] + list(dataFields.keys()))
+  return [name for name in fieldnames if name in neededColumns]
+
+# -----------------------------------------------------------------------------
+def getStringColumn(array):
+  """This function returns the values of the given Arrow array as strings, missing values become empty strings like in a CSV file."""
+  return pc.fill_null(pc.cast(array, pa.string()), '')
+
+# -----------------------------------------------------------------------------
+def countTrue(mask):
+  return pc.sum(mask).as_py() or 0
+
+# -----------------------------------------------------------------------------
+def countBatch(counters, plan, columns):
+  """This function updates the counters with the statistics of all rows of a record batch at once, like EnrichmentPlan.countRow does row by row.
+
+  The columns are string arrays in the order of plan.fieldnames.
+  """
+  identifiers = columns[plan.identifierIndex]
+  hasIdentifier = pc.not_equal(identifiers, '')
+  numberIdentifiers = pc.sum(pc.if_else(hasIdentifier, pc.add(pc.count_substring(identifiers, ';'), 1), 0)).as_py() or 0
+  missingPerDatafield = [(name, pc.equal(columns[index], '')) for index, name, prefixFunction in plan.datafields]
+  missingAny = functools.reduce(pc.or_, [missing for name, missing in missingPerDatafield])
+
+  counters['numberRows'] += len(identifiers)
+  counters['numberISNIs'] += numberIdentifiers
+  counters['numberRowsMissingAtLeastOneIdentifier'] += countTrue(missingAny)
+  counters['numberRowsHaveISNI'] += countTrue(hasIdentifier)
+  counters['numberRowsMissingAndPossibleToBeEnriched'] += countTrue(pc.and_(missingAny, hasIdentifier))
+
+  for name, missing in missingPerDatafield:
+    datafieldCounters = counters[name]
+    datafieldCounters['numberISNIs'] += numberIdentifiers
+    datafieldCounters['numberMissingIdentifierRows'] += countTrue(missing)
+    datafieldCounters['numberRowsThatCannotBeEnriched'] += countTrue(pc.and_(missing, pc.invert(hasIdentifier)))
+    datafieldCounters['numberRowsToBeEnrichedHaveISNI'] += countTrue(pc.and_(missing, hasIdentifier))
+
+# -----------------------------------------------------------------------------
+class ColumnarInput:
+  """An instance of this class reads a Parquet, Arrow IPC or CSV file (the latter with pyarrow.csv) in record batches.
+
+  Only the columns the enrichment needs (lookup identifiers, row key and datafields) are converted to Python strings,
+  the rows are yielded as lists in the order of plan.fieldnames, such that they can be enriched like the rows of a CSV file.
+  """
+
+  def __init__(self, filename, delimiter=',', batchSize=BATCH_SIZE):
+    checkPyArrow()
+    if filename == '-':
+      raise Exception('Parquet and Arrow files (and --arrow-csv) cannot be read from stdin')
+    self.filename = filename
+    self.fileFormat = getFileFormat(filename)
+    self.delimiter = delimiter
+    self.batchSize = batchSize
+    with self.openRecordBatches() as (self.schema, recordBatches):
+      pass
+    self.fieldnames = self.schema.names
+
+  # ---------------------------------------------------------------------------
+  def createPlan(self, dataFields, identifierColumnName, rowKeyColumnName=None):
+    """This function returns an EnrichmentPlan for the needed columns, missing columns are reported like for a CSV file."""
+    lib.checkIfColumnsExist(self.fieldnames, [identifierColumnName, rowKeyColumnName if rowKeyColumnName else identifierColumnName] + list(dataFields.keys()))
+    return EnrichmentPlan(getNeededColumns(self.fieldnames, dataFields, identifierColumnName, rowKeyColumnName), dataFields, identifierColumnName, rowKeyColumnName)
+
+  # ---------------------------------------------------------------------------
+  @contextlib.contextmanager
+  def openRecordBatches(self, columns=None):
+    """This function yields the schema and an iterator over the record batches of the file, which is closed when the with block is left.
+
+    If a list of columns is given only those are read from a Parquet file.
+    """
+    if self.fileFormat == 'parquet':
+      with pq.ParquetFile(self.filename) as parquetFile:
+        yield parquetFile.schema_arrow, parquetFile.iter_batches(batch_size=self.batchSize, columns=columns)
+      return
+
+    if self.fileFormat == 'arrow':
+      with pa.OSFile(self.filename, 'rb') as source:
+        reader = ipc.open_file(source)
+        yield reader.schema, (reader.get_batch(i) for i in range(reader.num_record_batches))
+      return
+
+    # all values of a CSV file are read as they are, without guessing types
+    with lib.openInputFile(self.filename) as inFile:
+      header = next(csv.reader(inFile, delimiter=self.delimiter), [])
+    with lib.openInputFile(self.filename, binary=True) as inFile:
+      reader = pacsv.open_csv(inFile,
+        read_options=pacsv.ReadOptions(block_size=self.batchSize * 256),
+        parse_options=pacsv.ParseOptions(delimiter=self.delimiter, newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in header}, strings_can_be_null=False, quoted_strings_can_be_null=False))
+      yield reader.schema, reader
+
+  # ---------------------------------------------------------------------------
+  def iterateColumns(self, plan, batches=None):
+    """This function yields the needed columns of each record batch as string arrays in the order of plan.fieldnames.
+
+    If a deque is given as batches, each record batch is appended to it, such that a ColumnarWriter can write it later.
+    """
+    with self.openRecordBatches(plan.fieldnames if batches is None else None) as (schema, recordBatches):
+      for batch in recordBatches:
+        if batch.num_rows == 0:
+          continue
+        if batches is not None:
+          batches.append(batch)
+        yield [getStringColumn(batch.column(batch.schema.get_field_index(name))) for name in plan.fieldnames]
+
+  # ---------------------------------------------------------------------------
+  def readRows(self, plan, batches=None, counters=None):
+    """This function yields the rows as lists of strings in the order of plan.fieldnames, like plan.readRows does for a CSV file.
+
+    If counters are given, the statistics of each batch are counted with countBatch when it is read.
+    """
+    for columns in self.iterateColumns(plan, batches):
+      if counters is not None:
+        countBatch(counters, plan, columns)
+      for values in zip(*[column.to_pylist() for column in columns]):
+        yield list(values)
+
+  # ---------------------------------------------------------------------------
+  def countRows(self, counters, plan):
+    """This function counts the statistics of the whole file with countBatch, only the needed columns are read."""
+    for columns in self.iterateColumns(plan):
+      countBatch(counters, plan, columns)
+
+# -----------------------------------------------------------------------------
+class ColumnarWriter:
+  """An instance of this class writes the enriched rows like csv.writer, as Parquet, Arrow IPC or CSV file depending on the extension of the filename.
+
+  The rows are collected per record batch of the input (taken in input order from the batches deque filled by ColumnarInput.iterateColumns),
+  each batch is written with its datafield columns replaced as a whole, the other columns keep their values and types.
+  """
+
+  def __init__(self, filename, schema, plan, batches):
+    checkPyArrow()
+    if filename == '-':
+      raise Exception('Parquet and Arrow files (and --arrow-csv) cannot be written to stdout')
+    self.batches = batches
+    self.rows = []
+
+    # the schema position of each datafield column and its position in the rows,
+    # enriched columns are strings even if the input column had another type (for example only missing values)
+    self.datafieldColumns = [(schema.get_field_index(plan.fieldnames[index]), index) for index, name, prefixFunction in plan.datafields]
+    fields = list(schema)
+    for schemaIndex, rowIndex in self.datafieldColumns:
+      fields[schemaIndex] = fields[schemaIndex].with_type(pa.string())
+    self.schema = pa.schema(fields, metadata=schema.metadata)
+
+    fileFormat = getFileFormat(filename)
+    self.outFile = None
+    if fileFormat == 'parquet':
+      self.writer = pq.ParquetWriter(filename, self.schema)
+    elif fileFormat == 'arrow':
+      self.writer = ipc.new_file(filename, self.schema)
+    else:
+      self.outFile = lib.openOutputFile(filename, binary=True)
+      self.writer = pacsv.CSVWriter(self.outFile, self.schema, write_options=pacsv.WriteOptions(quoting_style='needed'))
+
+  # ---------------------------------------------------------------------------
+  def writerow(self, row):
+    self.rows.append(row)
+    if len(self.rows) == self.batches[0].num_rows:
+      self.writeBatch()
+
+  # ---------------------------------------------------------------------------
+  def writeBatch(self):
+    batch = self.batches.popleft()
+    rows = self.rows
+    self.rows = []
+
+    columns = batch.columns
+    for schemaIndex, rowIndex in self.datafieldColumns:
+      original = columns[schemaIndex]
+      enriched = pa.array([row[rowIndex] for row in rows], pa.string())
+      # values that are still empty stay missing if they were missing in the input
+      columns[schemaIndex] = pc.if_else(pc.and_(pc.is_null(original), pc.equal(enriched, '')), pa.scalar(None, pa.string()), enriched)
+    self.writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=self.schema))
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    self.writer.close()
+    if self.outFile:
+      self.outFile.close()
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
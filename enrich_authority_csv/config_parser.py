@@ -64,6 +64,15 @@ class ConfigParser:
     self.checkRecordSchemaExistence(endpoint, recordSchema)
     return self.config['apis'][endpoint]['data'][recordSchema]
     
+  def getRecordIdentifierPath(self, endpoint, recordSchema):
+    """This function returns the path to the lookup identifier within records of the given schema, it is needed to route records of batched requests and dump files back to the requested identifier."""
+    self.checkRecordSchemaExistence(endpoint, recordSchema)
+    recordIdentifiers = self.config['apis'][endpoint].get('recordIdentifiers', {})
+    if recordSchema in recordIdentifiers:
+      return recordIdentifiers[recordSchema]
+    else:
+      raise Exception(f'No record identifier path specified for record schema "{recordSchema}" of API "{endpoint}", it is needed for batched requests and dump files')
+
   def getURL(self, endpoint):
     """This function returns the URL of the API, if it is an API that requires authentication via the URL, the URL is built based on available information from the config and environment variables."""
     self.checkEndpointExistence(endpoint)
@@ -82,6 +91,12 @@ class ConfigParser:
     else:
       raise Exception(f'Unrecognized connection type "{connectionType}"')
   
+  def getRateLimit(self, endpoint):
+    """This function returns the optional rate limit of the API, for example {"requestsPerSecond": 5, "burst": 1, "maxConcurrency": 4}, or an empty dict if none is specified."""
+    self.checkEndpointExistence(endpoint)
+    connectionInfo = self.config['apis'][endpoint].get('connection', {})
+    return connectionInfo.get('rateLimit', {})
+
   def getPayload(self, endpoint):
     self.checkEndpointExistence(endpoint)
 
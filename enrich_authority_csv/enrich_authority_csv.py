@@ -1,9 +1,30 @@
 import os
+import sys
 import csv
+import time
+import itertools
+import contextlib
+import math
+import shutil
+import tempfile
+import threading
+import cProfile
+import pstats
 from dotenv import load_dotenv
 from enrich_authority_csv.config_parser import ConfigParser
 import enrich_authority_csv.lib as lib
-import time
+from enrich_authority_csv.rate_limiter import createRateLimiter
+from enrich_authority_csv.pipeline import getRequestPayload, createResponseCache, createRecordStore, createRequester, createDumpRequester, getSourceDataFields, getFallbackOptions, createFallbackRequesters, getSharedRequestOptions, checkSourcesCoverDataFields, getStateTask, closeRequester, getRequestStatistics, iterateEnrichedRows
+from enrich_authority_csv.response_cache import ResponseCache
+from enrich_authority_csv.state_store import StateStore
+import enrich_authority_csv.shards as shards
+import enrich_authority_csv.columnar as columnar
+import enrich_authority_csv.planner as planner
+import enrich_authority_csv.metrics as metrics
+from enrich_authority_csv.enrichment_plan import EnrichmentPlan, PassthroughWriter
+from enrich_authority_csv.metrics import stageMetrics
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from argparse import ArgumentParser
 
@@ -11,149 +32,293 @@ from argparse import ArgumentParser
 # -----------------------------------------------------------------------------
 def parseArguments():
   parser = ArgumentParser(description='This script reads a CSV file and requests for each found lookup identifier (in the column specified with --column-name-lookup-identifier) the datafields specified with --data')
-  parser.add_argument('-i', '--input-file', action='store', required=True, help='A CSV file that contains records about contributors')
-  parser.add_argument('-o', '--output-file', action='store', required=True, help='The CSV file in which the enriched records are stored')
+  parser.add_argument('-i', '--input-file', action='store', required=True, help='A CSV file that contains records about contributors, "-" reads from stdin and gzip, bz2 or xz compressed input is detected automatically. Files ending with .parquet, .arrow or .feather are read as Parquet or Arrow file (this requires pyarrow)')
+  parser.add_argument('-o', '--output-file', action='store', help='The CSV file in which the enriched records are stored, "-" writes to stdout and the file is compressed if it ends with .gz, .bz2 or .xz. Files ending with .parquet, .arrow or .feather are written as Parquet or Arrow file (this requires pyarrow). Required unless --plan is given')
   parser.add_argument('--data', metavar='KEY=VALUE', required=True, nargs='+', help='A key value pair where the key is the name of the data column in the input that should be fetched and the value is the name of the datafield as stated in the configuration.')
   parser.add_argument('--api', action='store', required=True, help='The name of the API that should be queried, as specified in the configuration')
+  parser.add_argument('--source', action='store', default='api', help='Where the records come from: "api" requests them from the SRU API, "file:PATH" reads them from a (possibly compressed) dump file of the same records without any request')
   parser.add_argument('--record-schema', action='store', required=True, help='The name of the record schema that should be requested, for example "isni-e" or "unimarcxchange"')
   parser.add_argument('-q', '--query', action='store', required=True, help='The query pattern used to query, e.g. "aut.isni all" for BnF or "pica.isn=" for ISNI')
+  parser.add_argument('--fallback', metavar=('API', 'RECORD_SCHEMA', 'QUERY'), nargs=3, action='append', default=[], help='Another source that is requested for rows whose datafields are still empty after the earlier sources, only for the datafields specified for its record schema. Can be given several times, the sources are requested in the given order')
   parser.add_argument('--column-name-lookup-identifier', action='store', required=True, help='The name of the column in the input file that contains the identifier to lookup')
   parser.add_argument('-c', '--config', action='store', required=True, help='The JSON configuration that specifies SRU APIs and which data fields an be retrieved from it.')
-  parser.add_argument('--wait', action='store', type=float, default = 1, help='The number of seconds to wait in between API requests')
+  parser.add_argument('--wait', action='store', type=float, default = 1, help='The number of seconds to wait in between API requests, only used if the configuration does not specify a rate limit for the API')
   parser.add_argument('-d', '--delimiter', action='store', default=',', help='The delimiter of the input CSV')
+  parser.add_argument('--arrow-csv', action='store_true', help='Read and write CSV files with pyarrow in batches of rows, like Parquet and Arrow files')
+  parser.add_argument('--batch-size', action='store', type=int, default=1, help='The number of lookup identifiers combined in a single "or" query, a value higher than 1 requires a record identifier path in the configuration')
+  parser.add_argument('--adaptive-rate', action='store_true', help='Adapt the number of requests per second to the API: it grows while responses are fast and stable and is halved on HTTP status 429 or 503, timeouts and latency spikes, up to the "maxRequestsPerSecond" of the API rate limit in the configuration')
+  parser.add_argument('--max-in-flight', action='store', type=int, help='The maximum number of concurrent API requests, by default the "maxConcurrency" of the API rate limit in the configuration or 1')
+  parser.add_argument('--cache-dir', action='store', help='A directory in which API responses are cached, such that a later run does not have to request them again')
+  parser.add_argument('--cache-ttl', action='store', type=float, help='The number of days after which a cached response expires, by default cached responses do not expire')
+  parser.add_argument('--cache-max-size', action='store', type=float, default=1024, help='The maximum size of the cache in megabytes, the least recently used responses are removed if it is exceeded')
+  parser.add_argument('--refresh', action='store_true', help='Request all records again instead of using cached responses, the new responses are still cached')
+  parser.add_argument('--record-store', action='store', help='A file in which the fetched records are stored per lookup identifier, such that a later run takes the records of known identifiers from it without a request, also for other datafields of the same record schema')
+  parser.add_argument('--exact-progress', action='store_true', help='Count the rows of the input before the enrichment starts, such that the progress bar shows the total and statistics are printed upfront. This reads the input twice and does not work with stdin')
+  parser.add_argument('--max-remembered-identifiers', action='store', type=int, default=100000, help='Each distinct lookup identifier is requested only once per run, this is the maximum number of identifiers whose fetched values are kept in memory for later rows')
+  parser.add_argument('--checkpoint-file', action='store', help='The file in which the progress is recorded to resume an interrupted run, by default the name of the output file with the suffix ".checkpoint"')
+  parser.add_argument('--checkpoint-interval', action='store', type=int, default=1000, help='The number of written rows after which the progress is recorded')
+  parser.add_argument('--connect-timeout', action='store', type=float, default=10, help='The number of seconds to wait for a connection to the API')
+  parser.add_argument('--read-timeout', action='store', type=float, default=60, help='The number of seconds to wait for a response of the API')
+  parser.add_argument('--max-retries', action='store', type=int, default=3, help='The number of times a request is retried after a timeout, a connection error or the HTTP status codes 429, 500, 502, 503 and 504')
+  parser.add_argument('--hedge-percentile', action='store', type=float, help='Send a request a second time if it was not answered after this percentile (for example 95) of the duration of recent requests and use whichever answer comes first, by default requests are not hedged')
+  parser.add_argument('--broker', action='store', help='The Unix socket of a broker (started with "python -m enrich_authority_csv.broker") through which the requests are sent, such that concurrent runs share the rate limit of each API, identical queries in flight and recent responses. The rate limit, retries and hedging are then those of the broker')
+  parser.add_argument('--hedge-budget', action='store', type=float, default=5, help='The maximum number of requests sent a second time by --hedge-percentile, as percentage of all requests')
+  parser.add_argument('--failed-file', action='store', help='A CSV file in which the input rows are stored for which a request still failed after all retries, such that they can be enriched later')
+  parser.add_argument('--validate-identifiers', action='store', choices=['isni', 'bnf'], help='Check the lookup identifiers before they are requested: ISNIs (spaces and dashes are removed) need a correct ISO 27729 check character and BnF identifiers a correct control character (it is added if missing), invalid identifiers are not requested')
+  parser.add_argument('--rejects-file', action='store', help='A CSV file in which the input rows are stored that contain an invalid lookup identifier, only used with --validate-identifiers')
+  parser.add_argument('--negative-cache-ttl', action='store', type=float, help='The number of days after which a cached response without any record expires, by default the same as --cache-ttl')
+  parser.add_argument('--workers', action='store', type=int, default=1, help='The number of worker processes, each enriching a part of the input. This requires an uncompressed input file and cannot be resumed')
+  parser.add_argument('--timings', action='store_true', help='Print how long reading, requesting, parsing, extracting, writing and waiting for the rate limit took in total and per row or request, with percentiles and histograms')
+  parser.add_argument('--metrics-file', action='store', help='A file in which the timings per stage are stored, as CSV if the name ends with .csv otherwise as JSON')
+  parser.add_argument('--metrics-interval', action='store', type=float, help='Print a line with the timings per stage every given number of seconds while enriching')
+  parser.add_argument('--profile', action='store', help='Run the enrichment with cProfile and store the profile in the given file, the functions with the highest cumulative time are printed as well')
+  parser.add_argument('--state-file', action='store', help='A file in which is recorded per row which lookup identifiers were looked up when and if nothing was found, such that a later run (for example of next month\'s export) skips rows for which nothing was found recently')
+  parser.add_argument('--row-key', action='store', help='The column that identifies a row across runs in the state file, by default the column of the lookup identifier')
+  parser.add_argument('--recheck-after', action='store', type=float, default=30, help='The number of days after which rows for which nothing was found are looked up again, only used with --state-file')
+  parser.add_argument('--resume', action='store_true', help='Continue an interrupted run: rows that were already written to the output file according to the checkpoint are not requested again')
+  parser.add_argument('--plan', action='store_true', help='Only read the input and print how many distinct lookup identifiers and requests the enrichment needs, how many of them the response cache of --cache-dir answers and how long it would take based on the rate limit and the latency of recent runs. Nothing is requested or written')
   args = parser.parse_args()
+  if not args.output_file and not args.plan:
+    parser.error('the following arguments are required: -o/--output-file')
 
   return args
 
 # -----------------------------------------------------------------------------
-def main(configFile, inputFile, outputFile, apiName, query, recordSchema, dataFields, delimiter, secondsBetweenAPIRequests, identifierColumnName):
+def saveCheckpoint(checkpointFile, outFile, inputRows, counters, progress, dataFields, identifierColumnName, failedOutFile=None, rejectsOutFile=None):
+  """This function records how many input rows are completely written to the output, such that an interrupted run can be resumed from there."""
+  outFile.flush()
+  if failedOutFile:
+    failedOutFile.flush()
+  if rejectsOutFile:
+    rejectsOutFile.flush()
+  lib.writeCheckpoint(checkpointFile, {
+    'inputRows': inputRows,
+    'outputSize': outFile.tell(),
+    'failedSize': failedOutFile.tell() if failedOutFile else None,
+    'rejectsSize': rejectsOutFile.tell() if rejectsOutFile else None,
+    'progress': progress,
+    'counters': counters,
+    'dataFields': dataFields,
+    'identifierColumnName': identifierColumnName
+  })
 
+# -----------------------------------------------------------------------------
+def collectLookupIdentifiers(rows, plan):
+  """This function returns the normalized lookup identifiers of all rows that miss at least one datafield.
+
+  >>> plan = EnrichmentPlan(['isni', 'nationality'], {'nationality': 'nationality'}, 'isni')
+  >>> sorted(collectLookupIdentifiers([['0001;0002', ''], ['0003', 'BE']], plan))
+  ['0001', '0002']
+  """
+  identifiers = set()
+  for row in rows:
+    lookupIdentifierList = plan.getLookupIdentifiers(row)
+    if lookupIdentifierList and plan.needsEnrichment(row):
+      identifiers.update([lib.normalizeLookupIdentifier(i) for i in lookupIdentifierList if i])
+  return identifiers
 
-  config = ConfigParser(configFile)
+# -----------------------------------------------------------------------------
+def rewindInput(inFile, delimiter, plan, rowTexts=None):
+  """This function reads the input file again from the first row after the header, with the original texts of the rows if a rowTexts deque is given."""
+  inFile.seek(0, 0)
+  if rowTexts is not None:
+    rowTexts.clear()
+    inputRows = lib.iterateCSVRows(inFile, delimiter)
+    next(inputRows, None)
+    return plan.readRowsWithText(inputRows, rowTexts)
+
+  csvReader = csv.reader(inFile, delimiter=delimiter)
+  next(csvReader, None)
+  return plan.readRows(csvReader)
 
+# -----------------------------------------------------------------------------
+def enrichRows(inputReader, outputWriter, requester, plan, counters, requestLog, maxInFlight=1, batchSize=1, maxRememberedIdentifiers=100000, countRows=True, failedWriter=None, checkpoint=None, checkpointInterval=1000, stateStore=None, identifierType=None, rejectsWriter=None):
+  """This function enriches the rows of the inputReader (lists as yielded by plan.readRows) and writes them in input order with the outputWriter, it returns the number of written rows and of reused lookups.
+
+  If a checkpoint function is given, it is called with the number of written rows every checkpointInterval written rows.
+  """
+
+  # checkpoints are only saved in between rows, such that the counters and the output always match
+  rowsWritten = 0
+  lastCheckpointRows = 0
+  statistics = {}
+  for row in iterateEnrichedRows(inputReader, requester, plan, counters, requestLog, maxInFlight, batchSize, maxRememberedIdentifiers, countRows, failedWriter, statistics, stateStore, identifierType, rejectsWriter):
+    # timed without a context manager, because most rows are written unchanged and that is cheap
+    start = time.perf_counter()
+    outputWriter.writerow(row)
+    stageMetrics.record('write', time.perf_counter() - start)
+    rowsWritten += 1
+    if checkpoint and rowsWritten - lastCheckpointRows >= checkpointInterval:
+      checkpoint(rowsWritten)
+      lastCheckpointRows = rowsWritten
+
+  return rowsWritten, statistics['reusedLookups']
 
-  # check if the requested data can be fetched based on the given API config
-  lib.verifyTask(config, apiName, recordSchema, dataFields)
-
-
-
-  with open(inputFile, 'r') as inFile, \
-       open(outputFile, 'w') as outFile:
-
-
-    # Count some stats and reset the file pointer afterwards
-    countReader = csv.DictReader(inFile, delimiter=delimiter)
-
-    # the CSV should at least contain columns for the lookup identifier and the local datafields we want to enrich
-    minNeededColumns = [identifierColumnName] + list(dataFields.keys())
-    lib.checkIfColumnsExist(countReader.fieldnames, minNeededColumns)
-
-    counters = lib.initializeCounters(countReader, dataFields, identifierColumnName)
-    inFile.seek(0, 0)
-    
-    numberRowsAtLeastOneDatafieldMissing = counters['numberRowsMissingAtLeastOneIdentifier']
-    inputRowCountAll = counters['numberRows']
-    inputRowCountHaveLookupIdentifier = counters['numberRowsHaveISNI']
-    rowsWithLookupIdentifierPercentage = (inputRowCountHaveLookupIdentifier*100)/inputRowCountAll
-    inputRowCountEmptyAndPossibleToEnrich = counters['numberRowsMissingAndPossibleToBeEnriched']
-    print()
-    print(f'In total, the file contains {inputRowCountAll} lines from which {inputRowCountHaveLookupIdentifier} contain the identifier to lookup ({rowsWithLookupIdentifierPercentage:.2f}%)')
-    print()
-    for column, remoteFieldName in dataFields.items():
-      inputRowCountMissing = counters[remoteFieldName]['numberMissingIdentifierRows']
-      inputRowCountFieldMissingAndLookupIdentifier = counters[remoteFieldName]['numberRowsToBeEnrichedHaveISNI']
-      missingPercentage = (inputRowCountMissing*100)/inputRowCountAll
-      print(f'Stats for column "{column}" that should be enriched via "{remoteFieldName}" field from the remote SRU API')
-      print(f'{inputRowCountMissing} {remoteFieldName} values are missing and we want to get them ({missingPercentage:.2f}%).')
-      if inputRowCountMissing > 0:
-        missingChancePercentage = (inputRowCountFieldMissingAndLookupIdentifier*100)/inputRowCountMissing
-        print(f'From those {inputRowCountMissing} missing, we could enrich {inputRowCountFieldMissingAndLookupIdentifier}, because they have a lookup identifier ({missingChancePercentage:.2f}%)')
-      print()
-    print()
-
-    inputReader = csv.DictReader(inFile, delimiter=delimiter)
-
-
-    outputWriter = csv.DictWriter(outFile, fieldnames=inputReader.fieldnames)
-    outputWriter.writeheader()
-
-    # the payload for each request (the actual query will be appended for each request)
-    payload = config.getPayload(apiName)
-    payload['recordSchema'] = recordSchema
-    url = config.getURL(apiName)
-
-    skippedRows = 0
-    # instantiating tqdm separately, such that we can add a description
-    # The total number of lines is the one we have to make requests for
-    requestLog = tqdm(position=0, total=inputRowCountEmptyAndPossibleToEnrich)
-
-    for row in inputReader:
-
-      # we are not interested in rows that already have values for identifier we look for
-      if not lib.atLeastOneIdentifierMissing(row, minNeededColumns):
-        skippedRows += 1
-
-        # write the input as-is to the output and stop processing of this row
-        outputWriter.writerow(row)
-        continue
-
-      # if there is no lookup identifier there is also nothing we can do
-      identifierRaw = row[identifierColumnName]
-      if identifierRaw == '':
-        outputWriter.writerow(row)
-        continue
-      else:
-        lookupIdentifierList = identifierRaw.split(';') if ';' in identifierRaw else [identifierRaw]
-
-      # update the progress bar description
-      descriptions = []
-      for identifierColumn, lookupIdentifier in dataFields.items():
-        descriptions.append(f'{lookupIdentifier} ' + str(counters[lookupIdentifier]['numberFoundISNIRows']))
-      requestLog.set_description(f'found ' + ','.join(descriptions))
-
-      foundIdentifiers = {}
-      rowAlreadyProcessed = False
-      for lookupIdentifier in lookupIdentifierList:
-
-        # request the record for the found identifier
-        payload['query'] = f'{query} "{lookupIdentifier}"'
-        xmlRecord = lib.requestRecord(url, payload)
-
-        if not xmlRecord:
-          outputWriter.writerow(row)
-          requestLog.update(1)
-          continue
-
-        # extract information for each needed identifier
-        for identifierColumn, lookupIdentifierName in dataFields.items():
-          # Only enrich it when the currently looked for identifier is missing
-          # note: in the future we could think of an 'update' functionality
-          if row[identifierColumn] == '':
-      
-            datafieldDefinition = config.getDatafieldDefinition(apiName, recordSchema, lookupIdentifierName)
-            foundIdentifier = lib.extractIdentifier(xmlRecord, lookupIdentifierName, datafieldDefinition)
-
-            if foundIdentifier:
-              if not rowAlreadyProcessed:
-                counters[lookupIdentifierName]['numberFoundISNIRows'] += 1
-                rowAlreadyProcessed = True
-
-              if lookupIdentifierName in foundIdentifiers: 
-                foundIdentifiers[lookupIdentifierName].add(lib.getPrefixedIdentifier(foundIdentifier, lookupIdentifierName))
-              else:
-                foundIdentifiers[lookupIdentifierName] = set([lib.getPrefixedIdentifier(foundIdentifier, lookupIdentifierName)])
-              counters[lookupIdentifierName]['numberFoundISNIs'] += 1
-
-      for identifierColumn, lookupIdentifierName in dataFields.items():
-        # we can only add something if we found something
-        if lookupIdentifierName in foundIdentifiers:
-          currentValue = row[identifierColumn]
-          row[identifierColumn] = ';'.join(foundIdentifiers[lookupIdentifierName])
-      requestLog.update(1)
-
-
-      outputWriter.writerow(row)
-      time.sleep(secondsBetweenAPIRequests)
+# -----------------------------------------------------------------------------
+def initializeShardWorker(rateLimiters):
+  """This function is run once in each worker process, such that all workers share the rate limits (per API) of the main process."""
+  global sharedRateLimiters
+  sharedRateLimiters = rateLimiters
+
+  # a forked worker starts with a copy of the timings of the main process
+  stageMetrics.reset()
+
+# -----------------------------------------------------------------------------
+def enrichShard(shard):
+  """This function enriches the rows of one shard of the input in a worker process and writes them without header to the output file of the shard.
+
+  It returns the counters, request statistics and timings of the shard, such that they can be combined with those of the other shards.
+  """
+  config = ConfigParser(shard['configFile'])
+  requestOptions = shard['requestOptions']
+  requester = createRequester(config, sharedRateLimiters[requestOptions['apiName']][0], **requestOptions)
+  requester['fallbacks'] = createFallbackRequesters(config, sharedRateLimiters, shard['fallbackOptions'], **getSharedRequestOptions(requestOptions))
+  counters = lib.createCounters(shard['dataFields'])
+  plan = EnrichmentPlan(shard['fieldnames'], shard['dataFields'], shard['identifierColumnName'], shard['rowKeyColumnName'])
+  stateStore = StateStore(**shard['stateOptions']) if shard['stateOptions'] else None
+  requestLog = tqdm(position=shard['number'], leave=False)
+
+  with shards.openInputShard(shard['inputFile'], shard['start'], shard['end']) as inFile, \
+       open(shard['outputFile'], 'w', newline='') as outFile, \
+       (open(shard['failedFile'], 'w', newline='') if shard['failedFile'] else contextlib.nullcontext()) as failedOutFile, \
+       (open(shard['rejectsFile'], 'w', newline='') if shard['rejectsFile'] else contextlib.nullcontext()) as rejectsOutFile:
+
+    if shard['lineTerminator']:
+      rowTexts = deque()
+      inputReader = plan.readRowsWithText(lib.iterateCSVRows(inFile, shard['delimiter']), rowTexts)
+      outputWriter = PassthroughWriter(outFile, plan, rowTexts, shard['lineTerminator'])
+    else:
+      inputReader = plan.readRows(csv.reader(inFile, delimiter=shard['delimiter']))
+      outputWriter = csv.writer(outFile)
+    failedWriter = csv.writer(failedOutFile) if failedOutFile else None
+    rejectsWriter = csv.writer(rejectsOutFile) if rejectsOutFile else None
+    try:
+      rowsWritten, reusedLookups = enrichRows(inputReader, outputWriter, requester, plan, counters, requestLog, failedWriter=failedWriter, stateStore=stateStore, rejectsWriter=rejectsWriter, **shard['enrichOptions'])
+    finally:
+      requestLog.close()
+      closeRequester(requester)
+      if stateStore:
+        stateStore.close()
+
+  return counters, getRequestStatistics(requester, reusedLookups), stageMetrics.getState()
+
+# -----------------------------------------------------------------------------
+def enrichShards(configFile, inputFile, fieldnames, delimiter, outFile, failedOutFile, workers, rateLimiters, requestOptions, fallbackOptions, enrichOptions, dataFields, identifierColumnName, counters, rowKeyColumnName=None, stateOptions=None, rejectsOutFile=None, lineTerminator=None):
+  """This function splits the input into shards which are enriched by a pool of worker processes.
+
+  The outputs of the shards are appended in input order to the given output files, their counters are added to the given counters
+  and their timings to those of the main process, the combined request statistics are returned.
+  """
+  statistics = {}
+  with tempfile.TemporaryDirectory() as shardDir:
+    shardSettings = []
+    for number, (start, end) in enumerate(shards.findShardOffsets(inputFile, workers)):
+      shardSettings.append({
+        'number': number,
+        'configFile': configFile,
+        'inputFile': inputFile,
+        'start': start,
+        'end': end,
+        'fieldnames': fieldnames,
+        'delimiter': delimiter,
+        'lineTerminator': lineTerminator,
+        'outputFile': os.path.join(shardDir, f'shard-{number}.csv'),
+        'failedFile': os.path.join(shardDir, f'shard-{number}-failed.csv') if failedOutFile else None,
+        'rejectsFile': os.path.join(shardDir, f'shard-{number}-rejects.csv') if rejectsOutFile else None,
+        'dataFields': dataFields,
+        'identifierColumnName': identifierColumnName,
+        'rowKeyColumnName': rowKeyColumnName,
+        'stateOptions': stateOptions,
+        'requestOptions': requestOptions,
+        'fallbackOptions': fallbackOptions,
+        'enrichOptions': enrichOptions
+      })
+
+    # all workers share the rate limiters of the main process, the outputs are merged as soon as the shards before them are done
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializeShardWorker, initargs=(rateLimiters,)) as executor:
+      for shard, (shardCounters, shardStatistics, shardMetrics) in zip(shardSettings, executor.map(enrichShard, shardSettings)):
+        lib.mergeCounters(counters, shardCounters)
+        lib.mergeCounters(statistics, shardStatistics)
+        stageMetrics.merge(shardMetrics)
+        with open(shard['outputFile'], 'r', newline='') as shardFile:
+          shutil.copyfileobj(shardFile, outFile)
+        if failedOutFile:
+          with open(shard['failedFile'], 'r', newline='') as shardFile:
+            shutil.copyfileobj(shardFile, failedOutFile)
+        if rejectsOutFile:
+          with open(shard['rejectsFile'], 'r', newline='') as shardFile:
+            shutil.copyfileobj(shardFile, rejectsOutFile)
+
+  return statistics
+
+# -----------------------------------------------------------------------------
+def printRequestStatistics(statistics, counters, failedFile, reportFile=sys.stdout, rejectsFile=None):
+  """This function prints how many lookups were answered without a request and how many requests were retried or failed."""
+
+  print(file=reportFile)
+  print(f'{statistics["reusedLookups"]} lookups were answered by identifiers that were already requested in this run', file=reportFile)
+
+  if 'cacheHits' in statistics:
+    print(file=reportFile)
+    print(f'{statistics["cacheHits"]} responses were taken from the cache, {statistics["cacheMisses"]} had to be requested', file=reportFile)
+
+  if 'storedLookups' in statistics:
+    print(file=reportFile)
+    print(f'{statistics["storedLookups"]} lookups were answered by the records in the record store', file=reportFile)
+
+  if 'brokerRequest' in statistics:
+    print(file=reportFile)
+    print(f'Of the responses of the broker, {statistics["brokerRequest"]} were requested for this run, {statistics["brokerMemory"]} were answered from its memory and {statistics["brokerCoalesced"]} shared a request that was already in flight', file=reportFile)
+
+  print(file=reportFile)
+  numberFailedRows = counters.get('numberFailedRows', 0)
+  print(f'{statistics["retries"]} requests were retried, {numberFailedRows} rows could not be enriched because a request still failed', file=reportFile)
+  if 'hedgedRequests' in statistics:
+    print(f'{statistics["hedgedRequests"]} slow requests were sent a second time, the second request answered first for {statistics["hedgeWins"]} of them', file=reportFile)
+  if failedFile and numberFailedRows > 0:
+    print(f'These rows are stored in "{failedFile}" and can be enriched later', file=reportFile)
+
+  if 'numberRejectedIdentifiers' in counters:
+    print(file=reportFile)
+    print(f'{counters["numberRejectedIdentifiers"]} lookup identifiers were not requested, because they are invalid', file=reportFile)
+    if rejectsFile:
+      print(f'The rows with invalid lookup identifiers are stored in "{rejectsFile}"', file=reportFile)
+
+  if 'numberSkippedRows' in counters:
+    print(file=reportFile)
+    print(f'{counters["numberSkippedRows"]} rows were not looked up, because nothing was found for their lookup identifiers in a recent run', file=reportFile)
+
+# -----------------------------------------------------------------------------
+def printMetricsPeriodically(interval, reportFile, stopped):
+  """This function prints a line with the timings per stage every interval seconds until the stopped event is set, it runs in a separate thread."""
+  while not stopped.wait(interval):
+    tqdm.write(metrics.getMetricsLine(stageMetrics), file=reportFile)
+
+# -----------------------------------------------------------------------------
+def printInputStatistics(counters, dataFields, reportFile=sys.stdout):
+  """This function prints how many rows of the input could possibly be enriched."""
+
+  inputRowCountAll = counters['numberRows']
+  inputRowCountHaveLookupIdentifier = counters['numberRowsHaveISNI']
+  rowsWithLookupIdentifierPercentage = (inputRowCountHaveLookupIdentifier*100)/inputRowCountAll if inputRowCountAll > 0 else 0
+  print(file=reportFile)
+  print(f'In total, the file contains {inputRowCountAll} lines from which {inputRowCountHaveLookupIdentifier} contain the identifier to lookup ({rowsWithLookupIdentifierPercentage:.2f}%)', file=reportFile)
+  print(file=reportFile)
+  for column, remoteFieldName in dataFields.items():
+    inputRowCountMissing = counters[remoteFieldName]['numberMissingIdentifierRows']
+    inputRowCountFieldMissingAndLookupIdentifier = counters[remoteFieldName]['numberRowsToBeEnrichedHaveISNI']
+    missingPercentage = (inputRowCountMissing*100)/inputRowCountAll if inputRowCountAll > 0 else 0
+    print(f'Stats for column "{column}" that should be enriched via "{remoteFieldName}" field from the remote SRU API', file=reportFile)
+    print(f'{inputRowCountMissing} {remoteFieldName} values are missing and we want to get them ({missingPercentage:.2f}%).', file=reportFile)
+    if inputRowCountMissing > 0:
+      missingChancePercentage = (inputRowCountFieldMissingAndLookupIdentifier*100)/inputRowCountMissing
+      print(f'From those {inputRowCountMissing} missing, we could enrich {inputRowCountFieldMissingAndLookupIdentifier}, because they have a lookup identifier ({missingChancePercentage:.2f}%)', file=reportFile)
+    print(file=reportFile)
+  print(file=reportFile)
+
+# -----------------------------------------------------------------------------
+def printEnrichmentStatistics(counters, dataFields, reportFile=sys.stdout):
+  """This function prints how many rows could be enriched per datafield."""
 
   for identifierColumn, lookupIdentifierName in dataFields.items():
     counterFound = counters[lookupIdentifierName]['numberFoundISNIRows']
@@ -161,15 +326,407 @@ def main(configFile, inputFile, outputFile, apiName, query, recordSchema, dataFi
     counterFoundIdentifier = counters[lookupIdentifierName]['numberFoundISNIs']
     if inputRowCountMissingFieldHavingLookupIdentifier > 0:
       percentage = (counterFound*100)/inputRowCountMissingFieldHavingLookupIdentifier
-      print()
-      print(f'{counterFound} from possible {inputRowCountMissingFieldHavingLookupIdentifier} records ({percentage:.2f}%) could be enriched with {lookupIdentifierName}-values from the SRU API!')
-      print(f'(In total {counterFoundIdentifier} were found (this number might be higher, because there can be more than one lookup identifier per row)')
-      print()
+      print(file=reportFile)
+      print(f'{counterFound} from possible {inputRowCountMissingFieldHavingLookupIdentifier} records ({percentage:.2f}%) could be enriched with {lookupIdentifierName}-values from the SRU API!', file=reportFile)
+      print(f'(In total {counterFoundIdentifier} were found (this number might be higher, because there can be more than one lookup identifier per row)', file=reportFile)
+      print(file=reportFile)
+    else:
+      print(file=reportFile)
+      print(f'{lookupIdentifierName}: No missing values that would have a lookup identifier. So there is nothing to enrich', file=reportFile)
+
+# -----------------------------------------------------------------------------
+def planEnrichment(config, inputFile, delimiter, apiName, query, recordSchema, dataFields, identifierColumnName, rateLimiters, fallbackOptions, batchSize=1, maxInFlight=None, cacheDir=None, cacheTTL=None, refresh=False, negativeCacheTTL=None, dumpFile=None, stateOptions=None, identifierType=None, rowKeyColumnName=None, arrowCSV=False, reportFile=sys.stdout, recordStoreFile=None):
+  """This function reads the input once and prints which requests an enrichment would send (see planner.printPlan), without sending any of them.
+
+  Existing response caches, record stores and state files are only read, they are not created if they do not exist.
+  """
+  counters = lib.createCounters(dataFields)
+  hasRecordStore = recordStoreFile and os.path.isfile(recordStoreFile)
+  stateStore = StateStore(**stateOptions) if stateOptions and os.path.isfile(stateOptions['filename']) else None
+  recordStore = createRecordStore(recordStoreFile, apiName, recordSchema, cacheTTL, refresh, negativeCacheTTL) if hasRecordStore and not dumpFile else None
+  try:
+    if arrowCSV or columnar.getFileFormat(inputFile) != 'csv':
+      columnarInput = columnar.ColumnarInput(inputFile, delimiter)
+      plan = columnarInput.createPlan(dataFields, identifierColumnName, rowKeyColumnName)
+      planned = planner.collectPlannedRequests(columnarInput.readRows(plan), plan, counters, batchSize, identifierType, stateStore, recordStore)
     else:
-      print()
-      print(f'{lookupIdentifierName}: No missing values that would have a lookup identifier. So there is nothing to enrich')
+      with lib.openInputFile(inputFile) as inFile:
+        csvReader = csv.reader(inFile, delimiter=delimiter)
+        plan = EnrichmentPlan(next(csvReader, []), dataFields, identifierColumnName, rowKeyColumnName)
+        planned = planner.collectPlannedRequests(plan.readRows(csvReader), plan, counters, batchSize, identifierType, stateStore, recordStore)
+  finally:
+    if stateStore:
+      stateStore.close()
+    if recordStore:
+      recordStore.close()
+
+  # each source is planned with the cache it would use, its rate limit and its concurrency
+  hasCache = cacheDir and os.path.isfile(os.path.join(cacheDir, ResponseCache.FILENAME))
+  sourceOptions = []
+  if not dumpFile:
+    sourceOptions.append((apiName, recordSchema, query, planned['requests'], maxInFlight if maxInFlight else rateLimiters[apiName][1], batchSize > 1, False, len(planned['storedIdentifiers']) if hasRecordStore else None))
+  # a fallback source looks up each lookup identifier separately, but only if the datafields are still missing
+  fallbackIdentifiers = [lookupIdentifier for identifiers in planned['requests'] for lookupIdentifier in identifiers] + planned['storedIdentifiers']
+  for options in fallbackOptions:
+    fallbackRequests = [[lookupIdentifier] for lookupIdentifier in fallbackIdentifiers]
+    numberStored = None
+    if hasRecordStore:
+      fallbackStore = createRecordStore(recordStoreFile, options['apiName'], options['recordSchema'], cacheTTL, refresh, negativeCacheTTL)
+      try:
+        fallbackRequests = [[lookupIdentifier] for lookupIdentifier in fallbackIdentifiers if not fallbackStore.isStored(lookupIdentifier)]
+      finally:
+        fallbackStore.close()
+      numberStored = len(fallbackIdentifiers) - len(fallbackRequests)
+    sourceOptions.append((options['apiName'], options['recordSchema'], options['query'], fallbackRequests, options['maxInFlight'], False, True, numberStored))
+
+  sources = []
+  for sourceAPIName, sourceRecordSchema, sourceQuery, requests, sourceMaxInFlight, batch, fallback, numberStored in sourceOptions:
+    cache = createResponseCache(cacheDir, sourceAPIName, cacheTTL, None, refresh, negativeCacheTTL) if hasCache else None
+    try:
+      sources.append(planner.planSource(sourceAPIName, requests, getRequestPayload(config, sourceAPIName, sourceRecordSchema), sourceQuery, rateLimiters[sourceAPIName][0], sourceMaxInFlight, cache, batch, fallback, numberStored))
+    finally:
+      if cache:
+        cache.close()
+
+  printInputStatistics(counters, dataFields, reportFile)
+  planner.printPlan(planned, counters, sources, dumpFile, reportFile)
+
+# -----------------------------------------------------------------------------
+def main(configFile, inputFile, outputFile, apiName, query, recordSchema, dataFields, delimiter, secondsBetweenAPIRequests, identifierColumnName, batchSize=1, maxInFlight=None, cacheDir=None, cacheTTL=None, cacheMaxSize=None, refresh=False, exactProgress=False, maxRememberedIdentifiers=100000, checkpointFile=None, checkpointInterval=1000, resume=False, connectTimeout=10, readTimeout=60, maxRetries=3, failedFile=None, workers=1, timings=False, metricsFile=None, metricsInterval=None, source='api', fallbacks=None, stateFile=None, rowKeyColumnName=None, recheckAfter=30, identifierType=None, rejectsFile=None, negativeCacheTTL=None, adaptiveRate=False, arrowCSV=False, planOnly=False, hedgePercentile=None, hedgeBudget=5, recordStoreFile=None, brokerSocket=None):
+
+
+  config = ConfigParser(configFile)
+
+  # with a broker, the rate limit, retries and hedging are those of the broker for all runs that use it
+  if brokerSocket and (adaptiveRate or hedgePercentile):
+    raise Exception('--adaptive-rate and --hedge-percentile are options of the broker, they cannot be used with --broker')
+
+  fallbacks = fallbacks if fallbacks is not None else []
+
+  # the rate limiter and the maximum concurrency per API, sources of the same API share them
+  rateLimiters = {}
+
+  # check if the requested data can be fetched based on the given API config
+  if fallbacks:
+    # with fallback sources, each source requests the datafields specified for it and together they have to provide all of them
+    sourceDataFields = getSourceDataFields(config, apiName, recordSchema, dataFields)
+    fallbackOptions = getFallbackOptions(config, fallbacks, dataFields, rateLimiters, secondsBetweenAPIRequests, maxInFlight, workers, adaptiveRate)
+    checkSourcesCoverDataFields(dataFields, [sourceDataFields] + [options['dataFields'] for options in fallbackOptions])
+  else:
+    lib.verifyTask(config, apiName, recordSchema, dataFields)
+    sourceDataFields = dataFields
+    fallbackOptions = []
+
+
+  # statistics and the progress of the enrichment are reported on stderr if the enriched CSV is written to stdout
+  reportFile = sys.stderr if outputFile == '-' else sys.stdout
+
+  dumpFile = None
+  if source.startswith('file:'):
+    dumpFile = source[len('file:'):]
+    if workers > 1:
+      raise Exception('A dump file is read by a single process, it cannot be used with several workers')
+    # records are looked up in the dump instead of requested, there is nothing to combine
+    batchSize = 1
+  elif source != 'api':
+    raise Exception(f'Unknown source "{source}", possible values are "api" and "file:PATH"')
+
+  # rows for which nothing was found in a recent run are skipped
+  stateOptions = None
+  if stateFile:
+    stateOptions = {
+      'filename': stateFile,
+      'task': getStateTask(apiName, recordSchema, query, dataFields, fallbacks),
+      'recheckAge': recheckAfter * 24 * 3600 if recheckAfter is not None else None
+    }
+
+  # a plan only reads the input, nothing is requested or written
+  if planOnly:
+    if apiName not in rateLimiters:
+      rateLimiters[apiName] = createRateLimiter(config, apiName, secondsBetweenAPIRequests, adaptive=adaptiveRate and not dumpFile)
+    planEnrichment(config, inputFile, delimiter, apiName, query, recordSchema, dataFields, identifierColumnName, rateLimiters, fallbackOptions,
+      batchSize=batchSize, maxInFlight=maxInFlight, cacheDir=cacheDir, cacheTTL=cacheTTL, refresh=refresh, negativeCacheTTL=negativeCacheTTL, dumpFile=dumpFile, stateOptions=stateOptions,
+      identifierType=identifierType, rowKeyColumnName=rowKeyColumnName, arrowCSV=arrowCSV, reportFile=sys.stdout, recordStoreFile=recordStoreFile)
+    return
+
+  # shards are merged only after they are complete, their progress cannot be recorded
+  if workers > 1:
+    if resume:
+      raise Exception('A run with several workers cannot be resumed')
+    checkpointFile = None
+
+  # by default progress is recorded next to the output, unless the output cannot be resumed anyway
+  elif not checkpointFile and lib.isResumableOutput(outputFile):
+    checkpointFile = f'{outputFile}.checkpoint'
+
+  # Parquet and Arrow files (or CSV files read by pyarrow) are read and written in record batches by a single process
+  columnarMode = columnar.isColumnar(inputFile, outputFile, arrowCSV)
+  if columnarMode:
+    if workers > 1 or resume:
+      raise Exception('Parquet and Arrow files (and --arrow-csv) cannot be enriched by several workers or resumed')
+    checkpointFile = None
+
+  checkpoint = None
+  if resume:
+    if not lib.isResumableOutput(outputFile):
+      raise Exception(f'Cannot resume writing "{outputFile}", only uncompressed output files can be resumed')
+    checkpoint = lib.readCheckpoint(checkpointFile)
+    if checkpoint['dataFields'] != dataFields or checkpoint['identifierColumnName'] != identifierColumnName:
+      raise Exception(f'Cannot resume, the checkpoint "{checkpointFile}" was created for other columns')
+
+    # rows written after the last checkpoint will be written again
+    with open(outputFile, 'r+b') as partialOutputFile:
+      partialOutputFile.truncate(checkpoint['outputSize'])
+
+  # failed rows of the interrupted run are kept if they were recorded in the checkpoint
+  resumeFailedFile = failedFile and checkpoint and checkpoint.get('failedSize') is not None
+  if resumeFailedFile:
+    if not lib.isResumableOutput(failedFile):
+      raise Exception(f'Cannot resume writing "{failedFile}", only uncompressed output files can be resumed')
+    with open(failedFile, 'r+b') as partialFailedFile:
+      partialFailedFile.truncate(checkpoint['failedSize'])
+
+  # rows with invalid lookup identifiers are only stored if identifiers are validated
+  rejectsFile = rejectsFile if identifierType else None
+  resumeRejectsFile = rejectsFile and checkpoint and checkpoint.get('rejectsSize') is not None
+  if resumeRejectsFile:
+    if not lib.isResumableOutput(rejectsFile):
+      raise Exception(f'Cannot resume writing "{rejectsFile}", only uncompressed output files can be resumed')
+    with open(rejectsFile, 'r+b') as partialRejectsFile:
+      partialRejectsFile.truncate(checkpoint['rejectsSize'])
+
+  with (lib.openInputFile(inputFile) if not columnarMode else contextlib.nullcontext()) as inFile, \
+       (lib.openOutputFile(outputFile, 'a' if resume else 'w') if not columnarMode else contextlib.nullcontext()) as outFile, \
+       (lib.openOutputFile(failedFile, 'a' if resumeFailedFile else 'w') if failedFile else contextlib.nullcontext()) as failedOutFile, \
+       (lib.openOutputFile(rejectsFile, 'a' if resumeRejectsFile else 'w') if rejectsFile else contextlib.nullcontext()) as rejectsOutFile:
+
+    # rows whose datafields are not changed are copied with their original text instead of being written anew,
+    # unless the output (always comma separated) has another delimiter than the input
+    rowTexts = deque() if delimiter == ',' and not columnarMode else None
+    if columnarMode:
+      # only the columns of the lookup identifier, the row key and the datafields are converted to rows
+      columnarInput = columnar.ColumnarInput(inputFile, delimiter)
+      plan = columnarInput.createPlan(dataFields, identifierColumnName, rowKeyColumnName)
+      fieldnames = plan.fieldnames
+    elif rowTexts is not None:
+      inputRows = lib.iterateCSVRows(inFile, delimiter)
+      fieldnames, headerText = next(inputRows, ([], ''))
+    else:
+      csvReader = csv.reader(inFile, delimiter=delimiter)
+      fieldnames = next(csvReader, [])
+
+    # the CSV should at least contain columns for the lookup identifier and the local datafields we want to enrich,
+    # their positions are resolved once such that rows can be handled as lists
+    if not columnarMode:
+      plan = EnrichmentPlan(fieldnames, dataFields, identifierColumnName, rowKeyColumnName)
+      inputReader = plan.readRows(csvReader) if rowTexts is None else plan.readRowsWithText(inputRows, rowTexts)
+
+    # only the records of identifiers in the input are kept from a dump, unless the input cannot be read twice
+    dumpIdentifiers = None
+    if dumpFile and columnarMode:
+      dumpIdentifiers = collectLookupIdentifiers(columnarInput.readRows(plan), plan)
+    elif dumpFile and inFile.seekable():
+      dumpIdentifiers = collectLookupIdentifiers(inputReader, plan)
+      inputReader = rewindInput(inFile, delimiter, plan, rowTexts)
+
+    if exactProgress:
+      # Count some stats and reset the file pointer afterwards, such that the progress bar knows the total
+      counters = lib.createCounters(dataFields)
+      if columnarMode:
+        # the statistics of each record batch are computed with column operations, only the needed columns are read
+        columnarInput.countRows(counters, plan)
+      else:
+        if not inFile.seekable():
+          raise Exception(f'An exact progress requires reading the input twice, this is not possible for "{inputFile}"')
+        for row in inputReader:
+          plan.countRow(counters, row)
+        inputReader = rewindInput(inFile, delimiter, plan, rowTexts)
+      printInputStatistics(counters, dataFields, reportFile)
+      progressTotal = counters['numberRowsMissingAndPossibleToBeEnriched']
+      if checkpoint:
+        for lookupIdentifierName in dataFields.values():
+          for counterName in ['numberFoundISNIRows', 'numberFoundISNIs']:
+            counters[lookupIdentifierName][counterName] = checkpoint['counters'][lookupIdentifierName][counterName]
+    else:
+      # statistics are counted while enriching and reported at the end
+      counters = checkpoint['counters'] if checkpoint else lib.createCounters(dataFields)
+      progressTotal = None
+
+    lineTerminator = None
+    if columnarMode:
+      # the record batches wait until their rows are enriched, then their datafield columns are replaced as a whole,
+      # without an exact progress the statistics of each batch are counted with column operations when it is read
+      batches = deque()
+      inputReader = columnarInput.readRows(plan, batches, None if exactProgress else counters)
+      outputWriter = columnar.ColumnarWriter(outputFile, columnarInput.schema, plan, batches)
+    elif rowTexts is not None:
+      # enriched rows get the same line ending as the unchanged rows
+      lineTerminator = lib.getLineTerminator(headerText)
+      outputWriter = PassthroughWriter(outFile, plan, rowTexts, lineTerminator)
+    else:
+      outputWriter = csv.writer(outFile)
+
+    inputRowsWritten = 0
+    if checkpoint:
+      # skip the rows that were already written by the interrupted run
+      for row in itertools.islice(inputReader, checkpoint['inputRows']):
+        inputRowsWritten += 1
+      if rowTexts is not None:
+        rowTexts.clear()
+    elif rowTexts is not None:
+      outFile.write(headerText)
+    elif not columnarMode:
+      # the columnar writer writes the header with the schema
+      outputWriter.writerow(fieldnames)
+
+    failedWriter = None
+    if failedOutFile:
+      failedWriter = csv.writer(failedOutFile)
+      if not resumeFailedFile:
+        failedWriter.writerow(fieldnames)
+
+    rejectsWriter = None
+    if rejectsOutFile:
+      rejectsWriter = csv.writer(rejectsOutFile)
+      if not resumeRejectsFile:
+        rejectsWriter.writerow(fieldnames)
+
+    if apiName not in rateLimiters:
+      rateLimiters[apiName] = createRateLimiter(config, apiName, secondsBetweenAPIRequests, shared=workers > 1, adaptive=adaptiveRate and not dumpFile)
+    rateLimiter, maxConcurrency = rateLimiters[apiName]
+    maxInFlight = maxInFlight if maxInFlight else maxConcurrency
+
+    # the concurrent requests are divided over the workers
+    if workers > 1:
+      maxInFlight = max(1, math.ceil(maxInFlight / workers))
+
+    requestOptions = {
+      'apiName': apiName,
+      'query': query,
+      'recordSchema': recordSchema,
+      'dataFields': sourceDataFields,
+      'batchSize': batchSize,
+      'maxInFlight': maxInFlight,
+      'cacheDir': cacheDir,
+      'cacheTTL': cacheTTL,
+      'cacheMaxSize': cacheMaxSize,
+      'negativeCacheTTL': negativeCacheTTL,
+      'refresh': refresh,
+      'connectTimeout': connectTimeout,
+      'readTimeout': readTimeout,
+      'maxRetries': maxRetries,
+      'hedgePercentile': hedgePercentile,
+      'hedgeBudget': hedgeBudget,
+      'recordStoreFile': recordStoreFile,
+      'brokerSocket': brokerSocket
+    }
+    enrichOptions = {
+      'maxInFlight': maxInFlight,
+      'batchSize': batchSize,
+      'maxRememberedIdentifiers': maxRememberedIdentifiers,
+      'countRows': not exactProgress and not columnarMode,
+      'identifierType': identifierType
+    }
+
+    if workers > 1:
+      # each worker process enriches a part of the input with its own progress bar
+      statistics = enrichShards(configFile, inputFile, fieldnames, delimiter, outFile, failedOutFile, workers, rateLimiters, requestOptions, fallbackOptions, enrichOptions, dataFields, identifierColumnName, counters, rowKeyColumnName, stateOptions, rejectsOutFile, lineTerminator)
+    else:
+      stateStore = StateStore(**stateOptions) if stateOptions else None
+      if dumpFile:
+        requester = createDumpRequester(config, apiName, recordSchema, sourceDataFields, dumpFile, dumpIdentifiers, reportFile)
+      else:
+        requester = createRequester(config, rateLimiter, **requestOptions)
+      requester['fallbacks'] = createFallbackRequesters(config, rateLimiters, fallbackOptions, **getSharedRequestOptions(requestOptions))
+
+      # instantiating tqdm separately, such that we can add a description
+      # The total number of lines is the one we have to make requests for (only known if the input was counted beforehand)
+      requestLog = tqdm(position=0, total=progressTotal, initial=checkpoint['progress'] if checkpoint else 0)
+
+      # if the run is interrupted, it can be resumed from the last checkpoint
+      saveProgress = None
+      if checkpointFile:
+        saveProgress = lambda rowsWritten: saveCheckpoint(checkpointFile, outFile, inputRowsWritten + rowsWritten, counters, requestLog.n, dataFields, identifierColumnName, failedOutFile, rejectsOutFile)
+        saveProgress(0)
+
+      # the timings of worker processes are only known when their shard is done, so they are printed periodically only for a single process
+      metricsStopped = threading.Event()
+      if metricsInterval:
+        threading.Thread(target=printMetricsPeriodically, args=(metricsInterval, reportFile, metricsStopped), daemon=True).start()
+
+      try:
+        rowsWritten, reusedLookups = enrichRows(inputReader, outputWriter, requester, plan, counters, requestLog, failedWriter=failedWriter, checkpoint=saveProgress, checkpointInterval=checkpointInterval, stateStore=stateStore, rejectsWriter=rejectsWriter, **enrichOptions)
+      finally:
+        metricsStopped.set()
+        requestLog.close()
+        closeRequester(requester)
+        if stateStore:
+          stateStore.close()
+        if columnarMode:
+          outputWriter.close()
+      statistics = getRequestStatistics(requester, reusedLookups)
+
+    printRequestStatistics(statistics, counters, failedFile, reportFile, rejectsFile)
+    if timings:
+      metrics.printReport(stageMetrics, reportFile)
+    if metricsFile:
+      metrics.writeMetricsFile(stageMetrics, metricsFile)
+
+  # the run is complete, it should not be resumed
+  if checkpointFile and os.path.isfile(checkpointFile):
+    os.remove(checkpointFile)
+
+  if not exactProgress:
+    printInputStatistics(counters, dataFields, reportFile)
+  printEnrichmentStatistics(counters, dataFields, reportFile)
 
 if __name__ == '__main__':
   args = parseArguments()
   dataFields = dict(map(lambda s: s.split('='), args.data))
-  main(args.config, args.input_file, args.output_file, args.api, args.query, args.record_schema, dataFields, args.delimiter, args.wait, args.column_name_lookup_identifier)
+  profile = cProfile.Profile() if args.profile else None
+  if profile:
+    profile.enable()
+  # the options are passed by name, such that adding an option cannot shift the others
+  main(args.config, args.input_file, args.output_file, args.api, args.query, args.record_schema, dataFields, args.delimiter, args.wait, args.column_name_lookup_identifier,
+    batchSize=args.batch_size,
+    maxInFlight=args.max_in_flight,
+    cacheDir=args.cache_dir,
+    cacheTTL=args.cache_ttl,
+    cacheMaxSize=args.cache_max_size,
+    refresh=args.refresh,
+    exactProgress=args.exact_progress,
+    maxRememberedIdentifiers=args.max_remembered_identifiers,
+    checkpointFile=args.checkpoint_file,
+    checkpointInterval=args.checkpoint_interval,
+    resume=args.resume,
+    connectTimeout=args.connect_timeout,
+    readTimeout=args.read_timeout,
+    maxRetries=args.max_retries,
+    failedFile=args.failed_file,
+    workers=args.workers,
+    timings=args.timings,
+    metricsFile=args.metrics_file,
+    metricsInterval=args.metrics_interval,
+    source=args.source,
+    fallbacks=args.fallback,
+    stateFile=args.state_file,
+    rowKeyColumnName=args.row_key,
+    recheckAfter=args.recheck_after,
+    identifierType=args.validate_identifiers,
+    rejectsFile=args.rejects_file,
+    negativeCacheTTL=args.negative_cache_ttl,
+    adaptiveRate=args.adaptive_rate,
+    arrowCSV=args.arrow_csv,
+    planOnly=args.plan,
+    hedgePercentile=args.hedge_percentile,
+    hedgeBudget=args.hedge_budget,
+    recordStoreFile=args.record_store,
+    brokerSocket=args.broker)
+
+  # only the main process is profiled, with several workers the enrichment itself happens in the worker processes
+  if profile:
+    profile.disable()
+    profile.dump_stats(args.profile)
+    reportFile = sys.stderr if args.output_file == '-' else sys.stdout
+    print(file=reportFile)
+    pstats.Stats(profile, stream=reportFile).sort_stats('cumulative').print_stats(25)
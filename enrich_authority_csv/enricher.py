@@ -0,0 +1,211 @@
+import asyncio
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+import enrich_authority_csv.lib as lib
+from enrich_authority_csv.config_parser import ConfigParser
+from enrich_authority_csv.enrichment_plan import EnrichmentPlan
+from enrich_authority_csv.state_store import StateStore
+from enrich_authority_csv.rate_limiter import createRateLimiter
+from enrich_authority_csv.pipeline import createRequester, createDumpRequester, createFallbackRequesters, getSourceDataFields, getFallbackOptions, checkSourcesCoverDataFields, getStateTask, closeRequester, getRequestStatistics, iterateEnrichedRows
+
+class Enricher:
+  """An instance of this class enriches rows from any iterable, such that the enrichment can be embedded in other programs.
+
+  The HTTP connections, the rate limit, the response cache and the record store (or the index of a dump file) are created once
+  and shared by all calls, such that a long running process can enrich many jobs without setting them up again.
+  Fallback sources are given as tuples of API, record schema and query, like --fallback of the command line.
+
+  >>> import os, json, tempfile
+  >>> directory = tempfile.mkdtemp()
+  >>> with open(os.path.join(directory, 'dump.xml'), 'w') as dumpFile:
+  ...   _ = dumpFile.write('<dump><record><isni>0001</isni><nationality>BE</nationality></record></dump>')
+  >>> config = {'apis': {'local': {
+  ...   'connection': {'type': 'unauthenticated', 'url': 'http://localhost', 'payload': {}},
+  ...   'recordIdentifiers': {'dump': 'srw:records/srw:record/srw:recordData/record/isni'},
+  ...   'data': {'dump': {'nationality': {'type': 'element', 'path': 'srw:records/srw:record/srw:recordData/record/nationality'}}}}}}
+  >>> with open(os.path.join(directory, 'config.json'), 'w') as configFile: json.dump(config, configFile)
+  >>> enricher = Enricher(os.path.join(directory, 'config.json'), 'local', '', 'dump', {'nationalities': 'nationality'}, 'isniIDs', source=f'file:{os.path.join(directory, "dump.xml")}')
+
+  Rows are dicts (for example from csv.DictReader or a database cursor) and are yielded in input order
+  >>> statistics = {}
+  >>> list(enricher.enrichRows([{'isniIDs': '0001', 'nationalities': ''}, {'isniIDs': '0002', 'nationalities': ''}], statistics=statistics))
+  [{'isniIDs': '0001', 'nationalities': 'BE'}, {'isniIDs': '0002', 'nationalities': ''}]
+  >>> statistics['counters']['nationality']['numberFoundISNIRows'], statistics['reusedLookups']
+  (1, 0)
+
+  Rows can also be lists in the order of the given fieldnames
+  >>> list(enricher.enrichRows([['0001', '']], fieldnames=['isniIDs', 'nationalities']))
+  [['0001', 'BE']]
+
+  The async variant takes an iterable or an async iterable
+  >>> async def enrichAsync():
+  ...   return [row async for row in enricher.enrichRowsAsync([{'isniIDs': '0001', 'nationalities': ''}])]
+  >>> asyncio.run(enrichAsync())
+  [{'isniIDs': '0001', 'nationalities': 'BE'}]
+  >>> enricher.close()
+  """
+
+  def __init__(self, config, apiName, query, recordSchema, dataFields, identifierColumnName, secondsBetweenAPIRequests=1, batchSize=1, maxInFlight=None, cacheDir=None, cacheTTL=None, cacheMaxSize=None, refresh=False, connectTimeout=10, readTimeout=60, maxRetries=3, maxRememberedIdentifiers=100000, source='api', fallbacks=None, stateFile=None, rowKeyColumnName=None, recheckAfter=30, identifierType=None, negativeCacheTTL=None, adaptiveRate=False, hedgePercentile=None, hedgeBudget=5, recordStoreFile=None, brokerSocket=None):
+    self.config = config if isinstance(config, ConfigParser) else ConfigParser(config)
+
+    rateLimiters = {}
+    if fallbacks:
+      sourceDataFields = getSourceDataFields(self.config, apiName, recordSchema, dataFields)
+      fallbackOptions = getFallbackOptions(self.config, fallbacks, dataFields, rateLimiters, secondsBetweenAPIRequests, maxInFlight, adaptive=adaptiveRate)
+      checkSourcesCoverDataFields(dataFields, [sourceDataFields] + [options['dataFields'] for options in fallbackOptions])
+    else:
+      lib.verifyTask(self.config, apiName, recordSchema, dataFields)
+      sourceDataFields = dataFields
+      fallbackOptions = []
+
+    self.dataFields = dataFields
+    self.identifierColumnName = identifierColumnName
+    self.rowKeyColumnName = rowKeyColumnName
+    self.identifierType = identifierType
+    self.maxRememberedIdentifiers = maxRememberedIdentifiers
+
+    # the options of the requests that all sources share
+    requestOptions = {
+      'cacheDir': cacheDir,
+      'cacheTTL': cacheTTL,
+      'cacheMaxSize': cacheMaxSize,
+      'negativeCacheTTL': negativeCacheTTL,
+      'refresh': refresh,
+      'connectTimeout': connectTimeout,
+      'readTimeout': readTimeout,
+      'maxRetries': maxRetries,
+      'hedgePercentile': hedgePercentile,
+      'hedgeBudget': hedgeBudget,
+      'recordStoreFile': recordStoreFile,
+      'brokerSocket': brokerSocket
+    }
+
+    if source.startswith('file:'):
+      # all records of the dump are kept, the identifiers of later calls are not known yet
+      self.requester = createDumpRequester(self.config, apiName, recordSchema, sourceDataFields, source[len('file:'):], reportFile=None)
+      self.batchSize = 1
+      self.maxInFlight = 1
+    elif source == 'api':
+      if apiName not in rateLimiters:
+        rateLimiters[apiName] = createRateLimiter(self.config, apiName, secondsBetweenAPIRequests, adaptive=adaptiveRate)
+      rateLimiter, maxConcurrency = rateLimiters[apiName]
+      self.batchSize = batchSize
+      self.maxInFlight = maxInFlight if maxInFlight else maxConcurrency
+      self.requester = createRequester(self.config, rateLimiter, apiName, query, recordSchema, sourceDataFields, batchSize=batchSize, maxInFlight=self.maxInFlight, **requestOptions)
+    else:
+      raise Exception(f'Unknown source "{source}", possible values are "api" and "file:PATH"')
+    self.requester['fallbacks'] = createFallbackRequesters(self.config, rateLimiters, fallbackOptions, **requestOptions)
+
+    self.stateStore = None
+    if stateFile:
+      self.stateStore = StateStore(stateFile, getStateTask(apiName, recordSchema, query, dataFields, fallbacks), recheckAfter * 24 * 3600 if recheckAfter is not None else None)
+
+  # ---------------------------------------------------------------------------
+  def enrichRows(self, rows, fieldnames=None, statistics=None):
+    """This function returns an iterator over the enriched rows in input order, rows are read from the given iterable only as far as needed.
+
+    Rows are dicts whose keys are taken from the first row, or lists in the order of the given fieldnames.
+    Dicts are updated and yielded, lists are yielded as new lists.
+    If a dict is given as statistics, the counters of the rows (see lib.createCounters) are stored as "counters"
+    and the number of lookups that reused an earlier request as "reusedLookups".
+    """
+    statistics = statistics if statistics is not None else {}
+    statistics['counters'] = lib.createCounters(self.dataFields)
+    rows = iter(rows)
+
+    # the rows in input order, such that the enriched values can be copied back into the given dicts
+    inputDicts = None
+    if fieldnames is None:
+      firstRow = next(rows, None)
+      if firstRow is None:
+        statistics['reusedLookups'] = 0
+        return
+      fieldnames = list(firstRow.keys())
+      rows = itertools.chain([firstRow], rows)
+      inputDicts = deque()
+
+    plan = EnrichmentPlan(fieldnames, self.dataFields, self.identifierColumnName, self.rowKeyColumnName)
+    requestLog = tqdm(disable=True)
+    enrichedRows = iterateEnrichedRows(plan.readRows(self.readRows(rows, fieldnames, inputDicts)), self.requester, plan, statistics['counters'], requestLog,
+      self.maxInFlight, self.batchSize, self.maxRememberedIdentifiers, statistics=statistics, stateStore=self.stateStore, identifierType=self.identifierType)
+
+    try:
+      for row in enrichedRows:
+        if inputDicts is None:
+          yield row
+        else:
+          inputDict = inputDicts.popleft()
+          for index, name, prefixFunction in plan.datafields:
+            inputDict[fieldnames[index]] = row[index]
+          yield inputDict
+    finally:
+      enrichedRows.close()
+
+  # ---------------------------------------------------------------------------
+  def readRows(self, rows, fieldnames, inputDicts=None):
+    """This function yields each row as a new list of strings, dicts are additionally remembered in the given deque."""
+    for row in rows:
+      if inputDicts is not None:
+        inputDicts.append(row)
+        row = [row.get(name) for name in fieldnames]
+      yield ['' if value is None else str(value) for value in row]
+
+  # ---------------------------------------------------------------------------
+  async def enrichRowsAsync(self, rows, fieldnames=None, statistics=None):
+    """This function is the asynchronous variant of enrichRows, rows can also come from an async iterable.
+
+    The enrichment runs in a separate thread, such that the event loop is not blocked while waiting for requests.
+    """
+    loop = asyncio.get_running_loop()
+    if hasattr(rows, '__aiter__'):
+      rows = iterateAsync(rows, loop)
+
+    enrichedRows = self.enrichRows(rows, fieldnames, statistics)
+    # a single thread advances the iterator, such that it is never used by two threads at the same time
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+      while True:
+        row = await loop.run_in_executor(executor, next, enrichedRows, StopIteration)
+        if row is StopIteration:
+          break
+        yield row
+    finally:
+      # cancel the requests of rows that are not needed anymore if the caller stopped early
+      await loop.run_in_executor(executor, enrichedRows.close)
+      executor.shutdown()
+
+  # ---------------------------------------------------------------------------
+  def getRequestStatistics(self):
+    """This function returns how many requests were retried or hedged and how many responses came from the cache over all calls so far."""
+    statistics = getRequestStatistics(self.requester, 0)
+    del statistics['reusedLookups']
+    return statistics
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    closeRequester(self.requester)
+    if self.stateStore:
+      self.stateStore.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+# -----------------------------------------------------------------------------
+def iterateAsync(asyncRows, loop):
+  """This function yields the items of an async iterable in another thread than the one running the given event loop."""
+  iterator = asyncRows.__aiter__()
+  while True:
+    try:
+      yield asyncio.run_coroutine_threadsafe(iterator.__anext__(), loop).result()
+    except StopAsyncIteration:
+      return
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
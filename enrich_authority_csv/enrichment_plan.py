@@ -0,0 +1,233 @@
+import csv
+import operator
+from collections import deque
+import enrich_authority_csv.lib as lib
+
+class EnrichmentPlan:
+  """An instance of this class resolves the columns and datafields of an enrichment once, such that each row only needs index lookups.
+
+  Rows are lists of values in the order of the header, as read by csv.reader.
+
+  >>> plan = EnrichmentPlan(['localID', 'isniIDs', 'ntaIDs', 'nationalities'], {'ntaIDs': 'NTA', 'nationalities': 'nationality'}, 'isniIDs')
+  >>> row = ['1', '0001;0002', '', 'BE']
+  >>> plan.needsEnrichment(row), plan.getLookupIdentifiers(row)
+  (True, ['0001', '0002'])
+
+  >>> counters = lib.createCounters({'ntaIDs': 'NTA', 'nationalities': 'nationality'})
+  >>> plan.countRow(counters, row)
+  >>> counters['numberISNIs'], counters['NTA']['numberRowsToBeEnrichedHaveISNI'], counters['nationality']['numberMissingIdentifierRows']
+  (2, 1, 0)
+
+  Only missing datafields are filled, NTA identifiers get their prefix
+  >>> plan.enrichRow(row, ['0001', '0002'], {'0002': {'NTA': '123', 'nationality': 'NL'}}, counters)
+  >>> row
+  ['1', '0001;0002', 'p123', 'BE']
+  >>> plan.getProgressDescription(counters)
+  'found NTA 1,nationality 0'
+
+  The columns have to be part of the header
+  >>> EnrichmentPlan(['localID', 'isniIDs'], {'ntaIDs': 'NTA'}, 'isniIDs')
+  Traceback (most recent call last):
+      ...
+  Exception: The following requested column is not in the input: {'ntaIDs'}
+  """
+
+  def __init__(self, fieldnames, dataFields, identifierColumnName, rowKeyColumnName=None):
+    rowKeyColumnName = rowKeyColumnName if rowKeyColumnName else identifierColumnName
+    lib.checkIfColumnsExist(fieldnames, [identifierColumnName, rowKeyColumnName] + list(dataFields.keys()))
+    self.fieldnames = list(fieldnames)
+    self.numberColumns = len(self.fieldnames)
+    self.identifierIndex = self.fieldnames.index(identifierColumnName)
+    # the column that identifies a row across runs, by default the lookup identifiers themselves
+    self.rowKeyIndex = self.fieldnames.index(rowKeyColumnName)
+
+    # column index, datafield name and the function that adds the prefix of found values (or None) per datafield
+    self.datafields = tuple([(self.fieldnames.index(column), name, lib.getPrefixFunction(name)) for column, name in dataFields.items()])
+    self.datafieldNames = tuple([name for index, name, prefixFunction in self.datafields])
+
+    self.getNeededValues = createGetter([self.identifierIndex] + [index for index, name, prefixFunction in self.datafields])
+    self.getDatafieldValues = createGetter([index for index, name, prefixFunction in self.datafields])
+
+  # ---------------------------------------------------------------------------
+  def readRows(self, inputReader):
+    """This function yields the rows of a csv.reader like csv.DictReader would: empty lines are skipped and missing values at the end are empty.
+
+    >>> plan = EnrichmentPlan(['isniIDs', 'ntaIDs'], {'ntaIDs': 'NTA'}, 'isniIDs')
+    >>> list(plan.readRows([['0001', ''], [], ['0002']]))
+    [['0001', ''], ['0002', '']]
+    """
+    numberColumns = self.numberColumns
+    for row in inputReader:
+      if len(row) < numberColumns:
+        if not row:
+          continue
+        row += [''] * (numberColumns - len(row))
+      yield row
+
+  # ---------------------------------------------------------------------------
+  def readRowsWithText(self, rowsWithText, rowTexts):
+    """This function yields the rows of lib.iterateCSVRows like readRows, the original text and datafield values of each row are appended to the rowTexts deque.
+
+    Rows that are filled up with empty values get no original text, they are written anew.
+
+    >>> plan = EnrichmentPlan(['isniIDs', 'ntaIDs'], {'ntaIDs': 'NTA'}, 'isniIDs')
+    >>> rowTexts = deque()
+    >>> list(plan.readRowsWithText([(['0001', ''], '0001,\\n'), ([], '\\n'), (['0002'], '0002\\n')], rowTexts))
+    [['0001', ''], ['0002', '']]
+    >>> list(rowTexts)
+    [('0001,\\n', ('',)), (None, ('',))]
+    """
+    numberColumns = self.numberColumns
+    getDatafieldValues = self.getDatafieldValues
+    for row, text in rowsWithText:
+      if len(row) < numberColumns:
+        if not row:
+          continue
+        row += [''] * (numberColumns - len(row))
+        text = None
+      rowTexts.append((text, getDatafieldValues(row)))
+      yield row
+
+  # ---------------------------------------------------------------------------
+  def needsEnrichment(self, row):
+    """This function returns True if the lookup identifier or at least one of the datafields of the row is empty."""
+    return '' in self.getNeededValues(row)
+
+  # ---------------------------------------------------------------------------
+  def getLookupIdentifiers(self, row):
+    """This function returns the list of lookup identifiers of the row or None if it has none."""
+    identifierValue = row[self.identifierIndex]
+    return identifierValue.split(';') if identifierValue != '' else None
+
+  # ---------------------------------------------------------------------------
+  def getRowKey(self, row):
+    return row[self.rowKeyIndex]
+
+  # ---------------------------------------------------------------------------
+  def countRow(self, counters, row):
+    """This function updates the counters with the statistics of a single row, like lib.countRow."""
+    identifierValue = row[self.identifierIndex]
+    numberIdentifiers = identifierValue.count(';') + 1 if identifierValue != '' else 0
+    datafieldValues = self.getDatafieldValues(row)
+
+    counters['numberRows'] += 1
+    counters['numberISNIs'] += numberIdentifiers
+    if '' in datafieldValues:
+      counters['numberRowsMissingAtLeastOneIdentifier'] += 1
+    if identifierValue != '':
+      counters['numberRowsHaveISNI'] += 1
+
+    possibleEnrichmentNotCountedYet = True
+    for value, name in zip(datafieldValues, self.datafieldNames):
+      datafieldCounters = counters[name]
+      datafieldCounters['numberISNIs'] += numberIdentifiers
+      if value == '':
+        datafieldCounters['numberMissingIdentifierRows'] += 1
+        if identifierValue == '':
+          datafieldCounters['numberRowsThatCannotBeEnriched'] += 1
+        else:
+          datafieldCounters['numberRowsToBeEnrichedHaveISNI'] += 1
+          if possibleEnrichmentNotCountedYet:
+            counters['numberRowsMissingAndPossibleToBeEnriched'] += 1
+            possibleEnrichmentNotCountedYet = False
+
+  # ---------------------------------------------------------------------------
+  def enrichRow(self, row, lookupIdentifierList, valuesPerIdentifier, counters):
+    """This function fills the missing datafields of the row based on the datafield values found per (normalized) lookup identifier."""
+
+    foundIdentifiers = {}
+    rowAlreadyProcessed = False
+    for lookupIdentifier in lookupIdentifierList:
+
+      foundValues = valuesPerIdentifier.get(lib.normalizeLookupIdentifier(lookupIdentifier))
+      if not foundValues:
+        continue
+
+      # Only enrich it when the currently looked for identifier is missing
+      for index, name, prefixFunction in self.datafields:
+        if row[index] == '':
+          # values of fallback sources only contain the datafields of that source
+          foundIdentifier = foundValues.get(name)
+          if foundIdentifier:
+            if not rowAlreadyProcessed:
+              counters[name]['numberFoundISNIRows'] += 1
+              rowAlreadyProcessed = True
+
+            foundIdentifiers.setdefault(index, set()).add(prefixFunction(foundIdentifier) if prefixFunction else foundIdentifier)
+            counters[name]['numberFoundISNIs'] += 1
+
+    # we can only add something if we found something
+    for index, values in foundIdentifiers.items():
+      row[index] = ';'.join(values)
+
+  # ---------------------------------------------------------------------------
+  def getMissingDatafields(self, row, normalizedIdentifiers, valuesPerIdentifier, datafieldNames):
+    """This function returns the given datafields that are empty in the row and were not found for any of the normalized lookup identifiers.
+
+    >>> plan = EnrichmentPlan(['isniIDs', 'nationalities', 'languages'], {'nationalities': 'nationality', 'languages': 'language'}, 'isniIDs')
+    >>> plan.getMissingDatafields(['0001', '', 'fre'], ['0001'], {'0001': {'nationality': 'BE'}}, ['nationality', 'language'])
+    set()
+    >>> plan.getMissingDatafields(['0001', '', ''], ['0001'], {'0001': {'nationality': 'BE'}}, ['nationality', 'language'])
+    {'language'}
+    """
+    missingDatafields = set()
+    for index, name, prefixFunction in self.datafields:
+      if row[index] == '' and name in datafieldNames:
+        if not any([valuesPerIdentifier.get(identifier, {}).get(name) for identifier in normalizedIdentifiers]):
+          missingDatafields.add(name)
+    return missingDatafields
+
+  # ---------------------------------------------------------------------------
+  def getProgressDescription(self, counters):
+    """This function returns the description of the progress bar with the number of rows found so far per datafield."""
+    return 'found ' + ','.join([f'{name} {counters[name]["numberFoundISNIRows"]}' for name in self.datafieldNames])
+
+# -----------------------------------------------------------------------------
+class PassthroughWriter:
+  """An instance of this class writes rows like csv.writer, but rows whose datafields were not changed are written with their original text.
+
+  The original texts are taken in input order from the rowTexts deque filled by EnrichmentPlan.readRowsWithText,
+  such that untouched rows keep their quoting and line endings without being serialized again.
+
+  >>> import io
+  >>> plan = EnrichmentPlan(['isniIDs', 'nationalities'], {'nationalities': 'nationality'}, 'isniIDs')
+  >>> rowTexts = deque()
+  >>> rows = list(plan.readRowsWithText(lib.iterateCSVRows(io.StringIO('"0001",\\n"0002",""\\n')), rowTexts))
+  >>> rows[1][1] = 'BE'
+  >>> outFile = io.StringIO()
+  >>> writer = PassthroughWriter(outFile, plan, rowTexts, lineterminator='\\n')
+  >>> for row in rows: writer.writerow(row)
+  >>> outFile.getvalue()
+  '"0001",\\n0002,BE\\n'
+  """
+
+  def __init__(self, outFile, plan, rowTexts, lineterminator='\r\n'):
+    self.outFile = outFile
+    self.outputWriter = csv.writer(outFile, lineterminator=lineterminator)
+    self.getDatafieldValues = plan.getDatafieldValues
+    self.rowTexts = rowTexts
+
+  # ---------------------------------------------------------------------------
+  def writerow(self, row):
+    text, datafieldValues = self.rowTexts.popleft()
+    if text is not None and self.getDatafieldValues(row) == datafieldValues:
+      self.outFile.write(text)
+    else:
+      self.outputWriter.writerow(row)
+
+# -----------------------------------------------------------------------------
+def createGetter(indices):
+  """This function returns a function that returns the values at the given indices of a row as tuple, also for a single index.
+
+  >>> createGetter([1])(['a', 'b']), createGetter([1, 0])(['a', 'b'])
+  (('b',), ('b', 'a'))
+  """
+  getter = operator.itemgetter(*indices)
+  if len(indices) == 1:
+    return lambda row: (getter(row),)
+  return getter
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
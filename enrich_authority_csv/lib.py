@@ -1,11 +1,31 @@
+import io
+import csv
+import os
+import json
+import re
+import sys
+import bz2
+import gzip
+import lzma
+import functools
 import urllib
 import requests
 import xml.etree.ElementTree as ET
+from enrich_authority_csv.metrics import stageMetrics
 
 NS_SRW = 'http://www.loc.gov/zing/srw/'
 NS_MARC_EXCHANGE = 'info:lc/xmlns/marcxchange-v2'
 ALL_NS = {'srw': NS_SRW, 'mxc': NS_MARC_EXCHANGE}
 
+TAG_SRW_RECORDS = f'{{{NS_SRW}}}records'
+TAG_SRW_RECORD = f'{{{NS_SRW}}}record'
+TAG_SRW_RECORD_DATA = f'{{{NS_SRW}}}recordData'
+TAG_SRW_NEXT_RECORD_POSITION = f'{{{NS_SRW}}}nextRecordPosition'
+
+COMPRESSION_MAGIC_BYTES = {b'\x1f\x8b': gzip, b'BZh': bz2, b'\xfd7zXZ\x00': lzma}
+COMPRESSION_EXTENSIONS = {'.gz': gzip, '.bz2': bz2, '.xz': lzma}
+COLUMNAR_EXTENSIONS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
 
 # -----------------------------------------------------------------------------
 def getBnFIdentifierWithControlCharacter(identifier):
@@ -189,19 +209,12 @@ def countISNIs(isniString, delimiter=';', validateISNI=False):
 
 
 # -----------------------------------------------------------------------------
-def initializeCounters(countReader, identifiers, isniColumnName, nationalityColumnName=None):
-  """This function counts statistics from the given arra of dicts (or DictReader).
+def createCounters(identifiers):
+  """This function returns counters with initial values for the given identifiers, they can be updated row by row with countRow.
 
-  >>> rows = [{'kbrIDs':'', 'isniIDs':'001','ntaIDs':''},
-  ... {'kbrIDs':'123', 'isniIDs':'', 'ntaIDs':''},
-  ... {'kbrIDs':'', 'ntaIDs':'', 'isniIDs':''},
-  ... {'kbrIDs':'','ntaIDs':'','isniIDs':'002;003'},
-  ... {'kbrIDs':'123','ntaIDs':'456','isniIDs':'002;003'}]
-  >>> initializeCounters(rows, {'kbrIDs':'KBR', 'ntaIDs':'NTA'}, 'isniIDs')
-  {'numberRows': 5, 'numberRowsHaveISNI': 3, 'numberISNIs': 5, 'numberRowsMissingAtLeastOneIdentifier': 4, 'numberRowsMissingAndPossibleToBeEnriched': 2, 'KBR': {'numberMissingIdentifierRows': 3, 'numberISNIs': 5, 'numberRowsToBeEnrichedHaveISNI': 2, 'numberRowsThatCannotBeEnriched': 1, 'numberFoundISNIRows': 0, 'numberFoundISNIs': 0}, 'NTA': {'numberMissingIdentifierRows': 4, 'numberISNIs': 5, 'numberRowsToBeEnrichedHaveISNI': 2, 'numberRowsThatCannotBeEnriched': 2, 'numberFoundISNIRows': 0, 'numberFoundISNIs': 0}}
+  >>> createCounters({'kbrIDs': 'KBR'})['KBR']['numberFoundISNIRows']
+  0
   """
-
-  # initialize counters
   counters = {'numberRows': 0, 'numberRowsHaveISNI': 0, 'numberISNIs': 0, 'numberRowsMissingAtLeastOneIdentifier': 0, 'numberRowsMissingAndPossibleToBeEnriched': 0}
   for column, isniSourceName in identifiers.items():
     counters[isniSourceName] = {
@@ -212,40 +225,188 @@ def initializeCounters(countReader, identifiers, isniColumnName, nationalityColu
       'numberFoundISNIRows': 0,
       'numberFoundISNIs': 0
     }
-  
+  return counters
 
-  identifierColumns = identifiers.keys()
-  for row in countReader:
+# -----------------------------------------------------------------------------
+def mergeCounters(counters, otherCounters):
+  """This function adds the values of otherCounters to counters, for example to combine the statistics of several shards.
+
+  >>> counters = createCounters({'kbrIDs': 'KBR'})
+  >>> otherCounters = createCounters({'kbrIDs': 'KBR'})
+  >>> counters['numberRows'], otherCounters['numberRows'], otherCounters['KBR']['numberFoundISNIRows'] = 2, 3, 1
+  >>> otherCounters['numberFailedRows'] = 1
+  >>> mergeCounters(counters, otherCounters)
+  >>> counters['numberRows'], counters['KBR']['numberFoundISNIRows'], counters['numberFailedRows']
+  (5, 1, 1)
+  """
+  for name, value in otherCounters.items():
+    if isinstance(value, dict):
+      mergeCounters(counters.setdefault(name, {}), value)
+    else:
+      counters[name] = counters.get(name, 0) + value
 
-    # do some general counting for the row
-    counters['numberRows'] += 1
-    counters['numberISNIs'] += countISNIs(row[isniColumnName])
-    if atLeastOneIdentifierMissing(row, identifierColumns):
-      counters['numberRowsMissingAtLeastOneIdentifier'] += 1
+# -----------------------------------------------------------------------------
+def countRow(counters, row, identifiers, isniColumnName):
+  """This function updates the given counters with the statistics of a single row, such that statistics can be computed while streaming over the input.
 
-    if row[isniColumnName] != '':
-        counters['numberRowsHaveISNI'] += 1
+  >>> counters = createCounters({'kbrIDs': 'KBR'})
+  >>> countRow(counters, {'kbrIDs': '', 'isniIDs': '001;002'}, {'kbrIDs': 'KBR'}, 'isniIDs')
+  >>> counters['numberISNIs'], counters['numberRowsMissingAndPossibleToBeEnriched'], counters['KBR']['numberRowsToBeEnrichedHaveISNI']
+  (2, 1, 1)
+  """
 
-    posssibleEnrichmentTotalRowsNotCountedYet = True
+  # do some general counting for the row
+  counters['numberRows'] += 1
+  counters['numberISNIs'] += countISNIs(row[isniColumnName])
+  if atLeastOneIdentifierMissing(row, identifiers.keys()):
+    counters['numberRowsMissingAtLeastOneIdentifier'] += 1
 
-    # count for the specific identifiers we want to add via ISNI
-    for columnName, isniSourceName in identifiers.items():
+  if row[isniColumnName] != '':
+      counters['numberRowsHaveISNI'] += 1
 
-      counters[isniSourceName]['numberISNIs'] += countISNIs(row[isniColumnName])
-      # the identifier column is empty, a possible candidate to be enriched
-      if row[columnName] == '':
-        counters[isniSourceName]['numberMissingIdentifierRows'] += 1
+  posssibleEnrichmentTotalRowsNotCountedYet = True
 
-        # If there is also an ISNI there is the chance that we can enrich it
-        if row[isniColumnName] == '':
-          counters[isniSourceName]['numberRowsThatCannotBeEnriched'] += 1
-        else:
-          counters[isniSourceName]['numberRowsToBeEnrichedHaveISNI'] += 1
-          if posssibleEnrichmentTotalRowsNotCountedYet:
-            counters['numberRowsMissingAndPossibleToBeEnriched'] += 1
-            posssibleEnrichmentTotalRowsNotCountedYet = False
+  # count for the specific identifiers we want to add via ISNI
+  for columnName, isniSourceName in identifiers.items():
 
-  return counters
+    counters[isniSourceName]['numberISNIs'] += countISNIs(row[isniColumnName])
+    # the identifier column is empty, a possible candidate to be enriched
+    if row[columnName] == '':
+      counters[isniSourceName]['numberMissingIdentifierRows'] += 1
+
+      # If there is also an ISNI there is the chance that we can enrich it
+      if row[isniColumnName] == '':
+        counters[isniSourceName]['numberRowsThatCannotBeEnriched'] += 1
+      else:
+        counters[isniSourceName]['numberRowsToBeEnrichedHaveISNI'] += 1
+        if posssibleEnrichmentTotalRowsNotCountedYet:
+          counters['numberRowsMissingAndPossibleToBeEnriched'] += 1
+          posssibleEnrichmentTotalRowsNotCountedYet = False
+
+# -----------------------------------------------------------------------------
+def openInputFile(filename, binary=False):
+  """This function opens the given CSV file for reading, "-" stands for stdin and gzip, bz2 or xz compressed input is detected automatically.
+
+  With binary=True the decompressed bytes are read instead of text, for example to parse an XML file.
+
+  >>> import tempfile
+  >>> filename = os.path.join(tempfile.mkdtemp(), 'input.csv.gz')
+  >>> with openOutputFile(filename) as outFile: outFile.write('a,b\\r\\n1,2\\r\\n')
+  10
+  >>> with openInputFile(filename) as inFile: inFile.read()
+  'a,b\\r\\n1,2\\r\\n'
+  """
+  if filename == '-':
+    binaryFile = open(sys.stdin.fileno(), 'rb', closefd=False)
+  else:
+    binaryFile = open(filename, 'rb')
+
+  magic = binaryFile.peek(len(max(COMPRESSION_MAGIC_BYTES.keys(), key=len)))
+  for magicBytes, compression in COMPRESSION_MAGIC_BYTES.items():
+    if magic.startswith(magicBytes):
+      if filename == '-':
+        return compression.open(binaryFile, 'rb') if binary else compression.open(binaryFile, 'rt', newline='')
+      else:
+        binaryFile.close()
+        return compression.open(filename, 'rb') if binary else compression.open(filename, 'rt', newline='')
+
+  return binaryFile if binary else io.TextIOWrapper(binaryFile, newline='')
+
+# -----------------------------------------------------------------------------
+def openOutputFile(filename, mode='w', binary=False):
+  """This function opens the given CSV file for writing (or appending with mode "a"), "-" stands for stdout and the file is compressed based on a .gz, .bz2 or .xz extension.
+
+  With binary=True bytes are written instead of text.
+  """
+  if filename == '-':
+    return open(sys.stdout.fileno(), f'{mode}b' if binary else mode, newline=None if binary else '', closefd=False)
+
+  for extension, compression in COMPRESSION_EXTENSIONS.items():
+    if filename.endswith(extension):
+      return compression.open(filename, f'{mode}b') if binary else compression.open(filename, f'{mode}t', newline='')
+
+  return open(filename, f'{mode}b') if binary else open(filename, mode, newline='')
+
+# -----------------------------------------------------------------------------
+def isResumableOutput(filename):
+  """This function returns True if an interrupted run can continue writing the given output file, i.e. it is an uncompressed CSV file and not stdout.
+
+  >>> isResumableOutput('enriched.csv')
+  True
+  >>> isResumableOutput('enriched.csv.gz'), isResumableOutput('enriched.parquet')
+  (False, False)
+  >>> isResumableOutput('-')
+  False
+  """
+  return filename != '-' and not any([filename.endswith(extension) for extension in list(COMPRESSION_EXTENSIONS.keys()) + list(COLUMNAR_EXTENSIONS.keys())])
+
+# -----------------------------------------------------------------------------
+def iterateCSVRows(lines, delimiter=','):
+  """This function yields each row of a CSV file opened with newline='' as list of values together with its original text, including the line ending.
+
+  Lines without quotes are split directly, only rows with quotes (which can span several lines) are parsed by csv.reader.
+
+  >>> list(iterateCSVRows(io.StringIO('a,b\\r\\n"1\\r\\n2",""\\n\\r\\nc,')))
+  [(['a', 'b'], 'a,b\\r\\n'), (['1\\r\\n2', ''], '"1\\r\\n2",""\\n'), ([], '\\r\\n'), (['c', ''], 'c,')]
+  """
+  lines = iter(lines)
+  for line in lines:
+    if '"' in line:
+      rowLines = [line]
+      # csv.reader reads only as many lines as the row needs, those are the original text of the row
+      row = next(csv.reader(recordLines(line, lines, rowLines), delimiter=delimiter))
+      yield row, ''.join(rowLines)
+    else:
+      values = line.rstrip('\r\n')
+      yield (values.split(delimiter) if values else []), line
+
+# -----------------------------------------------------------------------------
+def recordLines(firstLine, lines, rowLines):
+  """This function yields the first line and then the next lines, the latter are also appended to rowLines."""
+  yield firstLine
+  for line in lines:
+    rowLines.append(line)
+    yield line
+
+# -----------------------------------------------------------------------------
+def getLineTerminator(text):
+  """This function returns the line ending of the given text, "\\r\\n" if it has none.
+
+  >>> getLineTerminator('a,b\\n'), getLineTerminator('a,b\\r\\n'), getLineTerminator('a,b')
+  ('\\n', '\\r\\n', '\\r\\n')
+  """
+  if text.endswith('\n') and not text.endswith('\r\n'):
+    return '\n'
+  return '\r\n'
+
+# -----------------------------------------------------------------------------
+def writeCheckpoint(filename, state):
+  """This function writes the given state as JSON, the file is replaced atomically such that an interruption never leaves a half written checkpoint.
+
+  >>> import tempfile
+  >>> filename = os.path.join(tempfile.mkdtemp(), 'enriched.csv.checkpoint')
+  >>> writeCheckpoint(filename, {'inputRows': 10})
+  >>> readCheckpoint(filename)
+  {'inputRows': 10}
+  """
+  tmpFilename = f'{filename}.tmp'
+  with open(tmpFilename, 'w') as checkpointFile:
+    json.dump(state, checkpointFile)
+  os.replace(tmpFilename, filename)
+
+# -----------------------------------------------------------------------------
+def readCheckpoint(filename):
+  """This function reads a checkpoint written by writeCheckpoint.
+
+  >>> readCheckpoint('non-existing.checkpoint')
+  Traceback (most recent call last):
+      ...
+  Exception: Cannot resume, the checkpoint file "non-existing.checkpoint" does not exist
+  """
+  if not os.path.isfile(filename):
+    raise Exception(f'Cannot resume, the checkpoint file "{filename}" does not exist')
+  with open(filename, 'r') as checkpointFile:
+    return json.load(checkpointFile)
 
 # -----------------------------------------------------------------------------
 def getPrefixedIdentifier(identifier, identifierName):
@@ -256,42 +417,544 @@ def getPrefixedIdentifier(identifier, identifierName):
   else:
     return identifier
 
+# -----------------------------------------------------------------------------
+def getPrefixFunction(identifierName):
+  """This function returns a function that prefixes identifiers of the given name like getPrefixedIdentifier, or None if they are used as they are.
+
+  >>> getPrefixFunction('NTA')('123')
+  'p123'
+  >>> getPrefixFunction('BNF')('cb11896963')
+  'cb11896963c'
+  >>> getPrefixFunction('KBR') is None
+  True
+  """
+  if identifierName == 'NTA':
+    return lambda identifier: f'p{identifier}'
+  elif identifierName == 'BNF':
+    # the same BnF identifiers are found for many rows, their control character is computed only once
+    return functools.lru_cache(maxsize=100000)(getBnFIdentifierWithControlCharacter)
+  else:
+    return None
+
+
+
+# -----------------------------------------------------------------------------
+def compilePath(path):
+  """This function replaces the namespace prefixes of the path with the full namespace, such that the path can be evaluated without namespace lookups.
+
+  >>> compilePath("mxc:datafield[@tag='102']/mxc:subfield[@code='a']")
+  "{info:lc/xmlns/marcxchange-v2}datafield[@tag='102']/{info:lc/xmlns/marcxchange-v2}subfield[@code='a']"
+  >>> compilePath('srw:recordData/responseRecord')
+  '{http://www.loc.gov/zing/srw/}recordData/responseRecord'
+  """
+  return re.sub(r'\b([A-Za-z_][\w.-]*):([A-Za-z_][\w.-]*)', lambda match: f'{{{ALL_NS[match.group(1)]}}}{match.group(2)}' if match.group(1) in ALL_NS else match.group(0), path)
+
+# -----------------------------------------------------------------------------
+def compileDatafieldDefinitions(datafieldDefinitions, datafieldNames):
+  """This function returns the definitions of the given datafields with compiled paths relative to a single srw:record, such that they can be evaluated for each record without further lookups.
+
+  >>> definitions = {'KBR': {'type': 'identifier', 'path': 'srw:records/srw:record/srw:recordData/sources', 'identifierCodeSubpath': 'codeOfSource', 'identifierNameSubpath': 'sourceIdentifier'}}
+  >>> compileDatafieldDefinitions(definitions, ['KBR'])['KBR']['path']
+  '{http://www.loc.gov/zing/srw/}recordData/sources'
+
+  Unknown datafield types are reported before any request is sent
+  >>> compileDatafieldDefinitions({'KBR': {'type': 'unknown', 'path': 'srw:records/srw:record/x'}}, ['KBR'])
+  Traceback (most recent call last):
+      ...
+  Exception: undefined datafield type "unknown" for datafield "KBR"
+  """
+  compiledDefinitions = {}
+  for datafieldName in datafieldNames:
+    definition = dict(datafieldDefinitions[datafieldName])
+    if definition['type'] not in ['element', 'identifier']:
+      raise Exception(f'undefined datafield type "{definition["type"]}" for datafield "{datafieldName}"')
+
+    definition['path'] = compilePath(getRecordRelativePath(definition['path']))
+    for subpath in ['identifierCodeSubpath', 'identifierNameSubpath']:
+      if subpath in definition:
+        definition[subpath] = compilePath(definition[subpath])
+    compiledDefinitions[datafieldName] = definition
+
+  return compiledDefinitions
+
+# -----------------------------------------------------------------------------
+def extractDatafields(records, compiledDefinitions, delimiter=';'):
+  """This function evaluates all given datafield definitions on the already parsed srw:record elements and returns the found value (or None) per datafield.
+
+  Datafields with the same path, for example identifiers of different sources, are extracted in a single pass over the records.
+  >>> xml = f'''<srw:record xmlns:srw="{NS_SRW}"><srw:recordData>
+  ... <nationality>NL</nationality><nationality>BE</nationality>
+  ... <sources><codeOfSource>BNF</codeOfSource><sourceIdentifier>123</sourceIdentifier></sources>
+  ... <sources><codeOfSource>KBR</codeOfSource><sourceIdentifier>456</sourceIdentifier></sources>
+  ... </srw:recordData></srw:record>'''
+  >>> definitions = {
+  ...   'nationality': {'type': 'element', 'path': 'srw:records/srw:record/srw:recordData/nationality'},
+  ...   'KBR': {'type': 'identifier', 'path': 'srw:records/srw:record/srw:recordData/sources', 'identifierCodeSubpath': 'codeOfSource', 'identifierNameSubpath': 'sourceIdentifier'},
+  ...   'NTA': {'type': 'identifier', 'path': 'srw:records/srw:record/srw:recordData/sources', 'identifierCodeSubpath': 'codeOfSource', 'identifierNameSubpath': 'sourceIdentifier'}}
+  >>> extractDatafields([ET.fromstring(xml)], compileDatafieldDefinitions(definitions, definitions.keys()))
+  {'nationality': 'BE;NL', 'KBR': '456', 'NTA': None}
+  """
+
+  collectedValues = {}
+  for record in records:
+    collectDatafieldValues(record, compiledDefinitions, collectedValues)
+  return getDatafieldValues(collectedValues, compiledDefinitions, delimiter)
 
+# -----------------------------------------------------------------------------
+def collectDatafieldValues(record, compiledDefinitions, collectedValues):
+  """This function adds the values of the given datafields found in a single srw:record to collectedValues, such that the record is not needed anymore afterwards.
 
+  Datafields with the same path, for example identifiers of different sources, are collected in a single pass over the record.
+  """
+  collectedKeys = set()
+  for datafieldName, definition in compiledDefinitions.items():
+    path = definition['path']
+
+    if definition['type'] == 'element':
+      key = ('element', path)
+      if key not in collectedKeys:
+        foundData = collectedValues.setdefault(key, set())
+        for elem in record.iterfind(path):
+          if elem.text:
+            foundData.add(elem.text)
+
+    else:
+      key = ('identifier', path, definition['identifierCodeSubpath'], definition['identifierNameSubpath'])
+      if key not in collectedKeys:
+        # only the first identifier of each source is taken
+        identifiersPerSource = collectedValues.setdefault(key, {})
+        for elem in record.iterfind(path):
+          sourceName = getElementValue(elem.find(definition['identifierCodeSubpath']))
+          identifiersPerSource.setdefault(sourceName, getElementValue(elem.find(definition['identifierNameSubpath'])))
+
+    collectedKeys.add(key)
 
 # -----------------------------------------------------------------------------
-def extractIdentifier(xmlContent, datafieldName, datafieldDefinition, delimiter=';'):
-  """This function tries to extract the identifier with the given name. If not found it returns None."""
+def getDatafieldValues(collectedValues, compiledDefinitions, delimiter=';'):
+  """This function returns the found value (or None) per datafield from the values collected with collectDatafieldValues."""
+  foundValues = {}
+  for datafieldName, definition in compiledDefinitions.items():
+    if definition['type'] == 'element':
+      foundValues[datafieldName] = delimiter.join(sorted(collectedValues.get(('element', definition['path']), set())))
+    else:
+      key = ('identifier', definition['path'], definition['identifierCodeSubpath'], definition['identifierNameSubpath'])
+      foundValues[datafieldName] = collectedValues.get(key, {}).get(datafieldName)
+  return foundValues
 
-  root = ET.fromstring(xmlContent)
+# -----------------------------------------------------------------------------
+def normalizeRecord(record):
+  """This function returns an srw:record element in a compact form that can be stored as JSON: nested lists [tag, attributes, text, children...].
 
-  foundData = set()
-  datafieldType = datafieldDefinition['type']
-  if datafieldType == 'element':
-    for record in root.findall(datafieldDefinition['path'], ALL_NS):
-      foundData.add(record.text)
-    return delimiter.join(sorted(foundData))
+  Whitespace in between child elements and elements without text, attributes and children are left out,
+  everything else (for example all sources of an ISNI record and all MARC datafields with their subfields) is kept, such that any path can be evaluated later.
 
-  elif datafieldType == 'identifier':
-    for record in root.findall(datafieldDefinition['path'], ALL_NS):
-      sourceName = getElementValue(record.find(datafieldDefinition['identifierCodeSubpath']))
-      identifier = getElementValue(record.find(datafieldDefinition['identifierNameSubpath']))
+  >>> normalizeRecord(ET.fromstring('<r>\\n  <d tag="102"><s code="a">BE</s></d>\\n  <empty/>\\n</r>'))
+  ['r', {}, None, ['d', {'tag': '102'}, None, ['s', {'code': 'a'}, 'BE']]]
+  """
+  return normalizeElement(record) or [record.tag, {}, None]
 
-      if datafieldName == sourceName:
-        return identifier
+# -----------------------------------------------------------------------------
+def normalizeElement(elem):
+  children = [child for child in map(normalizeElement, elem) if child is not None]
+  # the text of an element with children is only kept if it is more than the indentation of its children
+  text = elem.text if elem.text and not (len(elem) and elem.text.isspace()) else None
+  if text is None and not elem.attrib and not children:
+    return None
+  return [elem.tag, dict(elem.attrib), text] + children
+
+# -----------------------------------------------------------------------------
+def buildRecord(normalizedRecord):
+  """This function returns the element of a record normalized with normalizeRecord, such that compiled datafield definitions can be evaluated on it.
+
+  >>> xml = f'<srw:record xmlns:srw="{NS_SRW}"><srw:recordData><d tag="102"><s code="a">BE</s></d></srw:recordData></srw:record>'
+  >>> record = buildRecord(normalizeRecord(ET.fromstring(xml)))
+  >>> record.find(compilePath("srw:recordData/d[@tag='102']/s[@code='a']")).text
+  'BE'
+  """
+  tag, attributes, text = normalizedRecord[:3]
+  elem = ET.Element(tag, attributes)
+  elem.text = text
+  elem.extend([buildRecord(child) for child in normalizedRecord[3:]])
+  return elem
+
+# -----------------------------------------------------------------------------
+def getRecordRelativePath(path):
+  """This function returns the given response path relative to a single srw:record element.
+
+  >>> getRecordRelativePath('srw:records/srw:record/srw:recordData/mxc:record')
+  'srw:recordData/mxc:record'
+
+  Paths that do not start at the response root cannot be evaluated per record
+  >>> getRecordRelativePath('mxc:record/mxc:datafield')
+  Traceback (most recent call last):
+      ...
+  Exception: Path "mxc:record/mxc:datafield" does not start with "srw:records/srw:record/"
+  """
+  prefix = 'srw:records/srw:record/'
+  if not path.startswith(prefix):
+    raise Exception(f'Path "{path}" does not start with "{prefix}"')
+  return path[len(prefix):]
+
+# -----------------------------------------------------------------------------
+def iterateRecords(xmlContent, responseInfo=None, chunkSize=65536):
+  """This function parses the given SRU response incrementally and yields each srw:record element as soon as it is completely parsed.
+
+  A record is removed from the parsed tree as soon as the caller continues with the next one,
+  such that only a single record is kept in memory no matter how many records the response contains.
+  If a dict is given as responseInfo, the position of the next page is stored as "nextRecordPosition" (None if there is no next page).
+
+  >>> xml = f'''<srw:searchRetrieveResponse xmlns:srw="{NS_SRW}"><srw:records>
+  ... <srw:record><id>1</id></srw:record><srw:record><id>2</id></srw:record>
+  ... </srw:records><srw:nextRecordPosition>3</srw:nextRecordPosition></srw:searchRetrieveResponse>'''
+  >>> responseInfo = {}
+  >>> [record.find('id').text for record in iterateRecords(xml.encode('utf-8'), responseInfo, chunkSize=10)]
+  ['1', '2']
+  >>> responseInfo
+  {'nextRecordPosition': 3}
+  """
+  if responseInfo is not None:
+    responseInfo['nextRecordPosition'] = None
+
+  parser = ET.XMLPullParser(events=('start', 'end'))
+  parents = []
+  content = memoryview(xmlContent)
+  for chunkStart in range(0, len(content) + 1, chunkSize):
+    if chunkStart < len(content):
+      parser.feed(content[chunkStart:chunkStart+chunkSize])
+    else:
+      parser.close()
+
+    for event, elem in parser.read_events():
+      if event == 'start':
+        parents.append(elem)
+        continue
+
+      parents.pop()
+      if elem.tag == TAG_SRW_RECORD and parents and parents[-1].tag == TAG_SRW_RECORDS:
+        yield elem
+        parents[-1].remove(elem)
+      elif elem.tag == TAG_SRW_NEXT_RECORD_POSITION and responseInfo is not None:
+        position = getElementValue(elem)
+        responseInfo['nextRecordPosition'] = int(position) if position else None
+
+# -----------------------------------------------------------------------------
+def normalizeLookupIdentifier(identifier):
+  """This function removes whitespace from the identifier and uppercases it, such that identifiers from requests and records can be compared.
+
+  >>> normalizeLookupIdentifier('0000 0001 2103 268x')
+  '000000012103268X'
+  """
+  return ''.join(identifier.split()).upper()
+
+# -----------------------------------------------------------------------------
+def getISNICheckCharacter(digits):
+  """This function returns the ISO 27729 check character (ISO 7064 MOD 11-2) of the first 15 digits of an ISNI.
+
+  >>> getISNICheckCharacter('000000012103268')
+  '3'
+  """
+  total = 0
+  for digit in digits:
+    total = (total + int(digit)) * 2
+  result = (12 - total % 11) % 11
+  return 'X' if result == 10 else str(result)
+
+# -----------------------------------------------------------------------------
+def getValidISNI(identifier):
+  """This function returns the ISNI without spaces and dashes if it has 16 characters and a correct check character, otherwise None.
+
+  >>> getValidISNI('0000 0001-2103-2683')
+  '0000000121032683'
+  >>> getValidISNI('0000000121032684') is None, getValidISNI('000000012103268') is None, getValidISNI('00000001210326A3') is None
+  (True, True, True)
+  """
+  identifier = ''.join(identifier.split()).replace('-', '').upper()
+  if len(identifier) != 16 or not identifier[:15].isdigit():
+    return None
+  return identifier if getISNICheckCharacter(identifier[:15]) == identifier[15] else None
+
+# -----------------------------------------------------------------------------
+def getValidBnFIdentifier(identifier):
+  """This function returns the BnF identifier with its control character, or None if it is malformed or the given control character is wrong.
+
+  >>> getValidBnFIdentifier(' cb11896963c'), getValidBnFIdentifier('11896963')
+  ('cb11896963c', 'cb11896963c')
+  >>> getValidBnFIdentifier('cb11896963d') is None, getValidBnFIdentifier('cb118969c') is None, getValidBnFIdentifier('cb1189696a') is None
+  (True, True, True)
+  """
+  identifier = ''.join(identifier.split()).lower()
+  try:
+    validIdentifier = getBnFIdentifierWithControlCharacter(identifier)
+  except Exception:
+    return None
+  # an identifier with control character is only valid if it is the correct one
+  withPrefix = identifier if identifier.startswith('cb') else f'cb{identifier}'
+  if len(withPrefix) == 11 and withPrefix != validIdentifier:
+    return None
+  return validIdentifier
+
+# -----------------------------------------------------------------------------
+IDENTIFIER_VALIDATORS = {
+  'isni': getValidISNI,
+  'bnf': getValidBnFIdentifier
+}
+
+# -----------------------------------------------------------------------------
+def validateLookupIdentifiers(lookupIdentifierList, identifierType):
+  """This function returns the normalized valid lookup identifiers (of type "isni" or "bnf") and the invalid ones, empty identifiers are neither.
+
+  >>> validateLookupIdentifiers(['0000-0001-2103-2683', '', '0000 0001 2103 2684'], 'isni')
+  (['0000000121032683'], ['0000 0001 2103 2684'])
+  """
+  getValidIdentifier = IDENTIFIER_VALIDATORS[identifierType]
+  validIdentifiers = []
+  invalidIdentifiers = []
+  for lookupIdentifier in lookupIdentifierList:
+    if lookupIdentifier == '':
+      continue
+    validIdentifier = getValidIdentifier(lookupIdentifier)
+    if validIdentifier is None:
+      invalidIdentifiers.append(lookupIdentifier)
+    else:
+      validIdentifiers.append(validIdentifier)
+  return validIdentifiers, invalidIdentifiers
+
+# -----------------------------------------------------------------------------
+def buildBatchQuery(query, identifiers):
+  """This function combines the lookup of several identifiers in a single CQL query.
+
+  >>> buildBatchQuery('pica.isn=', ['0001', '0002'])
+  'pica.isn= "0001" or pica.isn= "0002"'
+  """
+  return ' or '.join([f'{query} "{identifier}"' for identifier in identifiers])
+
+# -----------------------------------------------------------------------------
+def getIdentifierPayload(payload, query, identifier):
+  """This function returns the payload of the request of a single lookup identifier.
+
+  >>> getIdentifierPayload({'recordSchema': 'isni-e'}, 'pica.isn=', '0001')
+  {'recordSchema': 'isni-e', 'query': 'pica.isn= "0001"'}
+  """
+  identifierPayload = dict(payload)
+  identifierPayload['query'] = f'{query} "{identifier}"'
+  return identifierPayload
+
+# -----------------------------------------------------------------------------
+def getBatchPayload(payload, query, identifiers, startRecord=1):
+  """This function returns the payload of the request of several lookup identifiers with one query, starting at the given record.
+
+  >>> getBatchPayload({'recordSchema': 'isni-e'}, 'pica.isn=', ['0001', '0002'])
+  {'recordSchema': 'isni-e', 'query': 'pica.isn= "0001" or pica.isn= "0002"', 'maximumRecords': '2', 'startRecord': '1'}
+  """
+  batchPayload = dict(payload)
+  batchPayload['query'] = buildBatchQuery(query, identifiers)
+  batchPayload['maximumRecords'] = str(len(identifiers))
+  batchPayload['startRecord'] = str(startRecord)
+  return batchPayload
+
+# -----------------------------------------------------------------------------
+def fetchRecord(url, payload, rateLimiter=None, cache=None, client=None):
+  """This function returns the response of the request from the cache if possible, otherwise the API is requested within the rate limit.
+
+  If an SRUClient is given, its pooled session is used and failed requests are retried.
+  """
+
+  if cache:
+    with stageMetrics.timed('cache'):
+      xmlContent = cache.get(payload)
+    if xmlContent is not None:
+      return xmlContent
+
+  if client:
+    xmlContent = client.requestRecord(payload, rateLimiter)
   else:
-    print(f'undefined datafield type "{datafieldType}"')
+    if rateLimiter:
+      with stageMetrics.timed('sleep'):
+        rateLimiter.acquire()
+    with stageMetrics.timed('request'):
+      xmlContent = requestRecord(url, payload)
+
+  if xmlContent and cache:
+    with stageMetrics.timed('cache'):
+      cache.put(payload, xmlContent)
+  return xmlContent
+
+# -----------------------------------------------------------------------------
+def requestDatafieldsPerIdentifier(url, payload, query, identifiers, compiledDefinitions, rateLimiter=None, cache=None, client=None, recordStore=None):
+  """This function requests the records of each given identifier separately and returns the found datafield values per normalized identifier.
+
+  Each response is parsed record by record and the datafields are extracted while parsing (see iterateRecords).
+  Identifiers without records are not part of the result. If a request fails None is returned.
+  If a RecordStore is given, the normalized records of each identifier are stored in it (also if there are none).
+  """
+
+  valuesPerIdentifier = {}
+  for identifier in identifiers:
+    xmlContent = fetchRecord(url, getIdentifierPayload(payload, query, identifier), rateLimiter, cache, client)
+    if not xmlContent:
+      return None
+
+    collectedValues = None
+    storedRecords = []
+    for record in stageMetrics.timedIterator('parse', iterateRecords(xmlContent)):
+      with stageMetrics.timed('extract'):
+        collectedValues = collectedValues if collectedValues is not None else {}
+        collectDatafieldValues(record, compiledDefinitions, collectedValues)
+        if recordStore is not None:
+          storedRecords.append(normalizeRecord(record))
 
+    if recordStore is not None:
+      recordStore.put(identifier, storedRecords)
 
-  # if this statement is reached nothing was found so we return None
-  return None
+    if collectedValues is not None:
+      with stageMetrics.timed('extract'):
+        valuesPerIdentifier[normalizeLookupIdentifier(identifier)] = getDatafieldValues(collectedValues, compiledDefinitions)
+
+  return valuesPerIdentifier
+
+# -----------------------------------------------------------------------------
+def requestDatafieldBatch(url, payload, query, identifiers, recordIdentifierPath, compiledDefinitions, rateLimiter=None, cache=None, client=None, recordStore=None):
+  """This function requests the records of all given identifiers with one query (paging if needed) and returns the found datafield values per normalized identifier.
+
+  Records are routed back to the identifier that requested them by reading the identifier out of the record with the given path,
+  the datafields are extracted while the response is parsed record by record (see iterateRecords).
+  Identifiers without records are not part of the result. If a request fails None is returned.
+  If a RecordStore is given, the normalized records of each identifier are stored in it once all pages are fetched.
+  """
+
+  batchPayload = getBatchPayload(payload, query, identifiers)
+  recordIdentifierPath = compilePath(getRecordRelativePath(recordIdentifierPath))
+
+  collectedValuesPerIdentifier = {normalizeLookupIdentifier(i): None for i in identifiers}
+  storedRecordsPerIdentifier = {identifier: [] for identifier in collectedValuesPerIdentifier.keys()}
+  responseInfo = {'nextRecordPosition': 1}
+  while responseInfo['nextRecordPosition'] is not None:
+    batchPayload['startRecord'] = str(responseInfo['nextRecordPosition'])
+    xmlContent = fetchRecord(url, batchPayload, rateLimiter, cache, client)
+    if not xmlContent:
+      return None
+
+    for record in stageMetrics.timedIterator('parse', iterateRecords(xmlContent, responseInfo)):
+      with stageMetrics.timed('extract'):
+        recordIdentifiers = set([normalizeLookupIdentifier(getElementValue(elem) or '') for elem in record.iterfind(recordIdentifierPath)])
+        normalizedRecord = None
+        for recordIdentifier in recordIdentifiers:
+          if recordIdentifier in collectedValuesPerIdentifier:
+            if collectedValuesPerIdentifier[recordIdentifier] is None:
+              collectedValuesPerIdentifier[recordIdentifier] = {}
+            collectDatafieldValues(record, compiledDefinitions, collectedValuesPerIdentifier[recordIdentifier])
+            if recordStore is not None:
+              normalizedRecord = normalizedRecord or normalizeRecord(record)
+              storedRecordsPerIdentifier[recordIdentifier].append(normalizedRecord)
+
+  if recordStore is not None:
+    for identifier, storedRecords in storedRecordsPerIdentifier.items():
+      recordStore.put(identifier, storedRecords)
+
+  with stageMetrics.timed('extract'):
+    return {identifier: getDatafieldValues(collectedValues, compiledDefinitions) for identifier, collectedValues in collectedValuesPerIdentifier.items() if collectedValues is not None}
+
+# -----------------------------------------------------------------------------
+def iterateDumpRecords(inFile, chunkSize=1048576):
+  """This function parses a dump file incrementally and yields each record as srw:record element, such that the paths of the configuration can be used.
+
+  A dump either contains srw:record elements (for example one or more SRU responses within a root element),
+  or its root element directly contains the records, which are then wrapped in srw:record/srw:recordData.
+  Each record is removed from the parsed tree when the caller continues with the next one.
+
+  >>> dump = f'<collection xmlns:srw="{NS_SRW}"><record><id>1</id></record><record><id>2</id></record></collection>'
+  >>> [record.find('srw:recordData/record/id', ALL_NS).text for record in iterateDumpRecords(io.BytesIO(dump.encode('utf-8')), chunkSize=10)]
+  ['1', '2']
+
+  >>> dump = f'''<dump><srw:searchRetrieveResponse xmlns:srw="{NS_SRW}"><srw:numberOfRecords>2</srw:numberOfRecords><srw:records>
+  ... <srw:record><id>1</id></srw:record><srw:record><id>2</id></srw:record></srw:records></srw:searchRetrieveResponse></dump>'''
+  >>> [record.find('id').text for record in iterateDumpRecords(io.BytesIO(dump.encode('utf-8')))]
+  ['1', '2']
+  """
+  parser = ET.XMLPullParser(events=('start', 'end'))
+  parents = []
+
+  # the number of srw:record elements so far and when the current child of the root started
+  numberSRWRecords = 0
+  numberSRWRecordsBeforeChild = 0
+  while True:
+    chunk = inFile.read(chunkSize)
+    if chunk:
+      parser.feed(chunk)
+    else:
+      parser.close()
+
+    for event, elem in parser.read_events():
+      if event == 'start':
+        parents.append(elem)
+        if len(parents) == 2:
+          numberSRWRecordsBeforeChild = numberSRWRecords
+        continue
+
+      parents.pop()
+      if elem.tag == TAG_SRW_RECORD:
+        numberSRWRecords += 1
+        yield elem
+        if parents:
+          parents[-1].remove(elem)
+      elif len(parents) == 1:
+        # a child of the root that is no SRU element and does not contain srw:record elements is a record itself
+        if numberSRWRecords == numberSRWRecordsBeforeChild and not elem.tag.startswith(f'{{{NS_SRW}}}'):
+          record = ET.Element(TAG_SRW_RECORD)
+          ET.SubElement(record, TAG_SRW_RECORD_DATA).append(elem)
+          yield record
+        parents[0].remove(elem)
+
+    if not chunk:
+      break
+
+# -----------------------------------------------------------------------------
+def buildDumpIndex(inFile, recordIdentifierPath, compiledDefinitions, identifiers=None):
+  """This function reads all records of a dump file and returns the datafield values per normalized identifier, the identifier is read out of each record with the given path.
+
+  If a set of normalized identifiers is given, only the records of these identifiers are kept.
+
+  >>> dump = f'''<collection xmlns:srw="{NS_SRW}">
+  ... <responseRecord><isni>0000 0001</isni><nationality>BE</nationality></responseRecord>
+  ... <responseRecord><isni>0000 0002</isni><nationality>NL</nationality></responseRecord>
+  ... </collection>'''
+  >>> definitions = {'nationality': {'type': 'element', 'path': 'srw:records/srw:record/srw:recordData/responseRecord/nationality'}}
+  >>> compiledDefinitions = compileDatafieldDefinitions(definitions, ['nationality'])
+  >>> buildDumpIndex(io.BytesIO(dump.encode('utf-8')), 'srw:records/srw:record/srw:recordData/responseRecord/isni', compiledDefinitions, {'00000002'})
+  {'00000002': {'nationality': 'NL'}}
+  """
+  recordIdentifierPath = compilePath(getRecordRelativePath(recordIdentifierPath))
+
+  collectedValuesPerIdentifier = {}
+  for record in stageMetrics.timedIterator('parse', iterateDumpRecords(inFile)):
+    with stageMetrics.timed('extract'):
+      recordIdentifiers = set([normalizeLookupIdentifier(getElementValue(elem) or '') for elem in record.iterfind(recordIdentifierPath)])
+      for recordIdentifier in recordIdentifiers:
+        if recordIdentifier and (identifiers is None or recordIdentifier in identifiers):
+          collectDatafieldValues(record, compiledDefinitions, collectedValuesPerIdentifier.setdefault(recordIdentifier, {}))
+
+  return {identifier: getDatafieldValues(collectedValues, compiledDefinitions) for identifier, collectedValues in collectedValuesPerIdentifier.items()}
+
+# -----------------------------------------------------------------------------
+def lookupDatafields(index, identifiers):
+  """This function returns the datafield values per normalized identifier from an index of a dump file, like a request would, identifiers without record are not part of the result.
+
+  >>> lookupDatafields({'00000002': {'nationality': 'NL'}}, ['0000 0001', '0000 0002'])
+  {'00000002': {'nationality': 'NL'}}
+  """
+  valuesPerIdentifier = {}
+  for identifier in identifiers:
+    normalizedIdentifier = normalizeLookupIdentifier(identifier)
+    if normalizedIdentifier in index:
+      valuesPerIdentifier[normalizedIdentifier] = index[normalizedIdentifier]
+  return valuesPerIdentifier
 
 # -----------------------------------------------------------------------------
-def requestRecord(url, payload):
+def requestRecord(url, payload, timeout=None):
 
   try: 
     payloadStr = urllib.parse.urlencode(payload, safe=',+*\\')
-    r = requests.get(url, params=payloadStr)
+    r = requests.get(url, params=payloadStr, timeout=timeout)
     r.raise_for_status()
 
     return r.content
@@ -0,0 +1,47 @@
+import threading
+from collections import OrderedDict
+
+class MemoryCache:
+  """An instance of this class keeps a bounded number of values in memory, the least recently used value is removed first.
+
+  >>> cache = MemoryCache(2)
+  >>> cache.put('a', 1)
+  >>> cache.put('b', 2)
+  >>> cache.get('a')
+  1
+  >>> cache.put('c', 3)
+  >>> cache.get('b') is None
+  True
+  >>> len(cache)
+  2
+  """
+
+  def __init__(self, maxEntries):
+    self.maxEntries = maxEntries
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  # ---------------------------------------------------------------------------
+  def get(self, key, default=None):
+    with self.lock:
+      if key not in self.entries:
+        return default
+      self.entries.move_to_end(key)
+      return self.entries[key]
+
+  # ---------------------------------------------------------------------------
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxEntries:
+        self.entries.popitem(last=False)
+
+  # ---------------------------------------------------------------------------
+  def __len__(self):
+    return len(self.entries)
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
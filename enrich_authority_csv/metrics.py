@@ -0,0 +1,213 @@
+import csv
+import json
+import math
+import time
+import threading
+import contextlib
+
+# durations are counted in logarithmic buckets starting at 1 microsecond, each bucket is 2^(1/4) (about 19%) wider than the previous one
+BUCKET_START = 1e-6
+BUCKETS_PER_DOUBLING = 4
+
+# the stages of the enrichment in the order in which they are reported
+STAGES = ['read', 'cache', 'store', 'sleep', 'request', 'backoff', 'parse', 'extract', 'write']
+
+class StageMetrics:
+  """An instance of this class collects the durations of the stages of the enrichment, it can be shared by several threads.
+
+  >>> stageMetrics = StageMetrics()
+  >>> for milliseconds in [1, 2, 3, 4, 100]: stageMetrics.record('request', milliseconds / 1000)
+  >>> summary = stageMetrics.getSummary()['request']
+  >>> summary['count'], round(summary['total'], 3), summary['max']
+  (5, 0.11, 0.1)
+
+  Percentiles are estimated from the buckets, they are at most one bucket (19%) too high
+  >>> 0.003 <= summary['p50'] <= 0.003 * 2 ** 0.25
+  True
+
+  Metrics of other processes can be merged
+  >>> otherMetrics = StageMetrics()
+  >>> otherMetrics.record('request', 0.5)
+  >>> stageMetrics.merge(otherMetrics.getState())
+  >>> stageMetrics.getSummary()['request']['count']
+  6
+  """
+
+  def __init__(self):
+    self.stages = {}
+    self.lock = threading.Lock()
+
+  # ---------------------------------------------------------------------------
+  def record(self, stage, seconds):
+    # this is called for each row, comparisons are cheaper than calls to min and max
+    bucket = int(math.log2(seconds / BUCKET_START) * BUCKETS_PER_DOUBLING) if seconds > BUCKET_START else 0
+    with self.lock:
+      statistics = self.stages.get(stage)
+      if statistics is None:
+        statistics = self.stages[stage] = {'count': 0, 'total': 0.0, 'min': seconds, 'max': seconds, 'buckets': {}}
+      statistics['count'] += 1
+      statistics['total'] += seconds
+      if seconds < statistics['min']:
+        statistics['min'] = seconds
+      if seconds > statistics['max']:
+        statistics['max'] = seconds
+      buckets = statistics['buckets']
+      buckets[bucket] = buckets.get(bucket, 0) + 1
+
+  # ---------------------------------------------------------------------------
+  @contextlib.contextmanager
+  def timed(self, stage):
+    """This function measures the duration of the enclosed block as the given stage."""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(stage, time.perf_counter() - start)
+
+  # ---------------------------------------------------------------------------
+  def timedIterator(self, stage, iterable):
+    """This function yields the items of the iterable and measures how long it takes to get each of them as the given stage."""
+    iterator = iter(iterable)
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        self.record(stage, time.perf_counter() - start)
+        return
+      self.record(stage, time.perf_counter() - start)
+      yield item
+
+  # ---------------------------------------------------------------------------
+  def getState(self):
+    """This function returns a copy of the collected metrics, for example to send them from a worker process to the main process."""
+    with self.lock:
+      return {stage: dict(statistics, buckets=dict(statistics['buckets'])) for stage, statistics in self.stages.items()}
+
+  # ---------------------------------------------------------------------------
+  def merge(self, state):
+    with self.lock:
+      for stage, otherStatistics in state.items():
+        if stage not in self.stages:
+          self.stages[stage] = dict(otherStatistics, buckets=dict(otherStatistics['buckets']))
+          continue
+        statistics = self.stages[stage]
+        statistics['count'] += otherStatistics['count']
+        statistics['total'] += otherStatistics['total']
+        statistics['min'] = min(statistics['min'], otherStatistics['min'])
+        statistics['max'] = max(statistics['max'], otherStatistics['max'])
+        for bucket, count in otherStatistics['buckets'].items():
+          statistics['buckets'][bucket] = statistics['buckets'].get(bucket, 0) + count
+
+  # ---------------------------------------------------------------------------
+  def reset(self):
+    with self.lock:
+      self.stages = {}
+
+  # ---------------------------------------------------------------------------
+  def getSummary(self):
+    """This function returns count, total, mean, min, max and the 50th, 90th and 99th percentile (in seconds) per stage."""
+    summary = {}
+    for stage, statistics in sorted(self.getState().items(), key=lambda item: getStageOrder(item[0])):
+      summary[stage] = {
+        'count': statistics['count'],
+        'total': statistics['total'],
+        'mean': statistics['total'] / statistics['count'],
+        'min': statistics['min'],
+        'max': statistics['max']
+      }
+      for percentile in [50, 90, 99]:
+        summary[stage][f'p{percentile}'] = getPercentile(statistics, percentile)
+    return summary
+
+# -----------------------------------------------------------------------------
+def getStageOrder(stage):
+  return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+# -----------------------------------------------------------------------------
+def getBucketUpperBound(bucket):
+  return BUCKET_START * 2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING)
+
+# -----------------------------------------------------------------------------
+def getPercentile(statistics, percentile):
+  """This function estimates the percentile of a stage as the upper bound of the bucket that contains it (but not more than the maximum)."""
+  rank = math.ceil(statistics['count'] * percentile / 100)
+  seen = 0
+  for bucket in sorted(statistics['buckets'].keys()):
+    seen += statistics['buckets'][bucket]
+    if seen >= rank:
+      return min(getBucketUpperBound(bucket), statistics['max'])
+  return statistics['max']
+
+# -----------------------------------------------------------------------------
+def getHistogram(statistics):
+  """This function returns the number of durations per decade, from below 0.1 milliseconds to 10 seconds and more.
+
+  >>> getHistogram({'buckets': {0: 3, 50: 1}})
+  [('< 0.1 ms', 3), ('< 1 ms', 0), ('< 10 ms', 1), ('< 100 ms', 0), ('< 1 s', 0), ('< 10 s', 0), ('>= 10 s', 0)]
+  """
+  bounds = [(1e-4, '< 0.1 ms'), (1e-3, '< 1 ms'), (1e-2, '< 10 ms'), (1e-1, '< 100 ms'), (1, '< 1 s'), (10, '< 10 s'), (math.inf, '>= 10 s')]
+  histogram = [[label, 0] for bound, label in bounds]
+  for bucket, count in statistics['buckets'].items():
+    # the lower bound of a bucket decides its decade
+    lowerBound = BUCKET_START * 2 ** (bucket / BUCKETS_PER_DOUBLING)
+    for i, (bound, label) in enumerate(bounds):
+      if lowerBound < bound:
+        histogram[i][1] += count
+        break
+  return [tuple(entry) for entry in histogram]
+
+# -----------------------------------------------------------------------------
+def getMetricsLine(stageMetrics):
+  """This function returns a single line with the number, mean and 99th percentile in milliseconds per stage, for example to report the progress periodically."""
+  parts = []
+  for stage, summary in stageMetrics.getSummary().items():
+    parts.append(f'{stage} n={summary["count"]} mean={summary["mean"]*1000:.2f}ms p99={summary["p99"]*1000:.2f}ms')
+  return 'metrics: ' + ', '.join(parts)
+
+# -----------------------------------------------------------------------------
+def printReport(stageMetrics, reportFile):
+  """This function prints a table with totals and percentiles per stage followed by a histogram per stage."""
+  summary = stageMetrics.getSummary()
+  if not summary:
+    return
+
+  print(file=reportFile)
+  print(f'{"stage":<10}{"count":>10}{"total s":>12}{"mean ms":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}', file=reportFile)
+  for stage, values in summary.items():
+    print(f'{stage:<10}{values["count"]:>10}{values["total"]:>12.2f}{values["mean"]*1000:>10.2f}{values["p50"]*1000:>10.2f}{values["p90"]*1000:>10.2f}{values["p99"]*1000:>10.2f}{values["max"]*1000:>10.2f}', file=reportFile)
+
+  state = stageMetrics.getState()
+  for stage in summary.keys():
+    print(file=reportFile)
+    print(f'{stage}:', file=reportFile)
+    histogram = getHistogram(state[stage])
+    maxCount = max([count for label, count in histogram])
+    for label, count in histogram:
+      print(f'  {label:>9} {count:>10} {"#" * math.ceil(40 * count / maxCount) if count else ""}', file=reportFile)
+
+# -----------------------------------------------------------------------------
+def writeMetricsFile(stageMetrics, filename):
+  """This function writes the summary per stage as CSV if the filename ends with .csv, otherwise as JSON including the histograms."""
+  summary = stageMetrics.getSummary()
+  if filename.endswith('.csv'):
+    with open(filename, 'w', newline='') as outFile:
+      outputWriter = csv.writer(outFile)
+      outputWriter.writerow(['stage', 'count', 'total', 'mean', 'min', 'max', 'p50', 'p90', 'p99'])
+      for stage, values in summary.items():
+        outputWriter.writerow([stage] + [values[name] for name in ['count', 'total', 'mean', 'min', 'max', 'p50', 'p90', 'p99']])
+  else:
+    state = stageMetrics.getState()
+    for stage in summary.keys():
+      summary[stage]['histogram'] = dict(getHistogram(state[stage]))
+    with open(filename, 'w') as outFile:
+      json.dump(summary, outFile, indent=2)
+
+# -----------------------------------------------------------------------------
+# the metrics of the current process, the stages are measured wherever they happen without passing this object around
+stageMetrics = StageMetrics()
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
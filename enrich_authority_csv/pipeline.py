@@ -0,0 +1,572 @@
+import sys
+import math
+import threading
+import enrich_authority_csv.lib as lib
+from enrich_authority_csv.rate_limiter import AdaptiveTokenBucket, createRateLimiter
+from enrich_authority_csv.response_cache import ResponseCache
+from enrich_authority_csv.memory_cache import MemoryCache
+from enrich_authority_csv.record_store import RecordStore
+from enrich_authority_csv.sru_client import SRUClient, BrokerClient
+from enrich_authority_csv.metrics import stageMetrics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# -----------------------------------------------------------------------------
+def queueRow(pendingRows, batchRows, row, lookupIdentifierList=None, futures=None):
+  """This function queues a row with the futures of its datafield values, behind the rows of a batch that is still being collected if there is one."""
+  futures = futures if futures is not None else []
+  if batchRows:
+    batchRows.append((row, lookupIdentifierList, futures))
+  else:
+    pendingRows.append((row, lookupIdentifierList, futures))
+
+# -----------------------------------------------------------------------------
+def getIdentifierFutures(lookupIdentifierList, requestedIdentifiers):
+  """This function returns the futures of identifiers that were already requested in this run and the identifiers that still have to be requested.
+
+  >>> from concurrent.futures import Future
+  >>> future = Future()
+  >>> getIdentifierFutures(['0001', '0002', '', '0002'], {'0001': future}) == ([future], ['0002'])
+  True
+  """
+  futures = []
+  newIdentifiers = []
+  newNormalizedIdentifiers = set()
+  for lookupIdentifier in lookupIdentifierList:
+    if lookupIdentifier == '':
+      continue
+    normalizedIdentifier = lib.normalizeLookupIdentifier(lookupIdentifier)
+    future = requestedIdentifiers.get(normalizedIdentifier)
+    if future is not None:
+      if future not in futures:
+        futures.append(future)
+    elif normalizedIdentifier not in newNormalizedIdentifiers:
+      newIdentifiers.append(lookupIdentifier)
+      newNormalizedIdentifiers.add(normalizedIdentifier)
+  return futures, newIdentifiers
+
+# -----------------------------------------------------------------------------
+def submitBatch(executor, requestArguments, batchRows, batchIdentifiers, requestedIdentifiers, pendingRows):
+  """This function requests the collected batch identifiers with a single query, queues the rows of the batch in input order and returns the future of the request."""
+  future = None
+  if batchIdentifiers:
+    future = executor.submit(lib.requestDatafieldBatch, *requestArguments)
+    for normalizedIdentifier in batchIdentifiers.keys():
+      requestedIdentifiers.put(normalizedIdentifier, future)
+    for row, lookupIdentifierList, futures in batchRows:
+      if lookupIdentifierList is not None and any([lib.normalizeLookupIdentifier(i) in batchIdentifiers for i in lookupIdentifierList]):
+        futures.append(future)
+  pendingRows.extend(batchRows)
+  return future
+
+# -----------------------------------------------------------------------------
+def lookupStoredRecords(requester, lookupIdentifier):
+  """This function returns a finished future with the datafield values of a lookup identifier from the record store of the requester, or None if its records are not stored."""
+  if requester['recordStore'] is None:
+    return None
+  with stageMetrics.timed('store'):
+    valuesPerIdentifier = requester['recordStore'].lookupDatafields(lookupIdentifier, requester['datafieldDefinitions'])
+  if valuesPerIdentifier is None:
+    return None
+  future = Future()
+  future.set_result(valuesPerIdentifier)
+  return future
+
+# -----------------------------------------------------------------------------
+def submitLookup(executor, requester, lookupIdentifier):
+  """This function returns the future of the datafield values of a single lookup identifier, looked up in the index of a dump file or the record store or requested by the executor."""
+  if requester.get('index') is not None:
+    future = Future()
+    future.set_result(lib.lookupDatafields(requester['index'], [lookupIdentifier]))
+    return future
+  future = lookupStoredRecords(requester, lookupIdentifier)
+  if future is not None:
+    return future
+  return executor.submit(lib.requestDatafieldsPerIdentifier, requester['url'], requester['payload'], requester['query'], [lookupIdentifier], requester['datafieldDefinitions'], requester['rateLimiter'], requester['cache'], requester['client'], requester['recordStore'])
+
+# -----------------------------------------------------------------------------
+def whenAllDone(futures, callback):
+  """This function calls the callback as soon as all given futures are done, in the thread that finished the last of them.
+
+  >>> futures = [Future(), Future()]
+  >>> whenAllDone(futures, lambda: print('done'))
+  >>> futures[0].set_result(1)
+  >>> futures[1].set_result(2)
+  done
+  """
+  if not futures:
+    callback()
+    return
+
+  remaining = [len(futures)]
+  lock = threading.Lock()
+  def futureDone(future):
+    with lock:
+      remaining[0] -= 1
+      isLast = remaining[0] == 0
+    if isLast:
+      callback()
+
+  for future in futures:
+    future.add_done_callback(futureDone)
+
+# -----------------------------------------------------------------------------
+def mergeFetchedValues(valuesPerIdentifier, futures, normalizedIdentifiers, datafieldNames=None):
+  """This function returns a copy of valuesPerIdentifier with the values of the given finished futures for the given identifiers.
+
+  Only the given datafields (by default all) are taken from the futures, such that values of an earlier source are kept.
+  If one of the requests failed None is returned.
+
+  >>> future = Future()
+  >>> future.set_result({'0001': {'nationality': 'FR', 'language': 'fre'}, '0002': {'nationality': 'NL', 'language': 'dut'}})
+  >>> mergeFetchedValues({'0001': {'nationality': 'BE'}}, [future], ['0001'], {'language'})
+  {'0001': {'nationality': 'BE', 'language': 'fre'}}
+  """
+  mergedValues = {identifier: dict(values) for identifier, values in valuesPerIdentifier.items()}
+  for future in futures:
+    values = future.result()
+    if values is None:
+      return None
+    for identifier in normalizedIdentifiers:
+      if identifier in values:
+        identifierValues = mergedValues.setdefault(identifier, {})
+        for name, value in values[identifier].items():
+          if datafieldNames is None or name in datafieldNames:
+            identifierValues[name] = value
+  return mergedValues
+
+# -----------------------------------------------------------------------------
+def requestFallbacks(row, lookupIdentifierList, futures, fallbacks, plan):
+  """This function returns a future of the datafield values of the row that also contains the values of the fallback sources.
+
+  As soon as the futures of a source are done, the next fallback source is requested if datafields it provides are still empty for the row,
+  only these datafields are taken from it. This happens in the threads of the requests, such that rows do not wait for the fallbacks of earlier rows.
+  The result is None if one of the requests failed.
+  """
+  normalizedIdentifiers = [lib.normalizeLookupIdentifier(i) for i in lookupIdentifierList if i != '']
+  rowFuture = Future()
+
+  def continueWith(number, previousFutures, valuesPerIdentifier, datafieldNames):
+    try:
+      valuesPerIdentifier = mergeFetchedValues(valuesPerIdentifier, previousFutures, normalizedIdentifiers, datafieldNames)
+      missingDatafields = set()
+      while valuesPerIdentifier is not None and number < len(fallbacks):
+        missingDatafields = plan.getMissingDatafields(row, normalizedIdentifiers, valuesPerIdentifier, fallbacks[number]['requester']['datafieldNames'])
+        if missingDatafields:
+          break
+        number += 1
+      if valuesPerIdentifier is None or number == len(fallbacks):
+        rowFuture.set_result(valuesPerIdentifier)
+        return
+
+      # each distinct identifier is requested only once per source, also if rows of several threads need it at the same time
+      fallback = fallbacks[number]
+      with fallback['lock']:
+        fallbackFutures, newIdentifiers = getIdentifierFutures(lookupIdentifierList, fallback['requestedIdentifiers'])
+        for lookupIdentifier in newIdentifiers:
+          future = submitLookup(fallback['executor'], fallback['requester'], lookupIdentifier)
+          fallback['requestedIdentifiers'].put(lib.normalizeLookupIdentifier(lookupIdentifier), future)
+          fallbackFutures.append(future)
+      whenAllDone(fallbackFutures, lambda: continueWith(number + 1, fallbackFutures, valuesPerIdentifier, missingDatafields))
+    except BaseException as e:
+      rowFuture.set_exception(e)
+
+  whenAllDone(futures, lambda: continueWith(0, futures, {}, None))
+  return rowFuture
+
+# -----------------------------------------------------------------------------
+def chainFallbacks(pendingRows, start, fallbacks, plan):
+  """This function replaces the futures of the pending rows from the given position on by a future that also contains the values of the fallback sources."""
+  for position in range(start, len(pendingRows)):
+    row, lookupIdentifierList, futures = pendingRows[position]
+    if lookupIdentifierList is not None:
+      pendingRows[position] = (row, lookupIdentifierList, [requestFallbacks(row, lookupIdentifierList, futures, fallbacks, plan)])
+
+# -----------------------------------------------------------------------------
+def popFinishedRows(pendingRows, maxPendingRows, plan, counters, requestLog, countRows=False, failedWriter=None, stateStore=None, rejectedRows=None, rejectsWriter=None, adaptiveRateLimiters=None):
+  """This function enriches and yields pending rows in input order as long as their datafields are fetched.
+
+  If more than maxPendingRows rows are pending, it waits for the datafields of the first row.
+  Rows for which a request failed are additionally written unchanged with the failedWriter if it is given.
+  If a stateStore is given, it records for each looked up row whether something was found (unless a request failed).
+  Rows of the deque rejectedRows (rows with invalid lookup identifiers in input order) are written unchanged with the rejectsWriter.
+  The current rate of the given adaptive rate limiters is shown in the progress bar.
+  Rows are counted right before they are yielded (and before they are enriched), such that the counters always match the rows that were yielded so far.
+  """
+  while pendingRows:
+    row, lookupIdentifierList, futures = pendingRows[0]
+    if len(pendingRows) <= maxPendingRows and not all([future.done() for future in futures]):
+      break
+
+    pendingRows.popleft()
+    if countRows:
+      plan.countRow(counters, row)
+
+    # rejected rows are written when they are written to the output, such that a checkpoint covers both
+    if rejectedRows and rejectedRows[0] is row:
+      rejectedRows.popleft()
+      if rejectsWriter:
+        with stageMetrics.timed('write'):
+          rejectsWriter.writerow(row)
+
+    if lookupIdentifierList is not None:
+      valuesPerIdentifier = {}
+      requestFailed = False
+      for future in futures:
+        values = future.result()
+        if values is None:
+          requestFailed = True
+        else:
+          valuesPerIdentifier.update(values)
+
+      if requestFailed:
+        counters['numberFailedRows'] = counters.get('numberFailedRows', 0) + 1
+        if failedWriter:
+          with stageMetrics.timed('write'):
+            failedWriter.writerow(row)
+
+      if stateStore and not requestFailed:
+        rowKey = plan.getRowKey(row)
+        datafieldValues = plan.getDatafieldValues(row)
+        plan.enrichRow(row, lookupIdentifierList, valuesPerIdentifier, counters)
+        stateStore.record(rowKey, lookupIdentifierList, plan.getDatafieldValues(row) == datafieldValues)
+      else:
+        plan.enrichRow(row, lookupIdentifierList, valuesPerIdentifier, counters)
+
+      # the progress bar is redrawn by update at most a few times per second, not for every row
+      description = plan.getProgressDescription(counters)
+      if adaptiveRateLimiters:
+        description += ''.join([f', {rateLimiter.getRate():.1f} requests/s' for rateLimiter in adaptiveRateLimiters])
+      requestLog.set_description(description, refresh=False)
+      requestLog.update(1)
+    yield row
+
+# -----------------------------------------------------------------------------
+def getAdaptiveRateLimiters(requester):
+  """This function returns the adaptive rate limiters of all sources of the requester, such that their current rate can be shown."""
+  requesters = [requester] + requester.get('fallbacks', [])
+  return [r['rateLimiter'] for r in requesters if isinstance(r['rateLimiter'], AdaptiveTokenBucket)]
+
+# -----------------------------------------------------------------------------
+def getRequestPayload(config, apiName, recordSchema):
+  """This function returns the payload for each request, the actual query will be appended for each request."""
+  payload = dict(config.getPayload(apiName))
+  payload['recordSchema'] = recordSchema
+  return payload
+
+# -----------------------------------------------------------------------------
+def createResponseCache(cacheDir, apiName, cacheTTL=None, cacheMaxSize=None, refresh=False, negativeCacheTTL=None):
+  """This function returns the response cache of the API in the given directory, the TTLs are given in days and the maximum size in megabytes."""
+  cacheTTLSeconds = cacheTTL * 24 * 3600 if cacheTTL is not None else None
+  cacheMaxSizeBytes = int(cacheMaxSize * 1024 * 1024) if cacheMaxSize is not None else None
+  negativeCacheTTLSeconds = negativeCacheTTL * 24 * 3600 if negativeCacheTTL is not None else None
+  return ResponseCache(cacheDir, apiName, cacheTTLSeconds, cacheMaxSizeBytes, refresh, negativeCacheTTLSeconds)
+
+# -----------------------------------------------------------------------------
+def createRecordStore(recordStoreFile, apiName, recordSchema, cacheTTL=None, refresh=False, negativeCacheTTL=None):
+  """This function returns the record store of the API and record schema in the given file, the stored records expire after the TTLs of the response cache (in days)."""
+  cacheTTLSeconds = cacheTTL * 24 * 3600 if cacheTTL is not None else None
+  negativeCacheTTLSeconds = negativeCacheTTL * 24 * 3600 if negativeCacheTTL is not None else None
+  return RecordStore(recordStoreFile, apiName, recordSchema, refresh, cacheTTLSeconds, negativeCacheTTLSeconds)
+
+# -----------------------------------------------------------------------------
+def createRequester(config, rateLimiter, apiName, query, recordSchema, dataFields, batchSize=1, maxInFlight=1, cacheDir=None, cacheTTL=None, cacheMaxSize=None, refresh=False, connectTimeout=10, readTimeout=60, maxRetries=3, negativeCacheTTL=None, hedgePercentile=None, hedgeBudget=5, recordStoreFile=None, brokerSocket=None):
+  """This function returns everything that is needed to request the datafields of lookup identifiers, it has to be closed with closeRequester.
+
+  With the socket of a broker, the requests are sent through the broker instead of to the API.
+  """
+
+  payload = getRequestPayload(config, apiName, recordSchema)
+  url = config.getURL(apiName)
+  cache = createResponseCache(cacheDir, apiName, cacheTTL, cacheMaxSize, refresh, negativeCacheTTL) if cacheDir else None
+
+  return {
+    'url': url,
+    'payload': payload,
+    'query': query,
+    # paths of the requested datafields are compiled once, each response is then parsed once and all datafields are extracted together
+    'datafieldDefinitions': lib.compileDatafieldDefinitions(config.getDatafieldDefinitions(apiName, recordSchema), dataFields.values()),
+    'recordIdentifierPath': config.getRecordIdentifierPath(apiName, recordSchema) if batchSize > 1 else None,
+    'datafieldNames': tuple(dataFields.values()),
+    'rateLimiter': rateLimiter,
+    'cache': cache,
+    # the records of each lookup identifier, such that later runs can extract other datafields without a request
+    'recordStore': createRecordStore(recordStoreFile, apiName, recordSchema, cacheTTL, refresh, negativeCacheTTL) if recordStoreFile else None,
+    # one pooled session, such that connections to the API are reused by all threads
+    'client': BrokerClient(brokerSocket, apiName) if brokerSocket else SRUClient(url, connectTimeout, readTimeout, maxRetries, poolSize=maxInFlight, hedgePercentile=hedgePercentile, hedgeBudget=hedgeBudget),
+    'maxInFlight': maxInFlight
+  }
+
+# -----------------------------------------------------------------------------
+def createDumpRequester(config, apiName, recordSchema, dataFields, dumpFile, identifiers=None, reportFile=sys.stdout):
+  """This function reads the records of a dump file into an index, such that lookup identifiers are looked up in the index instead of requested from the API.
+
+  If a set of normalized identifiers is given, only their records are kept in the index.
+  Progress messages are printed to the reportFile unless it is None.
+  """
+  datafieldDefinitions = lib.compileDatafieldDefinitions(config.getDatafieldDefinitions(apiName, recordSchema), dataFields.values())
+  recordIdentifierPath = config.getRecordIdentifierPath(apiName, recordSchema)
+
+  if reportFile:
+    print(f'Reading the records of "{dumpFile}"', file=reportFile)
+  with lib.openInputFile(dumpFile, binary=True) as inFile:
+    index = lib.buildDumpIndex(inFile, recordIdentifierPath, datafieldDefinitions, identifiers)
+  if reportFile:
+    print(f'Found records for {len(index)} lookup identifiers', file=reportFile)
+
+  return {
+    'url': None,
+    'payload': None,
+    'query': None,
+    'datafieldDefinitions': datafieldDefinitions,
+    'recordIdentifierPath': None,
+    'datafieldNames': tuple(dataFields.values()),
+    'rateLimiter': None,
+    'cache': None,
+    'recordStore': None,
+    'client': None,
+    'maxInFlight': 1,
+    'index': index
+  }
+
+# -----------------------------------------------------------------------------
+def getSourceDataFields(config, apiName, recordSchema, dataFields):
+  """This function returns the requested columns whose datafield is specified for the record schema of the API, such that each source of a run only requests what it provides."""
+  sourceDataFields = {column: name for column, name in dataFields.items() if config.containsDatafieldDefinition(apiName, recordSchema, name)}
+  if not sourceDataFields:
+    raise Exception(f'None of the requested datafields is specified for record schema "{recordSchema}" of API "{apiName}"')
+  return sourceDataFields
+
+# -----------------------------------------------------------------------------
+def getFallbackOptions(config, fallbacks, dataFields, rateLimiters, secondsBetweenAPIRequests, maxInFlight=None, workers=1, adaptive=False):
+  """This function returns the request options of each fallback source given as tuple of API, record schema and query.
+
+  The rate limiters of their APIs are added to the given dict of rate limiters (and maximum concurrency) per API,
+  such that sources of the same API share its rate limit.
+  """
+  fallbackOptions = []
+  for apiName, recordSchema, query in fallbacks:
+    sourceDataFields = getSourceDataFields(config, apiName, recordSchema, dataFields)
+    if apiName not in rateLimiters:
+      rateLimiters[apiName] = createRateLimiter(config, apiName, secondsBetweenAPIRequests, shared=workers > 1, adaptive=adaptive)
+    fallbackMaxInFlight = maxInFlight if maxInFlight else rateLimiters[apiName][1]
+    fallbackOptions.append({
+      'apiName': apiName,
+      'query': query,
+      'recordSchema': recordSchema,
+      'dataFields': sourceDataFields,
+      # the concurrent requests are divided over the workers
+      'maxInFlight': max(1, math.ceil(fallbackMaxInFlight / workers))
+    })
+  return fallbackOptions
+
+# -----------------------------------------------------------------------------
+def createFallbackRequesters(config, rateLimiters, fallbackOptions, cacheDir=None, cacheTTL=None, cacheMaxSize=None, refresh=False, connectTimeout=10, readTimeout=60, maxRetries=3, negativeCacheTTL=None, hedgePercentile=None, hedgeBudget=5, recordStoreFile=None, brokerSocket=None):
+  """This function returns a requester per fallback source, each with the rate limiter of its API, fallbacks request each identifier separately."""
+  return [createRequester(config, rateLimiters[options['apiName']][0], options['apiName'], options['query'], options['recordSchema'], options['dataFields'], batchSize=1, maxInFlight=options['maxInFlight'],
+    cacheDir=cacheDir, cacheTTL=cacheTTL, cacheMaxSize=cacheMaxSize, refresh=refresh, connectTimeout=connectTimeout, readTimeout=readTimeout, maxRetries=maxRetries, negativeCacheTTL=negativeCacheTTL,
+    hedgePercentile=hedgePercentile, hedgeBudget=hedgeBudget, recordStoreFile=recordStoreFile, brokerSocket=brokerSocket) for options in fallbackOptions]
+
+# -----------------------------------------------------------------------------
+def getSharedRequestOptions(requestOptions):
+  """This function returns the options of createRequester that the fallback sources share with the first source, without those that differ per source.
+
+  >>> getSharedRequestOptions({'apiName': 'ISNI', 'query': 'pica.isn =', 'batchSize': 10, 'cacheDir': 'cache', 'maxRetries': 3})
+  {'cacheDir': 'cache', 'maxRetries': 3}
+  """
+  return {name: value for name, value in requestOptions.items() if name not in ('apiName', 'query', 'recordSchema', 'dataFields', 'batchSize', 'maxInFlight')}
+
+# -----------------------------------------------------------------------------
+def checkSourcesCoverDataFields(dataFields, sourceDataFields):
+  """This function raises an exception if the datafield of a requested column is not provided by any of the sources.
+
+  >>> checkSourcesCoverDataFields({'nationalities': 'nationality', 'languages': 'language'}, [{'nationalities': 'nationality'}])
+  Traceback (most recent call last):
+      ...
+  Exception: The datafield "language" of column "languages" is not specified for any of the sources
+  """
+  for column, name in dataFields.items():
+    if not any([column in dataFieldsOfSource for dataFieldsOfSource in sourceDataFields]):
+      raise Exception(f'The datafield "{name}" of column "{column}" is not specified for any of the sources')
+
+# -----------------------------------------------------------------------------
+def getStateTask(apiName, recordSchema, query, dataFields, fallbacks=None):
+  """This function returns the name under which the state of rows is stored, rows are only skipped if they were looked up in the same sources for the same datafields.
+
+  >>> getStateTask('ISNI', 'isni-e', 'pica.isn =', {'nationalities': 'nationality', 'kbrIDs': 'KBR'}, [('BnF', 'unimarcxchange', 'aut.isni all')])
+  'ISNI|isni-e|pica.isn =|BnF|unimarcxchange|aut.isni all|KBR;nationality'
+  """
+  sources = [(apiName, recordSchema, query)] + [tuple(fallback) for fallback in (fallbacks if fallbacks is not None else [])]
+  return '|'.join(['|'.join(source) for source in sources] + [';'.join(sorted(dataFields.values()))])
+
+# -----------------------------------------------------------------------------
+def closeRequester(requester):
+  if requester['client']:
+    requester['client'].close()
+  if requester['cache']:
+    # the durations of this run's requests are kept with the responses, such that --plan can estimate later runs
+    if requester['client'] and requester['client'].latencies:
+      requester['cache'].addLatencies(requester['client'].latencies)
+    requester['cache'].close()
+  if requester['recordStore']:
+    requester['recordStore'].close()
+  for fallbackRequester in requester.get('fallbacks', []):
+    closeRequester(fallbackRequester)
+
+# -----------------------------------------------------------------------------
+def getRequestStatistics(requester, reusedLookups):
+  """This function returns how many lookups and requests could be avoided and how many requests were retried or hedged, over all sources."""
+  requesters = [requester] + requester.get('fallbacks', [])
+  statistics = {'reusedLookups': reusedLookups, 'retries': sum([r['client'].retries for r in requesters if r['client']])}
+  clients = [r['client'] for r in requesters if r['client'] and r['client'].hedgePercentile]
+  if clients:
+    statistics['hedgedRequests'] = sum([client.hedges for client in clients])
+    statistics['hedgeWins'] = sum([client.hedgeWins for client in clients])
+  caches = [r['cache'] for r in requesters if r['cache']]
+  if caches:
+    statistics['cacheHits'] = sum([cache.hits for cache in caches])
+    statistics['cacheMisses'] = sum([cache.misses for cache in caches])
+  recordStores = [r['recordStore'] for r in requesters if r['recordStore']]
+  if recordStores:
+    statistics['storedLookups'] = sum([recordStore.hits for recordStore in recordStores])
+  brokerClients = [r['client'] for r in requesters if isinstance(r['client'], BrokerClient)]
+  if brokerClients:
+    for answeredBy in ['request', 'memory', 'coalesced']:
+      statistics[f'broker{answeredBy.capitalize()}'] = sum([client.answeredBy[answeredBy] for client in brokerClients])
+  return statistics
+
+# -----------------------------------------------------------------------------
+def iterateEnrichedRows(inputReader, requester, plan, counters, requestLog, maxInFlight=1, batchSize=1, maxRememberedIdentifiers=100000, countRows=True, failedWriter=None, statistics=None, stateStore=None, identifierType=None, rejectsWriter=None):
+  """This function enriches the rows of the inputReader (lists as yielded by plan.readRows) and yields them in input order.
+
+  Requests are sent by a pool of maxInFlight threads, unless the requester has an index of a dump file in which the identifiers are looked up instead.
+  Identifiers whose records are in the record store of the requester are looked up in it instead of requested.
+  Rows that still miss datafields afterwards are looked up in the fallback sources of the requester, each with its own pool of threads.
+  If the iteration is stopped early, requests that are not needed anymore are cancelled.
+  If a dict is given as statistics, the number of lookups that reused an earlier request is stored as "reusedLookups".
+  If a stateStore is given, rows for which nothing was found recently are not looked up again, they are counted as "numberSkippedRows".
+  If an identifierType ("isni" or "bnf") is given, only valid lookup identifiers are looked up, invalid ones are counted as "numberRejectedIdentifiers"
+  and their rows are written unchanged with the rejectsWriter.
+  """
+
+  url, payload, query = requester['url'], requester['payload'], requester['query']
+  rateLimiter, cache, client, recordStore = requester['rateLimiter'], requester['cache'], requester['client'], requester['recordStore']
+  datafieldDefinitions = requester['datafieldDefinitions']
+  recordIdentifierPath = requester['recordIdentifierPath']
+  statistics = statistics if statistics is not None else {}
+
+  # rows wait in input order until their records are fetched, this bounds how far we read ahead
+  maxPendingRows = max(1000, maxInFlight * batchSize * 4)
+
+  # tuples of row, lookup identifiers and the futures of the fetched datafields in input order
+  pendingRows = deque()
+  rejectedRows = deque()
+  adaptiveRateLimiters = getAdaptiveRateLimiters(requester)
+
+  # the futures of already requested identifiers, such that each identifier is requested only once
+  requestedIdentifiers = MemoryCache(maxRememberedIdentifiers)
+  statistics['reusedLookups'] = 0
+
+  # in batch mode rows are collected until the batch is full
+  batchRows = []
+  batchIdentifiers = {}
+
+  # later sources are requested by their own threads and remember their own requested identifiers
+  fallbacks = [{
+    'requester': fallbackRequester,
+    'executor': ThreadPoolExecutor(max_workers=fallbackRequester['maxInFlight']),
+    'requestedIdentifiers': MemoryCache(maxRememberedIdentifiers),
+    'lock': threading.Lock()
+  } for fallbackRequester in requester.get('fallbacks', [])]
+  executors = [ThreadPoolExecutor(max_workers=maxInFlight)] + [fallback['executor'] for fallback in fallbacks]
+  executor = executors[0]
+  try:
+    for row in stageMetrics.timedIterator('read', inputReader):
+      numberPendingRows = len(pendingRows)
+
+      # we are not interested in rows that already have values for identifier we look for,
+      # and if there is no lookup identifier there is also nothing we can do
+      lookupIdentifierList = plan.getLookupIdentifiers(row) if plan.needsEnrichment(row) else None
+      if lookupIdentifierList is None:
+
+        # write the input as-is to the output and stop processing of this row,
+        # it only has to wait in the queue if rows before it are still pending
+        if pendingRows or batchRows:
+          queueRow(pendingRows, batchRows, row)
+        else:
+          if countRows:
+            plan.countRow(counters, row)
+          yield row
+        continue
+
+      # malformed identifiers and identifiers with a wrong check character would not be found anyway
+      if identifierType:
+        lookupIdentifierList, invalidIdentifiers = lib.validateLookupIdentifiers(lookupIdentifierList, identifierType)
+        if invalidIdentifiers:
+          counters['numberRejectedIdentifiers'] = counters.get('numberRejectedIdentifiers', 0) + len(invalidIdentifiers)
+          rejectedRows.append(row)
+        if not lookupIdentifierList:
+          queueRow(pendingRows, batchRows, row)
+          continue
+
+      # nothing was found for the same identifiers of this row in a recent run
+      if stateStore and stateStore.isConfirmedEmpty(plan.getRowKey(row), lookupIdentifierList):
+        counters['numberSkippedRows'] = counters.get('numberSkippedRows', 0) + 1
+        queueRow(pendingRows, batchRows, row)
+        continue
+
+      # each distinct identifier is requested only once per run, later rows reuse the (possibly still running) request
+      futures, newIdentifiers = getIdentifierFutures(lookupIdentifierList, requestedIdentifiers)
+      statistics['reusedLookups'] += len(futures)
+
+      if batchSize > 1:
+        newIdentifiers = [i for i in newIdentifiers if lib.normalizeLookupIdentifier(i) not in batchIdentifiers]
+        for lookupIdentifier in newIdentifiers:
+          # identifiers whose records are stored are not part of the batch
+          future = lookupStoredRecords(requester, lookupIdentifier)
+          if future is not None:
+            requestedIdentifiers.put(lib.normalizeLookupIdentifier(lookupIdentifier), future)
+            futures.append(future)
+          else:
+            batchIdentifiers[lib.normalizeLookupIdentifier(lookupIdentifier)] = lookupIdentifier
+            # a full batch is requested right away, also in the middle of a row with more new identifiers than the batch size
+            if len(batchIdentifiers) >= batchSize:
+              futures.append(submitBatch(executor, (url, payload, query, list(batchIdentifiers.values()), recordIdentifierPath, datafieldDefinitions, rateLimiter, cache, client, recordStore), batchRows, batchIdentifiers, requestedIdentifiers, pendingRows))
+              batchRows = []
+              batchIdentifiers = {}
+        batchRows.append((row, lookupIdentifierList, futures))
+      else:
+        for lookupIdentifier in newIdentifiers:
+          future = submitLookup(executor, requester, lookupIdentifier)
+          requestedIdentifiers.put(lib.normalizeLookupIdentifier(lookupIdentifier), future)
+          futures.append(future)
+        queueRow(pendingRows, batchRows, row, lookupIdentifierList, futures)
+
+      # rows that just became pending are looked up in the fallback sources once their values are fetched
+      if fallbacks:
+        chainFallbacks(pendingRows, numberPendingRows, fallbacks, plan)
+
+      yield from popFinishedRows(pendingRows, maxPendingRows, plan, counters, requestLog, countRows, failedWriter, stateStore, rejectedRows, rejectsWriter, adaptiveRateLimiters)
+
+    # the last batch might not be full
+    if batchRows:
+      numberPendingRows = len(pendingRows)
+      submitBatch(executor, (url, payload, query, list(batchIdentifiers.values()), recordIdentifierPath, datafieldDefinitions, rateLimiter, cache, client, recordStore), batchRows, batchIdentifiers, requestedIdentifiers, pendingRows)
+      if fallbacks:
+        chainFallbacks(pendingRows, numberPendingRows, fallbacks, plan)
+
+    # the remaining rows
+    yield from popFinishedRows(pendingRows, 0, plan, counters, requestLog, countRows, failedWriter, stateStore, rejectedRows, rejectsWriter, adaptiveRateLimiters)
+    for executor in executors:
+      executor.shutdown()
+
+  except BaseException:
+    # do not wait for requests of rows that will not be written anymore
+    for executor in executors:
+      executor.shutdown(wait=False, cancel_futures=True)
+    raise
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
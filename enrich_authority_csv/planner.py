@@ -0,0 +1,206 @@
+import sys
+import math
+import datetime
+import enrich_authority_csv.lib as lib
+from enrich_authority_csv.rate_limiter import AdaptiveTokenBucket
+
+# -----------------------------------------------------------------------------
+def collectPlannedRequests(rows, plan, counters, batchSize=1, identifierType=None, stateStore=None, recordStore=None):
+  """This function reads the rows (lists as yielded by plan.readRows) once and returns the requests a run would send, without sending them.
+
+  Rows are selected like in iterateEnrichedRows: only rows that miss a datafield and have a lookup identifier are looked up,
+  invalid identifiers (if an identifierType is given) and rows confirmed empty in the stateStore are left out and counted like in a run.
+  Each distinct identifier is requested once, with a batchSize higher than 1 the identifiers are combined in the same batches as in a run.
+  Identifiers whose records are in the given recordStore are not requested, they are returned as "storedIdentifiers".
+  The statistics of the rows are counted in the given counters.
+
+  >>> from enrich_authority_csv.enrichment_plan import EnrichmentPlan
+  >>> plan = EnrichmentPlan(['isni', 'nationality'], {'nationality': 'nationality'}, 'isni')
+  >>> counters = lib.createCounters({'nationality': 'nationality'})
+  >>> rows = [['0001;0002', ''], ['0003', 'BE'], ['0002;0004', ''], ['', '']]
+  >>> planned = collectPlannedRequests(rows, plan, counters)
+  >>> len(planned['identifiers']), planned['numberLookupIdentifiers'], planned['requests']
+  (4, 3, [['0001'], ['0002'], ['0004']])
+  >>> collectPlannedRequests(rows, plan, counters, batchSize=2)['requests']
+  [['0001', '0002'], ['0004']]
+
+  A row with more new identifiers than the batch size fills several batches
+  >>> collectPlannedRequests([['0001;0002;0003', '']], plan, counters, batchSize=2)['requests']
+  [['0001', '0002'], ['0003']]
+  """
+  planned = {'identifiers': set(), 'numberRowsToEnrich': 0, 'requests': [], 'storedIdentifiers': []}
+  requestedIdentifiers = set()
+  batchIdentifiers = {}
+
+  for row in rows:
+    plan.countRow(counters, row)
+    lookupIdentifierList = plan.getLookupIdentifiers(row)
+    if lookupIdentifierList is None:
+      continue
+    planned['identifiers'].update([lib.normalizeLookupIdentifier(i) for i in lookupIdentifierList if i])
+    if not plan.needsEnrichment(row):
+      continue
+
+    if identifierType:
+      lookupIdentifierList, invalidIdentifiers = lib.validateLookupIdentifiers(lookupIdentifierList, identifierType)
+      if invalidIdentifiers:
+        counters['numberRejectedIdentifiers'] = counters.get('numberRejectedIdentifiers', 0) + len(invalidIdentifiers)
+      if not lookupIdentifierList:
+        continue
+
+    if stateStore and stateStore.isConfirmedEmpty(plan.getRowKey(row), lookupIdentifierList):
+      counters['numberSkippedRows'] = counters.get('numberSkippedRows', 0) + 1
+      continue
+
+    planned['numberRowsToEnrich'] += 1
+    for lookupIdentifier in lookupIdentifierList:
+      normalizedIdentifier = lib.normalizeLookupIdentifier(lookupIdentifier)
+      if lookupIdentifier == '' or normalizedIdentifier in requestedIdentifiers or normalizedIdentifier in batchIdentifiers:
+        continue
+      if recordStore and recordStore.isStored(lookupIdentifier):
+        requestedIdentifiers.add(normalizedIdentifier)
+        planned['storedIdentifiers'].append(lookupIdentifier)
+      elif batchSize > 1:
+        batchIdentifiers[normalizedIdentifier] = lookupIdentifier
+        # like in a run, a full batch is requested right away, also in the middle of a row
+        if len(batchIdentifiers) >= batchSize:
+          requestedIdentifiers.update(batchIdentifiers.keys())
+          planned['requests'].append(list(batchIdentifiers.values()))
+          batchIdentifiers = {}
+      else:
+        requestedIdentifiers.add(normalizedIdentifier)
+        planned['requests'].append([lookupIdentifier])
+
+  # the last batch might not be full
+  if batchIdentifiers:
+    requestedIdentifiers.update(batchIdentifiers.keys())
+    planned['requests'].append(list(batchIdentifiers.values()))
+
+  planned['numberLookupIdentifiers'] = len(requestedIdentifiers)
+  return planned
+
+# -----------------------------------------------------------------------------
+def countCachedRequests(cache, payload, query, requests, batch=False):
+  """This function returns how many of the requests (lists of lookup identifiers) would be answered by the response cache.
+
+  Only the first page of a batch is checked, a batch whose records do not fit on one page needs further requests.
+  A batch is cached under its whole query (see ResponseCache.getKey), it only counts as cached if an earlier run sent exactly the same batch.
+  """
+  numberCached = 0
+  for identifiers in requests:
+    if batch:
+      requestPayload = lib.getBatchPayload(payload, query, identifiers)
+    else:
+      requestPayload = lib.getIdentifierPayload(payload, query, identifiers[0])
+    if cache.isCached(requestPayload):
+      numberCached += 1
+  return numberCached
+
+# -----------------------------------------------------------------------------
+def estimateSeconds(numberRequests, requestsPerSecond, maxInFlight=1, latency=None):
+  """This function returns the estimated number of seconds to send the requests or None if neither a rate limit nor a latency is known.
+
+  The requests are limited by the rate limit and by how many concurrent requests can be answered within the latency.
+
+  >>> estimateSeconds(3600, 1, 4, 0.5), estimateSeconds(3600, None, 4, 0.5), estimateSeconds(3600, 10, 1, 0.5)
+  (3600.0, 450.0, 1800.0)
+  >>> estimateSeconds(3600, None) is None, estimateSeconds(0, None)
+  (True, 0)
+  """
+  if numberRequests == 0:
+    return 0
+  requestsPerSecondLimits = []
+  if requestsPerSecond:
+    requestsPerSecondLimits.append(requestsPerSecond)
+  if latency:
+    requestsPerSecondLimits.append(maxInFlight / latency)
+  if not requestsPerSecondLimits:
+    return None
+  return numberRequests / min(requestsPerSecondLimits)
+
+# -----------------------------------------------------------------------------
+def formatDuration(seconds):
+  """This function returns the given number of seconds as days, hours, minutes and seconds.
+
+  >>> formatDuration(95000.4), formatDuration(None)
+  ('1 day, 2:23:21', 'unknown')
+  """
+  return str(datetime.timedelta(seconds=math.ceil(seconds))) if seconds is not None else 'unknown'
+
+# -----------------------------------------------------------------------------
+def planSource(name, requests, payload, query, rateLimiter, maxInFlight, cache=None, batch=False, fallback=False, numberStored=None):
+  """This function returns the number of requests of a source, how many of them the cache answers and how long the remaining requests take.
+
+  Without a cache nothing is answered by it, the latency is the median of the requests of recent runs that used the cache.
+  The number of lookup identifiers answered by the record store of the source (None without a record store) is only reported, they are not part of the requests.
+  An adaptive rate limiter is estimated at its initial rate and at its ceiling.
+  """
+  numberCached = countCachedRequests(cache, payload, query, requests, batch) if cache else None
+  numberRequests = len(requests) - (numberCached or 0)
+  latency = cache.getLatency() if cache else None
+  requestsPerSecond = rateLimiter.getRate()
+  maxRequestsPerSecond = rateLimiter.maxRequestsPerSecond if isinstance(rateLimiter, AdaptiveTokenBucket) else None
+
+  return {
+    'name': name,
+    'fallback': fallback,
+    'batch': batch,
+    'numberPlanned': len(requests),
+    'numberCached': numberCached,
+    'numberStored': numberStored,
+    'numberRequests': numberRequests,
+    'requestsPerSecond': requestsPerSecond,
+    'maxRequestsPerSecond': maxRequestsPerSecond,
+    'maxInFlight': maxInFlight,
+    'latency': latency,
+    'seconds': estimateSeconds(numberRequests, requestsPerSecond, maxInFlight, latency),
+    'minSeconds': estimateSeconds(numberRequests, maxRequestsPerSecond, maxInFlight, latency) if maxRequestsPerSecond else None
+  }
+
+# -----------------------------------------------------------------------------
+def printPlan(planned, counters, sources, dumpFile=None, reportFile=sys.stdout):
+  """This function prints the distinct lookup identifiers of the input and per source the planned requests, cache hits and the estimated duration."""
+
+  print(file=reportFile)
+  print(f'The input contains {len(planned["identifiers"])} distinct lookup identifiers in {counters["numberRowsHaveISNI"]} of {counters["numberRows"]} rows', file=reportFile)
+  print(f'{planned["numberRowsToEnrich"]} rows miss a datafield and would be looked up with {planned["numberLookupIdentifiers"]} distinct lookup identifiers', file=reportFile)
+  if 'numberRejectedIdentifiers' in counters:
+    print(f'{counters["numberRejectedIdentifiers"]} lookup identifiers would not be requested, because they are invalid', file=reportFile)
+  if 'numberSkippedRows' in counters:
+    print(f'{counters["numberSkippedRows"]} rows would be skipped, because nothing was found for their lookup identifiers in a recent run', file=reportFile)
+
+  if dumpFile:
+    print(file=reportFile)
+    print(f'The records are looked up in the dump file "{dumpFile}", they are not requested', file=reportFile)
+
+  for source in sources:
+    print(file=reportFile)
+    # fallback sources are only requested for rows that are still missing datafields, which is only known while enriching
+    atMost = 'at most ' if source['fallback'] else ''
+    name = f'{source["name"]} (fallback)' if source['fallback'] else source['name']
+    perRequest = ' (batches of lookup identifiers)' if source['batch'] else ''
+    if source['numberCached'] is None:
+      print(f'{name}: {atMost}{source["numberPlanned"]} requests{perRequest}, there is no response cache', file=reportFile)
+    else:
+      print(f'{name}: {atMost}{source["numberPlanned"]} requests{perRequest}, {source["numberCached"]} answered by the response cache, {source["numberRequests"]} have to be sent', file=reportFile)
+    if source['numberStored'] is not None:
+      print(f'  {atMost}{source["numberStored"]} lookup identifiers are answered by the record store without a request', file=reportFile)
+
+    rate = f'{source["requestsPerSecond"]:.2f} requests per second' if source['requestsPerSecond'] else 'no rate limit'
+    if source['maxRequestsPerSecond']:
+      rate += f' (adapted up to {source["maxRequestsPerSecond"]:.2f})'
+    latency = f'a recent latency of {source["latency"]*1000:.0f} ms' if source['latency'] else 'no recent latency'
+    duration = formatDuration(source['seconds'])
+    if source['minSeconds'] is not None:
+      duration = f'{formatDuration(source["minSeconds"])} to {duration}'
+    if source['seconds'] is not None:
+      duration = atMost + duration
+    print(f'  {rate}, {source["maxInFlight"]} concurrent requests and {latency}: {duration}', file=reportFile)
+
+  print(file=reportFile)
+  print('Nothing was requested, this was only a plan', file=reportFile)
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
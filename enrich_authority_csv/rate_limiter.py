@@ -0,0 +1,152 @@
+import time
+import threading
+import multiprocessing
+
+class TokenBucket:
+  """An instance of this class limits the number of API requests per second, it can be shared by several threads (and processes if it is created as shared).
+
+  Without a rate requests are never delayed
+  >>> TokenBucket(None).acquire()
+
+  A full bucket allows a burst of requests without waiting
+  >>> bucket = TokenBucket(1, capacity=3)
+  >>> start = time.monotonic()
+  >>> for i in range(3): bucket.acquire()
+  >>> time.monotonic() - start < 0.5
+  True
+
+  A shared bucket keeps its tokens in shared memory, such that it can be passed to worker processes
+  >>> TokenBucket(1, shared=True).acquire()
+  """
+
+  def __init__(self, requestsPerSecond, capacity=1, shared=False):
+    self.requestsPerSecond = requestsPerSecond
+    self.capacity = capacity
+    # the number of tokens and the time of the last refill
+    if shared:
+      self.state = multiprocessing.Array('d', [capacity, time.monotonic()], lock=False)
+      self.lock = multiprocessing.Lock()
+    else:
+      self.state = [capacity, time.monotonic()]
+      self.lock = threading.Lock()
+
+  # ---------------------------------------------------------------------------
+  def getRate(self):
+    """This function returns the current number of allowed requests per second or None if requests are not limited."""
+    return self.requestsPerSecond
+
+  # ---------------------------------------------------------------------------
+  def acquire(self):
+    """This function blocks until a request is allowed according to the rate limit."""
+    if not self.getRate():
+      return
+
+    while True:
+      with self.lock:
+        requestsPerSecond = self.getRate()
+        now = time.monotonic()
+        tokens = min(self.capacity, self.state[0] + (now - self.state[1]) * requestsPerSecond)
+        self.state[1] = now
+        if tokens >= 1:
+          self.state[0] = tokens - 1
+          return
+        self.state[0] = tokens
+        waitTime = (1 - tokens) / requestsPerSecond
+      time.sleep(waitTime)
+
+  # ---------------------------------------------------------------------------
+  def recordResponse(self, seconds, throttled=False):
+    """This function is called with the duration of each request and whether the API asked to slow down, a fixed rate ignores it."""
+    pass
+
+# -----------------------------------------------------------------------------
+class AdaptiveTokenBucket(TokenBucket):
+  """An instance of this class adapts the number of requests per second to the API with additive increase and multiplicative decrease (AIMD).
+
+  While responses arrive without throttling and in a stable time, the rate grows by increasePerSecond requests per second
+  for each second worth of requests, up to maxRequestsPerSecond. A throttled request (HTTP status 429 or 503, a timeout) or a request
+  that takes latencyFactor times longer than usual divides the rate by two, at most once per decreaseInterval seconds.
+
+  >>> bucket = AdaptiveTokenBucket(2, 4)
+  >>> for i in range(20): bucket.recordResponse(0.1)
+  >>> bucket.getRate()
+  4
+  >>> bucket.recordResponse(0.1, throttled=True)
+  >>> bucket.getRate()
+  2.0
+
+  A latency spike also decreases the rate, but not below the minimum (by default 1 request per second)
+  >>> for i in range(2):
+  ...   bucket.state[AdaptiveTokenBucket.LAST_DECREASE] = 0
+  ...   bucket.recordResponse(5)
+  >>> bucket.getRate()
+  1.0
+  """
+
+  # positions in the shared state after the tokens and the time of the last refill
+  RATE, LAST_DECREASE, LATENCY, SAMPLES = 2, 3, 4, 5
+
+  # the number of requests whose latency is averaged before latency spikes are detected
+  MIN_SAMPLES = 10
+
+  def __init__(self, requestsPerSecond, maxRequestsPerSecond, capacity=1, shared=False, minRequestsPerSecond=None, increasePerSecond=1, decreaseFactor=0.5, latencyFactor=3, decreaseInterval=1):
+    super().__init__(requestsPerSecond, capacity, shared)
+    self.maxRequestsPerSecond = maxRequestsPerSecond
+    self.minRequestsPerSecond = minRequestsPerSecond if minRequestsPerSecond else min(requestsPerSecond, 1.0)
+    self.increasePerSecond = increasePerSecond
+    self.decreaseFactor = decreaseFactor
+    self.latencyFactor = latencyFactor
+    self.decreaseInterval = decreaseInterval
+
+    # the current rate, the time of the last decrease, the average latency and the number of averaged latencies are shared as well
+    initialState = [capacity, time.monotonic(), requestsPerSecond, -decreaseInterval, 0, 0]
+    if shared:
+      self.state = multiprocessing.Array('d', initialState, lock=False)
+    else:
+      self.state = initialState
+
+  # ---------------------------------------------------------------------------
+  def getRate(self):
+    return self.state[AdaptiveTokenBucket.RATE]
+
+  # ---------------------------------------------------------------------------
+  def recordResponse(self, seconds, throttled=False):
+    with self.lock:
+      state = self.state
+      rate = state[AdaptiveTokenBucket.RATE]
+      latency = state[AdaptiveTokenBucket.LATENCY]
+      samples = state[AdaptiveTokenBucket.SAMPLES]
+      latencySpike = samples >= AdaptiveTokenBucket.MIN_SAMPLES and seconds > latency * self.latencyFactor
+
+      if throttled or latencySpike:
+        # all requests that were already in flight report the same overload, the rate is decreased only once for them
+        now = time.monotonic()
+        if now - state[AdaptiveTokenBucket.LAST_DECREASE] >= self.decreaseInterval:
+          state[AdaptiveTokenBucket.RATE] = max(self.minRequestsPerSecond, rate * self.decreaseFactor)
+          state[AdaptiveTokenBucket.LAST_DECREASE] = now
+      else:
+        state[AdaptiveTokenBucket.LATENCY] = seconds if samples == 0 else latency + 0.1 * (seconds - latency)
+        state[AdaptiveTokenBucket.SAMPLES] = samples + 1
+        state[AdaptiveTokenBucket.RATE] = min(self.maxRequestsPerSecond, rate + self.increasePerSecond / rate)
+
+# -----------------------------------------------------------------------------
+def createRateLimiter(config, apiName, secondsBetweenAPIRequests, shared=False, adaptive=False):
+  """This function returns the rate limiter of the API and the maximum number of concurrent requests from the configuration (or 1).
+
+  A rate limit of the config takes precedence over the fixed waiting time.
+  An adaptive rate limiter starts at this rate (or at the ceiling if there is none) and never exceeds the "maxRequestsPerSecond" of the config.
+  """
+  rateLimit = config.getRateLimit(apiName)
+  requestsPerSecond = rateLimit.get('requestsPerSecond', 1/secondsBetweenAPIRequests if secondsBetweenAPIRequests > 0 else None)
+  if adaptive:
+    maxRequestsPerSecond = rateLimit.get('maxRequestsPerSecond')
+    if not maxRequestsPerSecond:
+      raise Exception(f'An adaptive rate needs a ceiling "maxRequestsPerSecond" in the rate limit of API "{apiName}" in the configuration')
+    initialRequestsPerSecond = min(requestsPerSecond, maxRequestsPerSecond) if requestsPerSecond else maxRequestsPerSecond
+    return AdaptiveTokenBucket(initialRequestsPerSecond, maxRequestsPerSecond, rateLimit.get('burst', 1), shared), rateLimit.get('maxConcurrency', 1)
+  return TokenBucket(requestsPerSecond, rateLimit.get('burst', 1), shared), rateLimit.get('maxConcurrency', 1)
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+import enrich_authority_csv.lib as lib
+
+class RecordStore:
+  """An instance of this class keeps the fetched records per lookup identifier in the compact form of lib.normalizeRecord, per API and record schema.
+
+  Unlike the response cache, which keeps raw responses per query for the datafields that were requested,
+  any datafield of the configuration can be extracted from the stored records later, without a request.
+
+  >>> import tempfile
+  >>> xml = f'''<srw:record xmlns:srw="{lib.NS_SRW}"><srw:recordData><responseRecord>
+  ...   <nationality>BE</nationality>
+  ...   <sources><codeOfSource>BNF</codeOfSource><sourceIdentifier>123</sourceIdentifier></sources>
+  ...   <sources><codeOfSource>KBR</codeOfSource><sourceIdentifier>456</sourceIdentifier></sources>
+  ... </responseRecord></srw:recordData></srw:record>'''
+  >>> store = RecordStore(os.path.join(tempfile.mkdtemp(), 'records.sqlite'), 'ISNI', 'isni-e')
+  >>> store.put('0000 0001', [lib.normalizeRecord(ET.fromstring(xml))])
+  >>> store.put('0002', [])
+  >>> store.flush()
+
+  The datafields are extracted from the stored records like from fetched ones, also datafields that were not requested when the records were fetched
+  >>> definitions = {
+  ...   'nationality': {'type': 'element', 'path': 'srw:records/srw:record/srw:recordData/responseRecord/nationality'},
+  ...   'KBR': {'type': 'identifier', 'path': 'srw:records/srw:record/srw:recordData/responseRecord/sources', 'identifierCodeSubpath': 'codeOfSource', 'identifierNameSubpath': 'sourceIdentifier'}}
+  >>> compiledDefinitions = lib.compileDatafieldDefinitions(definitions, definitions.keys())
+  >>> store.lookupDatafields('00000001', compiledDefinitions), store.lookupDatafields('0002', compiledDefinitions)
+  ({'00000001': {'nationality': 'BE', 'KBR': '456'}}, {})
+
+  Identifiers that were never fetched are not in the store
+  >>> store.lookupDatafields('0003', compiledDefinitions) is None, store.hits, store.misses
+  (True, 2, 1)
+  >>> store.isStored('0002'), store.isStored('0003')
+  (True, False)
+  >>> store.close()
+
+  Stored records expire like cached responses, identifiers without any record can expire earlier than the others
+  >>> store = RecordStore(store.filename, 'ISNI', 'isni-e', negativeTTL=0)
+  >>> store.isStored('0002'), store.isStored('0000 0001'), store.lookupDatafields('0002', compiledDefinitions) is None
+  (False, True, True)
+  >>> store.ttl = 0
+  >>> store.isStored('0000 0001')
+  False
+  >>> store.close()
+  """
+
+  # the number of identifiers whose records are written together
+  FLUSH_INTERVAL = 100
+
+  def __init__(self, filename, apiName, recordSchema, refresh=False, ttl=None, negativeTTL=None):
+    directory = os.path.dirname(filename)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self.apiName = apiName
+    self.recordSchema = recordSchema
+    self.filename = filename
+    self.refresh = refresh
+    self.ttl = ttl
+    # identifiers without any record expire like the others unless they have their own TTL
+    self.negativeTTL = negativeTTL if negativeTTL is not None else ttl
+    self.hits = 0
+    self.misses = 0
+    # records that are not written yet per normalized identifier, such that they can already be looked up
+    self.pendingRecords = {}
+    self.lock = threading.Lock()
+
+    self.connection = sqlite3.connect(filename, check_same_thread=False)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')
+    self.connection.execute('CREATE TABLE IF NOT EXISTS records (api TEXT, recordSchema TEXT, identifier TEXT, records BLOB, fetched REAL, numberRecords INTEGER, PRIMARY KEY (api, recordSchema, identifier))')
+    self.connection.commit()
+
+  # ---------------------------------------------------------------------------
+  def put(self, identifier, normalizedRecords):
+    """This function stores the normalized records of a lookup identifier (an empty list if nothing was found), they are written with the next flush."""
+    content = zlib.compress(json.dumps(normalizedRecords, separators=(',', ':')).encode('utf-8'))
+    normalizedIdentifier = lib.normalizeLookupIdentifier(identifier)
+    with self.lock:
+      self.pendingRecords[normalizedIdentifier] = (self.apiName, self.recordSchema, normalizedIdentifier, content, time.time(), len(normalizedRecords))
+      if len(self.pendingRecords) >= RecordStore.FLUSH_INTERVAL:
+        self.writePendingRecords()
+
+  # ---------------------------------------------------------------------------
+  def isStored(self, identifier):
+    """This function returns True if the records of a lookup identifier are stored, without counting or reading them, for example to plan a run."""
+    if self.refresh:
+      return False
+    with self.lock:
+      return self.readEntry(identifier) is not None
+
+  # ---------------------------------------------------------------------------
+  def getRecords(self, identifier):
+    """This function returns the stored records of a lookup identifier as srw:record elements, or None if they were never stored, expired or should be fetched again."""
+    if self.refresh:
+      return None
+    with self.lock:
+      content = self.readEntry(identifier)
+      if content is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+    return [lib.buildRecord(normalizedRecord) for normalizedRecord in json.loads(zlib.decompress(content))]
+
+  # ---------------------------------------------------------------------------
+  def readEntry(self, identifier):
+    """This function returns the compressed records of a lookup identifier or None if they are not stored or expired, the lock has to be held."""
+    normalizedIdentifier = lib.normalizeLookupIdentifier(identifier)
+    pending = self.pendingRecords.get(normalizedIdentifier)
+    if pending is not None:
+      content, fetched, numberRecords = pending[3:6]
+    else:
+      result = self.connection.execute('SELECT records, fetched, numberRecords FROM records WHERE api=? AND recordSchema=? AND identifier=?', (self.apiName, self.recordSchema, normalizedIdentifier)).fetchone()
+      if result is None:
+        return None
+      content, fetched, numberRecords = result
+    ttl = self.negativeTTL if numberRecords == 0 else self.ttl
+    if ttl is not None and fetched + ttl <= time.time():
+      return None
+    return content
+
+  # ---------------------------------------------------------------------------
+  def lookupDatafields(self, identifier, compiledDefinitions):
+    """This function returns the datafield values of a lookup identifier from its stored records like lib.requestDatafieldsPerIdentifier, or None if its records are not stored."""
+    records = self.getRecords(identifier)
+    if records is None:
+      return None
+    if not records:
+      return {}
+    return {lib.normalizeLookupIdentifier(identifier): lib.extractDatafields(records, compiledDefinitions)}
+
+  # ---------------------------------------------------------------------------
+  def flush(self):
+    with self.lock:
+      self.writePendingRecords()
+
+  # ---------------------------------------------------------------------------
+  def writePendingRecords(self):
+    if self.pendingRecords:
+      self.connection.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)', self.pendingRecords.values())
+      self.connection.commit()
+      self.pendingRecords = {}
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    self.flush()
+    self.connection.close()
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
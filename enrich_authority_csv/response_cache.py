@@ -0,0 +1,237 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+
+class ResponseCache:
+  """An instance of this class stores raw API responses on disk, keyed by API name, record schema and query.
+
+  >>> import tempfile
+  >>> cache = ResponseCache(tempfile.mkdtemp(), 'ISNI')
+  >>> payload = {'query': 'pica.isn= "0000000121032683"', 'recordSchema': 'isni-e'}
+  >>> cache.get(payload) is None
+  True
+  >>> cache.put(payload, b'<xml/>')
+  >>> cache.get(payload)
+  b'<xml/>'
+
+  Expired entries are not returned
+  >>> cache.ttl = 0
+  >>> cache.get(payload) is None
+  True
+
+  The least recently used entries are evicted if the cache gets too big
+  >>> cache = ResponseCache(tempfile.mkdtemp(), 'ISNI', maxSize=10)
+  >>> cache.put({'query': '1', 'recordSchema': 'isni-e'}, b'123456')
+  >>> cache.put({'query': '2', 'recordSchema': 'isni-e'}, b'123456')
+  >>> cache.get({'query': '1', 'recordSchema': 'isni-e'}) is None
+  True
+  >>> cache.get({'query': '2', 'recordSchema': 'isni-e'})
+  b'123456'
+
+  The maximum size holds for all processes that share the cache
+  >>> directory = tempfile.mkdtemp()
+  >>> first, second = ResponseCache(directory, 'ISNI', maxSize=10), ResponseCache(directory, 'ISNI', maxSize=10)
+  >>> first.put({'query': '1'}, b'123456')
+  >>> second.put({'query': '2'}, b'123456')
+  >>> first.isCached({'query': '1'}), first.isCached({'query': '2'})
+  (False, True)
+
+  Responses without any record can expire earlier than other responses
+  >>> cache = ResponseCache(tempfile.mkdtemp(), 'ISNI', negativeTTL=0)
+  >>> cache.put({'query': '1'}, b'<srw:numberOfRecords>0</srw:numberOfRecords>')
+  >>> cache.put({'query': '2'}, b'<srw:numberOfRecords>1</srw:numberOfRecords>')
+  >>> cache.get({'query': '1'}) is None, cache.get({'query': '2'}) is None
+  (True, False)
+
+  Whether a response is cached can be checked without counting or touching it, for example to plan a run
+  >>> cache.isCached({'query': '2'}), cache.isCached({'query': '3'}), cache.hits
+  (True, False, 1)
+
+  The durations of requests are kept, such that the duration of a later run can be estimated
+  >>> cache.addLatencies([0.2, 0.4, 0.3])
+  >>> cache.getLatency()
+  0.3
+  """
+
+  FILENAME = 'responses.sqlite'
+
+  # the number of request durations per API that are kept
+  LATENCY_HISTORY = 1000
+
+  # SRU responses without any record, they are recognized without parsing the response
+  EMPTY_RESPONSE_PATTERN = re.compile(rb'numberOfRecords>\s*0\s*<')
+
+  # the number of hits whose access times are written together, unless a response is stored before
+  FLUSH_INTERVAL = 1000
+
+  def __init__(self, cacheDir, apiName, ttl=None, maxSize=None, refresh=False, negativeTTL=None):
+    os.makedirs(cacheDir, exist_ok=True)
+    self.apiName = apiName
+    self.ttl = ttl
+    # "no record" answers expire like other responses unless they have their own TTL
+    self.negativeTTL = negativeTTL if negativeTTL is not None else ttl
+    self.maxSize = maxSize
+    self.refresh = refresh
+    self.hits = 0
+    self.misses = 0
+    # the access times of hits that are not written yet per key
+    self.pendingAccesses = {}
+    self.lock = threading.Lock()
+
+    self.connection = sqlite3.connect(os.path.join(cacheDir, ResponseCache.FILENAME), check_same_thread=False)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')
+    self.connection.execute('CREATE TABLE IF NOT EXISTS responses (api TEXT, recordSchema TEXT, query TEXT, content BLOB, fetched REAL, lastAccess REAL, size INTEGER, empty INTEGER DEFAULT 0, PRIMARY KEY (api, recordSchema, query))')
+    # caches of earlier versions do not know which responses are empty
+    if 'empty' not in [column[1] for column in self.connection.execute('PRAGMA table_info(responses)')]:
+      self.connection.execute('ALTER TABLE responses ADD COLUMN empty INTEGER DEFAULT 0')
+    self.connection.execute('CREATE INDEX IF NOT EXISTS responsesLastAccess ON responses (lastAccess)')
+    self.connection.execute('CREATE TABLE IF NOT EXISTS latencies (api TEXT, recorded REAL, seconds REAL)')
+    # the total size of all responses, it is changed in the same transaction as the responses, such that processes sharing the cache agree on it
+    self.connection.execute('CREATE TABLE IF NOT EXISTS cacheSize (size INTEGER)')
+    self.connection.commit()
+    self.connection.execute('BEGIN IMMEDIATE')
+    if self.connection.execute('SELECT COUNT(*) FROM cacheSize').fetchone()[0] == 0:
+      self.connection.execute('INSERT INTO cacheSize SELECT COALESCE(SUM(size), 0) FROM responses')
+    self.connection.commit()
+
+  # ---------------------------------------------------------------------------
+  def getKey(self, payload):
+    """This function returns the cache key of a request, the query is the request payload without the record schema.
+
+    A batched request is cached under its whole query, with all its lookup identifiers in their order and the paging parameters,
+    such that it is only answered from the cache for exactly the same batch, for example not after the batch size or the input changed.
+    """
+    query = '&'.join([f'{name}={value}' for name, value in payload.items() if name != 'recordSchema'])
+    return (self.apiName, payload.get('recordSchema', ''), query)
+
+  # ---------------------------------------------------------------------------
+  def get(self, payload):
+    """This function returns the cached response of the request or None if it is not cached, expired or a refresh was requested."""
+    if self.refresh:
+      self.misses += 1
+      return None
+
+    key = self.getKey(payload)
+    now = time.time()
+    with self.lock:
+      result = self.connection.execute('SELECT content, fetched, empty FROM responses WHERE api=? AND recordSchema=? AND query=?', key).fetchone()
+      if result is None:
+        self.misses += 1
+        return None
+
+      # an expired response is replaced when it is stored again
+      content, fetched, empty = result
+      ttl = self.negativeTTL if empty else self.ttl
+      if ttl is not None and fetched + ttl <= now:
+        self.misses += 1
+        return None
+
+      self.pendingAccesses[key] = now
+      if len(self.pendingAccesses) >= ResponseCache.FLUSH_INTERVAL:
+        self.writePendingAccesses()
+        self.connection.commit()
+      self.hits += 1
+      return content
+
+  # ---------------------------------------------------------------------------
+  def isCached(self, payload):
+    """This function returns True if get would return a cached response for the request, without counting a hit or miss and without changing the entry."""
+    if self.refresh:
+      return False
+
+    key = self.getKey(payload)
+    with self.lock:
+      result = self.connection.execute('SELECT fetched, empty FROM responses WHERE api=? AND recordSchema=? AND query=?', key).fetchone()
+    if result is None:
+      return False
+    fetched, empty = result
+    ttl = self.negativeTTL if empty else self.ttl
+    return ttl is None or fetched + ttl > time.time()
+
+  # ---------------------------------------------------------------------------
+  def put(self, payload, content):
+    """This function stores the response of the request and evicts the least recently used responses if the maximum size is exceeded."""
+    key = self.getKey(payload)
+    now = time.time()
+    empty = 1 if isinstance(content, bytes) and ResponseCache.EMPTY_RESPONSE_PATTERN.search(content) else 0
+    with self.lock:
+      # the write lock is taken first, such that no other process changes the responses or their total size in between
+      self.connection.execute('BEGIN IMMEDIATE')
+      try:
+        self.writePendingAccesses()
+        self.delete(key)
+        self.connection.execute('INSERT INTO responses (api, recordSchema, query, content, fetched, lastAccess, size, empty) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', key + (content, now, now, len(content), empty))
+        self.connection.execute('UPDATE cacheSize SET size = size + ?', (len(content),))
+        self.evict()
+      except BaseException:
+        self.connection.rollback()
+        raise
+      self.connection.commit()
+
+  # ---------------------------------------------------------------------------
+  def delete(self, key):
+    result = self.connection.execute('SELECT size FROM responses WHERE api=? AND recordSchema=? AND query=?', key).fetchone()
+    if result is not None:
+      self.connection.execute('DELETE FROM responses WHERE api=? AND recordSchema=? AND query=?', key)
+      self.connection.execute('UPDATE cacheSize SET size = size - ?', (result[0],))
+
+  # ---------------------------------------------------------------------------
+  def getSize(self):
+    return self.connection.execute('SELECT size FROM cacheSize').fetchone()[0]
+
+  # ---------------------------------------------------------------------------
+  def evict(self):
+    if self.maxSize is None:
+      return
+    size = self.getSize()
+    while size > self.maxSize:
+      oldest = self.connection.execute('SELECT api, recordSchema, query FROM responses ORDER BY lastAccess, rowid LIMIT 100').fetchall()
+      if not oldest:
+        break
+      for key in oldest:
+        self.delete(key)
+        size = self.getSize()
+        if size <= self.maxSize:
+          break
+
+  # ---------------------------------------------------------------------------
+  def writePendingAccesses(self):
+    if self.pendingAccesses:
+      self.connection.executemany('UPDATE responses SET lastAccess=? WHERE api=? AND recordSchema=? AND query=?', [(lastAccess,) + key for key, lastAccess in self.pendingAccesses.items()])
+      self.pendingAccesses = {}
+
+  # ---------------------------------------------------------------------------
+  def flush(self):
+    """This function writes the access times of the recent hits, such that they count for the eviction of the least recently used responses."""
+    with self.lock:
+      self.writePendingAccesses()
+      self.connection.commit()
+
+  # ---------------------------------------------------------------------------
+  def addLatencies(self, latencies):
+    """This function stores the durations (in seconds) of requests to the API, only the most recent ones are kept."""
+    now = time.time()
+    with self.lock:
+      self.connection.executemany('INSERT INTO latencies (api, recorded, seconds) VALUES (?, ?, ?)', [(self.apiName, now, seconds) for seconds in latencies])
+      self.connection.execute('DELETE FROM latencies WHERE api=? AND rowid NOT IN (SELECT rowid FROM latencies WHERE api=? ORDER BY rowid DESC LIMIT ?)', (self.apiName, self.apiName, ResponseCache.LATENCY_HISTORY))
+      self.connection.commit()
+
+  # ---------------------------------------------------------------------------
+  def getLatency(self):
+    """This function returns the median duration of the recent requests to the API in seconds or None if none was recorded."""
+    with self.lock:
+      latencies = [row[0] for row in self.connection.execute('SELECT seconds FROM latencies WHERE api=? ORDER BY seconds', (self.apiName,))]
+    return latencies[len(latencies) // 2] if latencies else None
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    self.flush()
+    self.connection.close()
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,106 @@
+import io
+import os
+from enrich_authority_csv.lib import COMPRESSION_MAGIC_BYTES
+
+# -----------------------------------------------------------------------------
+def findShardOffsets(filename, numberShards, chunkSize=1024*1024):
+  """This function splits the rows of the given CSV file (without the header) into byte ranges of about the same size and returns them as (start, end) tuples.
+
+  Ranges always end at a row boundary: newlines within quoted values are skipped, because the number of quotes before them is odd.
+
+  >>> import tempfile
+  >>> filename = os.path.join(tempfile.mkdtemp(), 'input.csv')
+  >>> with open(filename, 'w', newline='') as outFile: outFile.write('id,name\\r\\n1,"a\\r\\nb"\\r\\n2,c\\r\\n3,"d ""e"" f"\\r\\n')
+  39
+  >>> findShardOffsets(filename, 4)
+  [(9, 19), (19, 24), (24, 39)]
+  >>> findShardOffsets(filename, 4, chunkSize=4)
+  [(9, 19), (19, 24), (24, 39)]
+
+  There are never more shards than rows
+  >>> findShardOffsets(filename, 10)
+  [(9, 19), (19, 24), (24, 39)]
+  """
+  if filename == '-':
+    raise Exception('The input cannot be split into shards if it is read from stdin')
+  with open(filename, 'rb') as inFile:
+    magic = inFile.peek(len(max(COMPRESSION_MAGIC_BYTES.keys(), key=len)))
+    if any([magic.startswith(magicBytes) for magicBytes in COMPRESSION_MAGIC_BYTES.keys()]):
+      raise Exception(f'The compressed input "{filename}" cannot be split into shards')
+
+    fileSize = os.path.getsize(filename)
+
+    # the first boundary is the end of the header, the others are the first row boundary after an equal share of the file
+    targets = [0] + [fileSize * i // numberShards for i in range(1, numberShards)]
+    boundaries = []
+    chunkStart = 0
+    quotesBefore = 0
+    while targets:
+      chunk = inFile.read(chunkSize)
+      if not chunk:
+        break
+      chunkEnd = chunkStart + len(chunk)
+
+      position = 0
+      while targets and targets[0] < chunkEnd:
+        position = max(position, targets[0] - chunkStart)
+        newline = chunk.find(b'\n', position)
+        if newline == -1:
+          break
+        if (quotesBefore + chunk.count(b'"', 0, newline)) % 2 == 0:
+          boundary = chunkStart + newline + 1
+          boundaries.append(boundary)
+          while targets and targets[0] < boundary:
+            targets.pop(0)
+        position = newline + 1
+
+      quotesBefore += chunk.count(b'"')
+      chunkStart = chunkEnd
+
+  boundaries.append(fileSize)
+  return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+# -----------------------------------------------------------------------------
+class ByteRangeReader(io.RawIOBase):
+  """An instance of this class reads only the bytes of the given range of a file."""
+
+  def __init__(self, filename, start, end):
+    self.file = open(filename, 'rb')
+    self.file.seek(start)
+    self.remaining = end - start
+
+  # ---------------------------------------------------------------------------
+  def readable(self):
+    return True
+
+  # ---------------------------------------------------------------------------
+  def readinto(self, buffer):
+    size = min(len(buffer), self.remaining)
+    if size <= 0:
+      return 0
+    numberBytes = self.file.readinto(memoryview(buffer)[:size])
+    self.remaining -= numberBytes
+    return numberBytes
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    self.file.close()
+    super().close()
+
+# -----------------------------------------------------------------------------
+def openInputShard(filename, start, end):
+  """This function opens the byte range of the given CSV file for reading, like lib.openInputFile does for the whole file.
+
+  >>> import tempfile
+  >>> filename = os.path.join(tempfile.mkdtemp(), 'input.csv')
+  >>> with open(filename, 'w', newline='') as outFile: outFile.write('id\\r\\n1\\r\\n2\\r\\n')
+  10
+  >>> with openInputShard(filename, 4, 7) as inFile: inFile.read()
+  '1\\r\\n'
+  """
+  return io.TextIOWrapper(io.BufferedReader(ByteRangeReader(filename, start, end)), newline='')
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,346 @@
+import sys
+import json
+import math
+import time
+import random
+import socket
+import threading
+import urllib.parse
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from enrich_authority_csv.metrics import stageMetrics
+
+class SRUClient:
+  """An instance of this class sends the requests to one SRU API over a pooled HTTP session, such that connections are kept alive and reused.
+
+  Requests time out after the given connect and read timeout, timeouts, connection errors and
+  the status codes 429, 500, 502, 503 and 504 are retried with an exponential backoff with jitter.
+
+  >>> client = SRUClient('http://example.org/sru', backoffFactor=1, maxBackoff=30)
+  >>> 0 <= client.getBackoff(3) <= 8
+  True
+  >>> client.getBackoff(10) <= 30
+  True
+
+  A Retry-After header of the API takes precedence
+  >>> client.getBackoff(1, '5')
+  5.0
+  >>> client.getBackoff(1, 'not a date') <= 1
+  True
+
+  With a hedge percentile, a duplicate of a request is sent if it takes longer than this percentile of the recent requests,
+  but only as long as the duplicates stay within the hedge budget (a percentage of the sent requests)
+  >>> client = SRUClient('http://example.org/sru', hedgePercentile=90, hedgeBudget=10)
+  >>> for milliseconds in range(1, 21): client.recordLatency(milliseconds / 1000)
+  >>> client.hedgeDelay
+  0.018
+  >>> client.requests = 20
+  >>> client.takeHedge(), client.takeHedge(), client.takeHedge()
+  (True, True, False)
+  >>> client.close()
+  """
+
+  RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+  # status codes with which the API asks to slow down, an adaptive rate limiter decreases its rate
+  THROTTLE_STATUS_CODES = [429, 503]
+
+  # the number of durations of successful requests that are remembered, for example to store them in the response cache
+  LATENCY_HISTORY = 1000
+
+  # requests are hedged once this many durations are known, the delay after which a duplicate is sent is updated every HEDGE_UPDATE_INTERVAL responses
+  MIN_HEDGE_SAMPLES = 20
+  HEDGE_UPDATE_INTERVAL = 50
+
+  def __init__(self, url, connectTimeout=10, readTimeout=60, maxRetries=3, backoffFactor=1, maxBackoff=60, poolSize=10, hedgePercentile=None, hedgeBudget=5):
+    if hedgePercentile is not None and not 0 < hedgePercentile < 100:
+      raise Exception(f'The hedge percentile has to be between 0 and 100, not {hedgePercentile}')
+    self.url = url
+    self.timeout = (connectTimeout, readTimeout)
+    self.maxRetries = maxRetries
+    self.backoffFactor = backoffFactor
+    self.maxBackoff = maxBackoff
+    self.retries = 0
+    self.failures = 0
+    self.latencies = deque(maxlen=SRUClient.LATENCY_HISTORY)
+
+    # the delay after which a duplicate is sent, the number of sent requests (without duplicates), of duplicates and of duplicates that answered first
+    self.hedgePercentile = hedgePercentile
+    self.hedgeBudget = hedgeBudget
+    self.hedgeDelay = None
+    self.responsesSinceHedgeDelay = 0
+    self.requests = 0
+    self.hedges = 0
+    self.hedgeWins = 0
+    self.lock = threading.Lock()
+    self.hedgeExecutor = None
+    if hedgePercentile:
+      # the request and its duplicate run in their own threads, the slower one keeps its thread until it is answered
+      self.hedgeExecutor = ThreadPoolExecutor(max_workers=4 * poolSize)
+      poolSize = 2 * poolSize
+
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  # ---------------------------------------------------------------------------
+  def getBackoff(self, attempt, retryAfter=None):
+    """This function returns the number of seconds to wait before the given retry attempt (starting with 1)."""
+    if retryAfter:
+      try:
+        return min(float(retryAfter), self.maxBackoff)
+      except ValueError:
+        try:
+          retryDate = parsedate_to_datetime(retryAfter)
+          return min(max(0.0, (retryDate - datetime.now(timezone.utc)).total_seconds()), self.maxBackoff)
+        except (TypeError, ValueError):
+          pass
+
+    # full jitter: a random time up to the exponentially growing backoff
+    return random.uniform(0, min(self.maxBackoff, self.backoffFactor * 2 ** (attempt - 1)))
+
+  # ---------------------------------------------------------------------------
+  def requestRecord(self, payload, rateLimiter=None):
+    """This function returns the content of the response or None if the request still failed after all retries.
+
+    Each attempt takes a token of the given rate limiter and reports its duration to it, as well as whether the API asked to slow down.
+    """
+    payloadStr = urllib.parse.urlencode(payload, safe=',+*\\')
+    attempt = 0
+    while True:
+      retryAfter = None
+      if rateLimiter:
+        with stageMetrics.timed('sleep'):
+          rateLimiter.acquire()
+
+      try:
+        start = time.perf_counter()
+        r, seconds = self.getResponse(payloadStr, rateLimiter)
+        if rateLimiter:
+          rateLimiter.recordResponse(seconds, throttled=r.status_code in SRUClient.THROTTLE_STATUS_CODES)
+
+        if r.status_code not in SRUClient.RETRY_STATUS_CODES:
+          r.raise_for_status()
+          self.recordLatency(seconds)
+          return r.content
+        error = f'HTTP status code {r.status_code}'
+        retryAfter = r.headers.get('Retry-After')
+
+      except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        error = f'{type(e).__name__}: {e}'
+        # a timeout is a sign of an overloaded API as well
+        if rateLimiter and isinstance(e, requests.exceptions.Timeout):
+          rateLimiter.recordResponse(time.perf_counter() - start, throttled=True)
+      except requests.exceptions.HTTPError as err:
+        print(f'There was an HTTP response code which is not 200 for url "{self.url}" and payload "{payloadStr}"', file=sys.stderr)
+        print(err, file=sys.stderr)
+        self.failures += 1
+        return None
+      except requests.exceptions.RequestException as e:
+        print(f'There was an exception in the request for url "{self.url}" and payload "{payloadStr}": {e}', file=sys.stderr)
+        self.failures += 1
+        return None
+
+      attempt += 1
+      if attempt > self.maxRetries:
+        print(f'The request for url "{self.url}" and payload "{payloadStr}" failed after {self.maxRetries} retries ({error})', file=sys.stderr)
+        self.failures += 1
+        return None
+
+      self.retries += 1
+      with stageMetrics.timed('backoff'):
+        time.sleep(self.getBackoff(attempt, retryAfter))
+
+  # ---------------------------------------------------------------------------
+  def sendRequest(self, payloadStr, rateLimiter=None):
+    """This function sends a single request and returns the response and its duration, the duplicate of a hedged request first takes a token of the rate limiter."""
+    if rateLimiter:
+      with stageMetrics.timed('sleep'):
+        rateLimiter.acquire()
+    start = time.perf_counter()
+    with stageMetrics.timed('request'):
+      r = self.session.get(self.url, params=payloadStr, timeout=self.timeout)
+    return r, time.perf_counter() - start
+
+  # ---------------------------------------------------------------------------
+  def getResponse(self, payloadStr, rateLimiter=None):
+    """This function returns the response of the request and its duration.
+
+    A hedged request that is not answered within the hedge delay is sent a second time (if the hedge budget allows it),
+    the first successful response of both is returned.
+    """
+    if self.hedgeExecutor is None:
+      return self.sendRequest(payloadStr)
+
+    with self.lock:
+      self.requests += 1
+      hedgeDelay = self.hedgeDelay
+    if hedgeDelay is None:
+      return self.sendRequest(payloadStr)
+
+    request = self.hedgeExecutor.submit(self.sendRequest, payloadStr)
+    done, notDone = wait([request], timeout=hedgeDelay)
+    if done or not self.takeHedge():
+      return request.result()
+
+    duplicate = self.hedgeExecutor.submit(self.sendRequest, payloadStr, rateLimiter)
+    done, notDone = wait([request, duplicate], return_when=FIRST_COMPLETED)
+    first = duplicate if duplicate in done and request not in done else request
+    if not self.isSuccessful(first):
+      # the other one might still succeed
+      other = duplicate if first is request else request
+      wait([other])
+      first = other if self.isSuccessful(other) else first
+
+    if first is duplicate:
+      with self.lock:
+        self.hedgeWins += 1
+    return first.result()
+
+  # ---------------------------------------------------------------------------
+  def isSuccessful(self, future):
+    return future.exception() is None and future.result()[0].status_code not in SRUClient.RETRY_STATUS_CODES
+
+  # ---------------------------------------------------------------------------
+  def takeHedge(self):
+    """This function returns True if another duplicate request is within the hedge budget and counts it."""
+    with self.lock:
+      if self.hedges + 1 <= self.requests * self.hedgeBudget / 100:
+        self.hedges += 1
+        return True
+      return False
+
+  # ---------------------------------------------------------------------------
+  def recordLatency(self, seconds):
+    """This function remembers the duration of a successful request and updates the hedge delay to the hedge percentile of the recent durations."""
+    self.latencies.append(seconds)
+    if self.hedgePercentile and len(self.latencies) >= SRUClient.MIN_HEDGE_SAMPLES:
+      with self.lock:
+        self.responsesSinceHedgeDelay += 1
+        if self.hedgeDelay is None or self.responsesSinceHedgeDelay >= SRUClient.HEDGE_UPDATE_INTERVAL:
+          latencies = sorted(self.latencies)
+          self.hedgeDelay = latencies[min(len(latencies), math.ceil(len(latencies) * self.hedgePercentile / 100)) - 1]
+          self.responsesSinceHedgeDelay = 0
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    if self.hedgeExecutor:
+      self.hedgeExecutor.shutdown(wait=False, cancel_futures=True)
+    self.session.close()
+
+# -----------------------------------------------------------------------------
+class BrokerClient:
+  """An instance of this class sends the requests of one API through a broker process (see enrich_authority_csv.broker) over a Unix socket, instead of requesting the API itself.
+
+  The broker requests the API for all jobs that use it under one rate limit per API, answers identical queries that are already in flight with the same response
+  and keeps recent responses in memory. Retries and hedging happen in the broker as well, each thread of a job uses its own connection to the broker.
+  """
+
+  def __init__(self, socketPath, apiName):
+    self.socketPath = socketPath
+    self.apiName = apiName
+    self.retries = 0
+    self.failures = 0
+    self.hedgePercentile = None
+    self.latencies = deque(maxlen=SRUClient.LATENCY_HISTORY)
+    # how many responses the broker requested, took from its memory or shared with a request that was already in flight
+    self.answeredBy = {'request': 0, 'memory': 0, 'coalesced': 0}
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.connections = []
+
+    # a missing broker is reported before the first row is read
+    self.getConnection()
+
+  # ---------------------------------------------------------------------------
+  def getConnection(self):
+    """This function returns the connection of the current thread to the broker, it is opened on first use."""
+    connection = getattr(self.local, 'connection', None)
+    if connection is None:
+      brokerSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        brokerSocket.connect(self.socketPath)
+      except OSError as e:
+        brokerSocket.close()
+        raise Exception(f'No broker is listening on "{self.socketPath}" ({e}), it is started with "python -m enrich_authority_csv.broker"')
+      connection = self.local.connection = (brokerSocket, brokerSocket.makefile('rb'))
+      with self.lock:
+        self.connections.append(connection)
+    return connection
+
+  # ---------------------------------------------------------------------------
+  def requestRecord(self, payload, rateLimiter=None):
+    """This function returns the content of the response from the broker or None if the request failed.
+
+    The given rate limiter is not used, the broker applies the rate limit of the API to the requests of all jobs.
+    """
+    error = 'the broker closed the connection'
+    header = None
+    try:
+      brokerSocket, inFile = self.getConnection()
+      start = time.perf_counter()
+      with stageMetrics.timed('request'):
+        writeMessage(brokerSocket, {'api': self.apiName, 'payload': payload})
+        header, content = readMessage(inFile)
+    except Exception as e:
+      error = e
+    if header is None:
+      # the connection is opened again for the next request, for example after the broker was restarted
+      self.local.connection = None
+      print(f'The request for payload "{payload}" failed, because the broker at "{self.socketPath}" could not be reached ({error})', file=sys.stderr)
+      self.failures += 1
+      return None
+    if 'error' in header:
+      raise Exception(f'The broker at "{self.socketPath}" could not request API "{self.apiName}": {header["error"]}')
+
+    with self.lock:
+      self.answeredBy[header['answeredBy']] += 1
+    if content is None:
+      self.failures += 1
+    elif header['answeredBy'] == 'request':
+      self.latencies.append(time.perf_counter() - start)
+    return content
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    with self.lock:
+      for brokerSocket, inFile in self.connections:
+        inFile.close()
+        brokerSocket.close()
+      self.connections = []
+
+# -----------------------------------------------------------------------------
+def writeMessage(brokerSocket, header, content=None):
+  """This function sends a message to or from the broker: a line with the JSON header (with the size of the content, -1 without content) followed by the content.
+
+  >>> left, right = socket.socketpair()
+  >>> writeMessage(left, {'answeredBy': 'memory'}, b'<xml/>')
+  >>> readMessage(right.makefile('rb'))
+  ({'answeredBy': 'memory', 'size': 6}, b'<xml/>')
+  >>> left.close(); right.close()
+  """
+  header = dict(header, size=len(content) if content is not None else -1)
+  brokerSocket.sendall(json.dumps(header).encode('utf-8') + b'\n' + (content if content is not None else b''))
+
+# -----------------------------------------------------------------------------
+def readMessage(inFile):
+  """This function returns the header and the content (None if there is none) of the next message written with writeMessage, the header is None if the connection was closed."""
+  line = inFile.readline()
+  if not line:
+    return None, None
+  header = json.loads(line)
+  if header['size'] < 0:
+    return header, None
+  content = inFile.read(header['size'])
+  if len(content) < header['size']:
+    return None, None
+  return header, content
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
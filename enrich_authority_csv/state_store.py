@@ -0,0 +1,97 @@
+import os
+import time
+import sqlite3
+import threading
+import enrich_authority_csv.lib as lib
+
+class StateStore:
+  """An instance of this class remembers per row key which lookup identifiers were looked up when and if nothing was found, such that a later run can skip them.
+
+  The state is kept per task (for example the API, record schema and datafields), a row is only skipped for the same task.
+
+  >>> import tempfile
+  >>> store = StateStore(os.path.join(tempfile.mkdtemp(), 'state.sqlite'), 'ISNI/isni-e/nationality', recheckAge=3600)
+  >>> store.record('1', ['0000 0001'], True)
+  >>> store.record('2', ['0002'], False)
+  >>> store.flush()
+
+  Only rows whose lookup found nothing are skipped, as long as their identifiers did not change
+  >>> store.isConfirmedEmpty('1', ['00000001']), store.isConfirmedEmpty('1', ['00000001', '0003']), store.isConfirmedEmpty('2', ['0002'])
+  (True, False, False)
+
+  After the recheck age they are looked up again
+  >>> store.recheckAge = 0
+  >>> store.isConfirmedEmpty('1', ['00000001'])
+  False
+  >>> store.close()
+  """
+
+  # the number of recorded rows that are written together
+  FLUSH_INTERVAL = 1000
+
+  def __init__(self, filename, task, recheckAge=None):
+    directory = os.path.dirname(filename)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self.task = task
+    self.recheckAge = recheckAge
+    self.pendingRecords = []
+    self.lock = threading.Lock()
+
+    self.connection = sqlite3.connect(filename, check_same_thread=False)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')
+    self.connection.execute('CREATE TABLE IF NOT EXISTS rows (task TEXT, rowKey TEXT, identifiers TEXT, fetched REAL, empty INTEGER, PRIMARY KEY (task, rowKey))')
+    self.connection.commit()
+
+  # ---------------------------------------------------------------------------
+  def getIdentifierKey(self, identifiers):
+    """This function returns the normalized identifiers of a row in a fixed order, such that a changed order or formatting is not a change.
+
+    >>> StateStore.getIdentifierKey(None, ['0002', '0000 0001', '', '0002'])
+    '00000001;0002'
+    """
+    return ';'.join(sorted(set([lib.normalizeLookupIdentifier(i) for i in identifiers if i != ''])))
+
+  # ---------------------------------------------------------------------------
+  def isConfirmedEmpty(self, rowKey, identifiers):
+    """This function returns True if nothing was found for the same identifiers of the row less than recheckAge seconds ago."""
+    with self.lock:
+      result = self.connection.execute('SELECT identifiers, fetched, empty FROM rows WHERE task=? AND rowKey=?', (self.task, rowKey)).fetchone()
+    if result is None:
+      return False
+
+    storedIdentifiers, fetched, empty = result
+    if not empty or storedIdentifiers != self.getIdentifierKey(identifiers):
+      return False
+    return self.recheckAge is None or fetched + self.recheckAge > time.time()
+
+  # ---------------------------------------------------------------------------
+  def record(self, rowKey, identifiers, empty):
+    """This function remembers that the identifiers of the row were just looked up and whether nothing was found, it is stored with the next flush."""
+    with self.lock:
+      self.pendingRecords.append((self.task, rowKey, self.getIdentifierKey(identifiers), time.time(), 1 if empty else 0))
+      if len(self.pendingRecords) >= StateStore.FLUSH_INTERVAL:
+        self.writePendingRecords()
+
+  # ---------------------------------------------------------------------------
+  def flush(self):
+    with self.lock:
+      self.writePendingRecords()
+
+  # ---------------------------------------------------------------------------
+  def writePendingRecords(self):
+    if self.pendingRecords:
+      self.connection.executemany('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)', self.pendingRecords)
+      self.connection.commit()
+      self.pendingRecords = []
+
+  # ---------------------------------------------------------------------------
+  def close(self):
+    self.flush()
+    self.connection.close()
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()